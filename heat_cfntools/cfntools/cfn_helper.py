@@ -18,14 +18,21 @@ Not implemented yet:
     * command line args
       - placeholders are ignored
 """
-import atexit
+import base64
+import binascii
+import bz2
+from concurrent import futures
 import configparser
 import contextlib
 import errno
 import functools
 import grp
+import gzip
+import hashlib
+import http.client
 import json
 import logging
+import lzma
 import os
 import os.path
 import pwd
@@ -36,9 +43,20 @@ try:
 except ImportError:
     rpmutils_present = False
 import re
+import select
 import shutil
+import socket
+import ssl
+import stat
 import subprocess
+import tarfile
 import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+import zipfile
+import zlib
 
 
 # Override BOTO_CONFIG, which makes boto look only at the specified
@@ -49,12 +67,93 @@ from boto import cloudformation  # noqa
 
 LOG = logging.getLogger(__name__)
 
+# The umask is process-wide: it is read once, on import, before any thread
+# is started, as reading it means setting it.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
 
 def to_boolean(b):
     val = b.lower().strip() if isinstance(b, str) else b
     return val in [True, 'true', 'yes', '1', 1]
 
 
+def file_digests(path, names):
+    """Return a dict of hash names to the hex digests of a file.
+
+    The file is read once, in chunks, whatever the number of hashes.
+    """
+    hashes = dict((name, hashlib.new(name)) for name in names)
+    with open(path, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, 65536), b''):
+            for h in hashes.values():
+                h.update(chunk)
+    return dict((name, h.hexdigest()) for name, h in hashes.items())
+
+
+def file_digest(path):
+    """Return the sha256 hex digest of a file, reading it in chunks."""
+    return file_digests(path, ['sha256'])['sha256']
+
+
+def save_json(path, data):
+    """Atomically and durably replace the JSON file at path with data.
+
+    The data is written to a temporary file next to path, which is synced
+    before being renamed over path, so that a crash leaves either the old
+    or the new content.
+    """
+    directory = os.path.dirname(path) or '.'
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory,
+                               prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def expected_checksums(meta):
+    """Return the checksums a files or sources entry expects.
+
+    Returns a dict mapping 'sha256' and/or 'md5' to lower case hex digests,
+    empty if the entry gives none.
+    """
+    if not isinstance(meta, dict):
+        return {}
+    return dict((name, meta[name].lower()) for name in ('sha256', 'md5')
+                if meta.get(name))
+
+
+def verify_checksums(url, digests, checksums):
+    """Raise DownloadError if digests do not match the expected checksums."""
+    for name, expected in sorted(checksums.items()):
+        if digests[name] != expected:
+            raise DownloadError('%s does not match its %s checksum: expected '
+                                '%s, got %s' % (url, name, expected,
+                                                digests[name]))
+
+
+def plan_entry(handler, item, action, **detail):
+    """Build one entry of a cfn-init plan.
+
+    Arguments:
+        handler -- the handler reporting the action, e.g. "files"
+        item    -- the resource acted upon, e.g. a path or a package name
+        action  -- what would be done, e.g. "install", "write", "skip"
+        detail  -- optional extra keys describing the action
+    """
+    entry = {'handler': handler, 'item': item, 'action': action}
+    entry.update(detail)
+    return entry
+
+
 def parse_creds_file(path='/etc/cfn/cfn-credentials'):
     '''Parse the cfn credentials file.
 
@@ -78,16 +177,22 @@ class InvalidCredentialsException(Exception):
 
 
 class HupConfig(object):
+    # sections which are not hooks
+    reserved_sections = ('main', 'mirrors')
+
     def __init__(self, fp_list):
         self.config = configparser.ConfigParser()
         for fp in fp_list:
             self.config.read_file(fp)
 
         self.load_main_section()
+        self.mirrors = MirrorMap.from_config(self.config)
+        self.scheduler = DownloadScheduler.from_config(self.config)
+        self.restart_policy = RestartPolicy.from_config(self.config)
 
         self.hooks = []
         for s in self.config.sections():
-            if s != 'main':
+            if s not in self.reserved_sections:
                 self.hooks.append(Hook(
                     s,
                     self.config.get(s, 'triggers'),
@@ -116,6 +221,17 @@ class HupConfig(object):
         except configparser.NoOptionError:
             self.interval = 10
 
+        try:
+            self.monitor_interval = self.config.getint('main',
+                                                       'monitor-interval')
+        except configparser.NoOptionError:
+            self.monitor_interval = 10
+
+        try:
+            self.service_watcher = self.config.get('main', 'service-watcher')
+        except configparser.NoOptionError:
+            self.service_watcher = 'auto'
+
     def __str__(self):
         return ('{stack: %s, credential_file: %s, region: %s, interval:%d}' %
                 (self.stack, self.credential_file, self.region, self.interval))
@@ -157,15 +273,55 @@ class Hook(object):
                                          self.action)
 
 
+class IdentityResolver(object):
+    """Resolve user and group names, remembering the answers.
+
+    Each known name is looked up through NSS at most once, so a resolver is
+    meant to live for a single run. Unknown names are looked up again every
+    time, as packages or commands may create them later in the run.
+    Handlers modifying users or groups must forget the names they modify.
+    """
+
+    def __init__(self):
+        self._users = {}
+        self._groups = {}
+
+    @staticmethod
+    def _lookup(cache, lookup, name):
+        try:
+            return cache[name]
+        except KeyError:
+            try:
+                entry = lookup(name)
+            except KeyError:
+                raise KeyError('name not found: %s' % name)
+            cache[name] = entry
+            return entry
+
+    def getpwnam(self, name):
+        """Like pwd.getpwnam(), raising KeyError for unknown users."""
+        return self._lookup(self._users, pwd.getpwnam, name)
+
+    def getgrnam(self, name):
+        """Like grp.getgrnam(), raising KeyError for unknown groups."""
+        return self._lookup(self._groups, grp.getgrnam, name)
+
+    def forget_user(self, name):
+        self._users.pop(name, None)
+
+    def forget_group(self, name):
+        self._groups.pop(name, None)
+
+
 class ControlledPrivilegesFailureException(Exception):
     pass
 
 
 @contextlib.contextmanager
-def controlled_privileges(user):
+def controlled_privileges(user, resolver=None):
     orig_euid = None
     try:
-        real = pwd.getpwnam(user)
+        real = (resolver or pwd).getpwnam(user)
         if os.geteuid() != real.pw_uid:
             orig_euid = os.geteuid()
             os.seteuid(real.pw_uid)
@@ -206,9 +362,12 @@ class CommandRunner(object):
             s += "\n\tstderr: %s" % self.stderr
         return s
 
-    def run(self, user='root', cwd=None, env=None):
+    def run(self, user='root', cwd=None, env=None, resolver=None):
         """Run the Command and return the output.
 
+        Arguments:
+            resolver -- an optional IdentityResolver used to look up user
+
         Returns:
             self
         """
@@ -221,7 +380,7 @@ class CommandRunner(object):
         assert isinstance(cmd, str) is bool(shell)
 
         try:
-            with controlled_privileges(user):
+            with controlled_privileges(user, resolver):
                 subproc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                                            stderr=subprocess.PIPE, cwd=cwd,
                                            env=env, shell=shell)
@@ -296,7 +455,9 @@ class RpmHelper(object):
         if versions:
             if isinstance(versions, str):
                 return versions
-            versions = sorted(versions, rpmutils.compareVerOnly,
+            versions = sorted(versions,
+                              key=functools.cmp_to_key(
+                                  rpmutils.compareVerOnly),
                               reverse=True)
             return versions[0]
         else:
@@ -309,7 +470,7 @@ class RpmHelper(object):
         Arguments:
             pkg -- A package name
         """
-        cmd = "rpm -q --queryformat '%%{VERSION}-%%{RELEASE}' %s" % pkg
+        cmd = ['rpm', '-q', '--queryformat', '%{VERSION}-%{RELEASE}', pkg]
         command = CommandRunner(cmd).run()
         return command.stdout
 
@@ -390,6 +551,8 @@ class RpmHelper(object):
             dnf      -- if True:
                         * overrides use of yum, use dnf instead
                         * packages must be in same format as yum pkg list
+
+        Returns whether the packages were installed.
         """
         if rpms:
             cmd = ['rpm', '-U', '--force', '--nosignature']
@@ -405,6 +568,7 @@ class RpmHelper(object):
         command = CommandRunner(cmd).run()
         if command.status:
             LOG.warning("Failed to install packages: %s" % cmd)
+        return command.status == 0
 
     @classmethod
     def downgrade(cls, packages, rpms=True, zypper=False, dnf=False):
@@ -423,9 +587,11 @@ class RpmHelper(object):
                             (httpd-2.2.22-1.fc16)
             dnf     -- if True:
                        * Use dnf instead of RPM/yum
+
+        Returns whether the packages were downgraded.
         """
         if rpms:
-            cls.install(packages)
+            return cls.install(packages)
         elif zypper:
             cmd = ['zypper', '-n', 'install', '--oldpackage']
             cmd.extend(packages)
@@ -447,6 +613,7 @@ class RpmHelper(object):
             command = CommandRunner(cmd).run()
             if command.status:
                 LOG.warning("Failed to downgrade packages: %s" % cmd)
+        return command.status == 0
 
 
 class PackagesHandler(object):
@@ -474,6 +641,10 @@ class PackagesHandler(object):
 
     def __init__(self, packages):
         self._packages = packages
+        # names of the packages changed, by package manager
+        self.changed = {}
+        # whether a package could not be installed
+        self.failed = False
 
     def _handle_gem_packages(self, packages):
         """very basic support for gems."""
@@ -481,25 +652,117 @@ class PackagesHandler(object):
         # -b == local & remote install
         # -y == install deps
         opts = ['-b', '-y']
+        changed = []
         for pkg_name, versions in packages.items():
-            if len(versions) > 0:
-                cmd = ['gem', 'install'] + opts
-                cmd.extend(['--version', versions[0], pkg_name])
-                CommandRunner(cmd).run()
-            else:
-                cmd = ['gem', 'install'] + opts
-                cmd.append(pkg_name)
-                CommandRunner(cmd).run()
+            version = ['--version', versions[0]] if len(versions) > 0 else []
+            cmd = ['gem', 'list', '-i'] + version + [pkg_name]
+            installed = CommandRunner(cmd).run().status == 0
+            cmd = ['gem', 'install'] + opts + version + [pkg_name]
+            if CommandRunner(cmd).run().status != 0:
+                self.failed = True
+            elif not installed:
+                changed.append(pkg_name)
+        return changed
 
     def _handle_python_packages(self, packages):
         """very basic support for easy_install."""
         # TODO(asalkeld) support versions
+        changed = []
         for pkg_name, versions in packages.items():
+            cmd = ['pip', 'show', '-q', pkg_name]
+            try:
+                installed = CommandRunner(cmd).run().status == 0
+            except OSError:
+                installed = False
             cmd = ['easy_install', pkg_name]
-            CommandRunner(cmd).run()
+            if CommandRunner(cmd).run().status != 0:
+                self.failed = True
+            elif not installed:
+                changed.append(pkg_name)
+        return changed
+
+    def _rpm_package_actions(self, packages, available):
+        """Decide what to do with each entry of a yum/dnf/zypper map.
+
+        Only read-only queries are run, so this is shared by the apply and
+        plan code paths.
+
+        Arguments:
+        packages  -- a package entries map of the form:
+                       "pkg_name" : "version",
+                       "pkg_name" : ["v1", "v2"],
+                       "pkg_name" : []
+        available -- a function returning whether a package spec can be
+                     installed from the package manager's repositories
+
+        Returns a list of (pkg, action) tuples, where action is one of
+        "installed", "unavailable", "install", "upgrade", "downgrade" or
+        "unchanged".
+        """
+        actions = []
+        for pkg_name, versions in packages.items():
+            ver = RpmHelper.newest_rpm_version(versions)
+            pkg = "%s-%s" % (pkg_name, ver) if ver else pkg_name
+            if RpmHelper.rpm_package_installed(pkg):
+                action = "installed"
+            elif not available(pkg):
+                action = "unavailable"
+            elif not ver:
+                action = "install"
+            else:
+                current_ver = RpmHelper.rpm_package_version(pkg)
+                rc = RpmHelper.compare_rpm_versions(current_ver, ver)
+                if rc < 0:
+                    action = "upgrade" if current_ver else "install"
+                elif rc > 0:
+                    action = "downgrade"
+                else:
+                    action = "unchanged"
+            actions.append((pkg, action))
+        return actions
+
+    @staticmethod
+    def _rpm_changed(packages, actions, installed=True, downgraded=True):
+        """Return the names of the packages installing actions changes.
+
+        Arguments:
+            installed  -- whether the install and upgrade batch succeeded
+            downgraded -- whether the downgrade batch succeeded
+        """
+        done = ()
+        if installed:
+            done += ("install", "upgrade")
+        if downgraded:
+            done += ("downgrade",)
+        return [pkg_name for pkg_name, (pkg, action) in zip(packages, actions)
+                if action in done]
+
+    def _rpm_package_batches(self, actions, manager):
+        """Split (pkg, action) tuples into install and downgrade batches."""
+        installs = []
+        downgrades = []
+        for pkg, action in actions:
+            if action == "unavailable":
+                LOG.warning(
+                    "Skipping package '%s'. Not available via %s" %
+                    (pkg, manager))
+            elif action in ("install", "upgrade"):
+                installs.append(pkg)
+            elif action == "downgrade":
+                downgrades.append(pkg)
+        return installs, downgrades
+
+    def _yum_missing(self):
+        """Return True when yum is not installed and dnf should be used."""
+        cmd = CommandRunner(['which', 'yum']).run()
+        if cmd.status == 127:
+            # `which` command not found
+            LOG.info("`which` not found. Using yum without checking if dnf "
+                     "is available")
+        return cmd.status == 1
 
     def _handle_zypper_packages(self, packages):
-        """Handle installation, upgrade, or downgrade of packages via yum.
+        """Handle installation, upgrade, or downgrade of packages via zypper.
 
         Arguments:
         packages -- a package entries map of the form:
@@ -519,30 +782,17 @@ class PackagesHandler(object):
             array and follow same logic for version string above
         """
         # collect pkgs for batch processing at end
-        installs = []
-        downgrades = []
-        for pkg_name, versions in packages.items():
-            ver = RpmHelper.newest_rpm_version(versions)
-            pkg = "%s-%s" % (pkg_name, ver) if ver else pkg_name
-            if RpmHelper.rpm_package_installed(pkg):
-                # FIXME:print non-error, but skipping pkg
-                pass
-            elif not RpmHelper.zypper_package_available(pkg):
-                LOG.warning(
-                    "Skipping package '%s' - unavailable via zypper", pkg)
-            elif not ver:
-                installs.append(pkg)
-            else:
-                current_ver = RpmHelper.rpm_package_version(pkg)
-                rc = RpmHelper.compare_rpm_versions(current_ver, ver)
-                if rc < 0:
-                    installs.append(pkg)
-                elif rc > 0:
-                    downgrades.append(pkg)
+        actions = self._rpm_package_actions(packages,
+                                            RpmHelper.zypper_package_available)
+        installs, downgrades = self._rpm_package_batches(actions, 'zypper')
+        installed = downgraded = True
         if installs:
-            RpmHelper.install(installs, rpms=False, zypper=True)
+            installed = RpmHelper.install(installs, rpms=False, zypper=True)
         if downgrades:
-            RpmHelper.downgrade(downgrades, zypper=True)
+            downgraded = RpmHelper.downgrade(downgrades, zypper=True)
+        if not (installed and downgraded):
+            self.failed = True
+        return self._rpm_changed(packages, actions, installed, downgraded)
 
     def _handle_dnf_packages(self, packages):
         """Handle installation, upgrade, or downgrade of packages via dnf.
@@ -565,30 +815,17 @@ class PackagesHandler(object):
             array and follow same logic for version string above
         """
         # collect pkgs for batch processing at end
-        installs = []
-        downgrades = []
-        for pkg_name, versions in packages.items():
-            ver = RpmHelper.newest_rpm_version(versions)
-            pkg = "%s-%s" % (pkg_name, ver) if ver else pkg_name
-            if RpmHelper.rpm_package_installed(pkg):
-                # FIXME:print non-error, but skipping pkg
-                pass
-            elif not RpmHelper.dnf_package_available(pkg):
-                LOG.warning(
-                    "Skipping package '%s'. Not available via yum" % pkg)
-            elif not ver:
-                installs.append(pkg)
-            else:
-                current_ver = RpmHelper.rpm_package_version(pkg)
-                rc = RpmHelper.compare_rpm_versions(current_ver, ver)
-                if rc < 0:
-                    installs.append(pkg)
-                elif rc > 0:
-                    downgrades.append(pkg)
+        actions = self._rpm_package_actions(packages,
+                                            RpmHelper.dnf_package_available)
+        installs, downgrades = self._rpm_package_batches(actions, 'dnf')
+        installed = downgraded = True
         if installs:
-            RpmHelper.install(installs, rpms=False, dnf=True)
+            installed = RpmHelper.install(installs, rpms=False, dnf=True)
         if downgrades:
-            RpmHelper.downgrade(downgrades, rpms=False, dnf=True)
+            downgraded = RpmHelper.downgrade(downgrades, rpms=False, dnf=True)
+        if not (installed and downgraded):
+            self.failed = True
+        return self._rpm_changed(packages, actions, installed, downgraded)
 
     def _handle_yum_packages(self, packages):
         """Handle installation, upgrade, or downgrade of packages via yum.
@@ -611,41 +848,22 @@ class PackagesHandler(object):
             array and follow same logic for version string above
         """
 
-        cmd = CommandRunner(['which', 'yum']).run()
-        if cmd.status == 1:
+        if self._yum_missing():
             # yum not available, use DNF if available
-            self._handle_dnf_packages(packages)
-            return
-        elif cmd.status == 127:
-            # `which` command not found
-            LOG.info("`which` not found. Using yum without checking if dnf "
-                     "is available")
+            return self._handle_dnf_packages(packages)
 
         # collect pkgs for batch processing at end
-        installs = []
-        downgrades = []
-        for pkg_name, versions in packages.items():
-            ver = RpmHelper.newest_rpm_version(versions)
-            pkg = "%s-%s" % (pkg_name, ver) if ver else pkg_name
-            if RpmHelper.rpm_package_installed(pkg):
-                # FIXME:print non-error, but skipping pkg
-                pass
-            elif not RpmHelper.yum_package_available(pkg):
-                LOG.warning(
-                    "Skipping package '%s'. Not available via yum" % pkg)
-            elif not ver:
-                installs.append(pkg)
-            else:
-                current_ver = RpmHelper.rpm_package_version(pkg)
-                rc = RpmHelper.compare_rpm_versions(current_ver, ver)
-                if rc < 0:
-                    installs.append(pkg)
-                elif rc > 0:
-                    downgrades.append(pkg)
+        actions = self._rpm_package_actions(packages,
+                                            RpmHelper.yum_package_available)
+        installs, downgrades = self._rpm_package_batches(actions, 'yum')
+        installed = downgraded = True
         if installs:
-            RpmHelper.install(installs, rpms=False)
+            installed = RpmHelper.install(installs, rpms=False)
         if downgrades:
-            RpmHelper.downgrade(downgrades)
+            downgraded = RpmHelper.downgrade(downgrades)
+        if not (installed and downgraded):
+            self.failed = True
+        return self._rpm_changed(packages, actions, installed, downgraded)
 
     def _handle_rpm_packages(self, packages):
         """Handle installation, upgrade, or downgrade of packages via rpm.
@@ -666,10 +884,25 @@ class PackagesHandler(object):
         """very basic support for apt."""
         # TODO(asalkeld) support versions
         pkg_list = list(packages)
+        missing = [pkg_name for pkg_name in pkg_list
+                   if not self._apt_installed(pkg_name)]
 
         env = {'DEBIAN_FRONTEND': 'noninteractive'}
         cmd = ['apt-get', '-y', 'install'] + pkg_list
-        CommandRunner(cmd).run(env=env)
+        if CommandRunner(cmd).run(env=env).status != 0:
+            self.failed = True
+            return []
+        return missing
+
+    @staticmethod
+    def _apt_installed(pkg_name):
+        """Return whether dpkg has a package installed."""
+        cmd = ['dpkg-query', '-W', '-f=${Status}', pkg_name]
+        command = CommandRunner(cmd).run()
+        status = command.stdout or b''
+        if isinstance(status, bytes):
+            status = status.decode('utf-8', 'replace')
+        return command.status == 0 and status.endswith(' installed')
 
     # map of function pointers to handle different package managers
     _package_handlers = {"yum": _handle_yum_packages,
@@ -686,6 +919,17 @@ class PackagesHandler(object):
             handler = self._package_handlers[manager_name]
         return handler
 
+    def _sorted_packages(self):
+        try:
+            return sorted(
+                self._packages.items(), cmp=PackagesHandler._pkgsort)
+        except TypeError:
+            # On Python 3, we have to use key instead of cmp
+            # This could also work on Python 2.7, but not on 2.6
+            return sorted(
+                self._packages.items(),
+                key=functools.cmp_to_key(PackagesHandler._pkgsort))
+
     def apply_packages(self):
         """Install, upgrade, or downgrade packages listed.
 
@@ -699,98 +943,1431 @@ class PackagesHandler(object):
         """
         if not self._packages:
             return
-        try:
-            packages = sorted(
-                self._packages.items(), cmp=PackagesHandler._pkgsort)
-        except TypeError:
-            # On Python 3, we have to use key instead of cmp
-            # This could also work on Python 2.7, but not on 2.6
-            packages = sorted(
-                self._packages.items(),
-                key=functools.cmp_to_key(PackagesHandler._pkgsort))
-
-        for manager, package_entries in packages:
+        for manager, package_entries in self._sorted_packages():
             handler = self._package_handler(manager)
             if not handler:
                 LOG.warning("Skipping invalid package type: %s" % manager)
             else:
-                handler(self, package_entries)
+                changed = handler(self, package_entries)
+                if changed:
+                    self.changed.setdefault(manager, set()).update(changed)
+
+    def _plan_rpm_packages(self, manager, packages):
+        if manager == "zypper":
+            available = RpmHelper.zypper_package_available
+        elif manager == "yum" and not self._yum_missing():
+            available = RpmHelper.yum_package_available
+        else:
+            available = RpmHelper.dnf_package_available
+        plan = []
+        for pkg, action in self._rpm_package_actions(packages, available):
+            if action in ("installed", "unchanged", "unavailable"):
+                plan.append(plan_entry('packages', pkg, 'skip',
+                                       manager=manager, reason=action))
+            else:
+                plan.append(plan_entry('packages', pkg, action,
+                                       manager=manager))
+        return plan
+
+    def _plan_apt_packages(self, packages):
+        plan = []
+        for pkg_name in packages:
+            if self._apt_installed(pkg_name):
+                plan.append(plan_entry('packages', pkg_name, 'skip',
+                                       manager='apt', reason='installed'))
+            else:
+                plan.append(plan_entry('packages', pkg_name, 'install',
+                                       manager='apt'))
+        return plan
 
+    def plan_packages(self):
+        """Return the actions apply_packages() would take.
 
-class FilesHandler(object):
-    def __init__(self, files):
-        self._files = files
+        Only read-only package database queries are run.
+        """
+        plan = []
+        if not self._packages:
+            return plan
+        for manager, package_entries in self._sorted_packages():
+            if manager in ("yum", "dnf", "zypper"):
+                plan.extend(self._plan_rpm_packages(manager, package_entries))
+            elif manager == "apt":
+                plan.extend(self._plan_apt_packages(package_entries))
+            elif manager in ("rubygems", "python"):
+                plan.extend(plan_entry('packages', pkg_name, 'install',
+                                       manager=manager)
+                            for pkg_name in package_entries)
+            else:
+                reason = ('unsupported' if manager == 'rpm'
+                          else 'invalid package type')
+                plan.extend(plan_entry('packages', pkg_name, 'skip',
+                                       manager=manager, reason=reason)
+                            for pkg_name in package_entries)
+        return plan
 
-    def apply_files(self):
-        if not self._files:
+
+class DownloadError(Exception):
+    pass
+
+
+class MirrorMap(object):
+    """Maps URL prefixes to mirrors serving the same content.
+
+    The mirrors of a URL are tried in the order they are listed, and its
+    origin last. A mirror which could not be reached, or answered with a
+    server error, is not tried again for cooldown seconds.
+    """
+
+    def __init__(self, mirrors=None, cooldown=300):
+        # the longest matching prefix wins
+        self._mirrors = sorted((mirrors or {}).items(),
+                               key=lambda item: len(item[0]), reverse=True)
+        self.cooldown = cooldown
+        self._failed = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, section='mirrors'):
+        """Build a map from the mirrors section of a ConfigParser.
+
+        Each option of the section, whatever its name, lists a URL prefix
+        followed by the prefixes of its mirrors, e.g.::
+
+            [mirrors]
+            artifacts = http://artifacts.example.com/
+                        http://mirror.az1.example.com/artifacts/
+        """
+        mirrors = {}
+        if config.has_section(section):
+            for name, value in config.items(section):
+                urls = value.replace(',', ' ').split()
+                if len(urls) < 2:
+                    LOG.warning('Ignoring mirror %s, it has no mirror URL' %
+                                name)
+                    continue
+                mirrors[urls[0]] = urls[1:]
+        return cls(mirrors)
+
+    @classmethod
+    def from_files(cls, paths):
+        """Build a map from the mirrors section of configuration files.
+
+        Missing files are ignored.
+        """
+        config = configparser.ConfigParser()
+        try:
+            config.read(paths)
+        except configparser.Error as e:
+            LOG.warning('Could not read the mirrors configuration: %s' % e)
+        return cls.from_config(config)
+
+    def __bool__(self):
+        return bool(self._mirrors)
+
+    def candidates(self, url):
+        """Return the URLs to try for url, the origin coming last."""
+        for prefix, mirrors in self._mirrors:
+            if url.startswith(prefix):
+                break
+        else:
+            return [url]
+        now = time.monotonic()
+        with self._lock:
+            healthy = [mirror for mirror in mirrors
+                       if self._failed.get(mirror, 0) <= now]
+        return [mirror + url[len(prefix):] for mirror in healthy] + [url]
+
+    def _mirror_of(self, url):
+        for prefix, mirrors in self._mirrors:
+            for mirror in mirrors:
+                if url.startswith(mirror):
+                    return mirror
+        return None
+
+    def failed(self, url):
+        """Record that the mirror url belongs to is failing."""
+        mirror = self._mirror_of(url)
+        if mirror:
+            with self._lock:
+                self._failed[mirror] = time.monotonic() + self.cooldown
+
+    def succeeded(self, url):
+        """Record that the mirror url belongs to is working."""
+        mirror = self._mirror_of(url)
+        if mirror:
+            with self._lock:
+                self._failed.pop(mirror, None)
+
+
+class DownloadScheduler(object):
+    """Limits the downloads running at once and the bandwidth they use.
+
+    At most max_downloads transfers run at the same time, and at most
+    max_per_host to the same host (None for no limit). If rate is set, all
+    transfers together read at most rate bytes per second, with bursts of
+    up to burst bytes (one second worth of rate by default). A scheduler is
+    shared by all the threads downloading for a cfn-init run.
+    """
+
+    def __init__(self, max_downloads=None, max_per_host=None, rate=None,
+                 burst=None):
+        self.max_per_host = max_per_host
+        self.rate = rate
+        self.burst = burst or rate
+        self._downloads = (threading.BoundedSemaphore(max_downloads)
+                           if max_downloads else None)
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+
+    @staticmethod
+    def _parse_rate(value):
+        """Parse a number of bytes per second, with an optional K/M/G."""
+        value = value.strip().upper()
+        scale = 1
+        if value and value[-1] in 'KMG':
+            scale = 1024 ** ('KMG'.index(value[-1]) + 1)
+            value = value[:-1]
+        return int(float(value) * scale)
+
+    @classmethod
+    def from_config(cls, config, section='main'):
+        """Build a scheduler from the download options of a ConfigParser.
+
+        The options are download-concurrency (default 8),
+        download-concurrency-per-host (default 4) and download-rate, in
+        bytes per second with an optional K, M or G suffix (no limit by
+        default).
+        """
+        limits = {'max_downloads': 8, 'max_per_host': 4, 'rate': None}
+        try:
+            if config.has_option(section, 'download-concurrency'):
+                limits['max_downloads'] = config.getint(
+                    section, 'download-concurrency')
+            if config.has_option(section, 'download-concurrency-per-host'):
+                limits['max_per_host'] = config.getint(
+                    section, 'download-concurrency-per-host')
+            if config.has_option(section, 'download-rate'):
+                limits['rate'] = cls._parse_rate(
+                    config.get(section, 'download-rate'))
+        except ValueError as e:
+            LOG.warning('Invalid download limits, using the defaults: %s' %
+                        e)
+            limits = {'max_downloads': 8, 'max_per_host': 4, 'rate': None}
+        return cls(**limits)
+
+    @classmethod
+    def from_files(cls, paths):
+        """Build a scheduler from the [main] section of configuration files.
+
+        Missing files are ignored.
+        """
+        config = configparser.ConfigParser()
+        try:
+            config.read(paths)
+        except configparser.Error as e:
+            LOG.warning('Could not read the download configuration: %s' % e)
+        return cls.from_config(config)
+
+    def _host_semaphore(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(
+                    self.max_per_host)
+            return self._hosts[host]
+
+    def acquire(self, url):
+        """Wait for a download slot for url and return it."""
+        host = self._host_semaphore(url) if self.max_per_host else None
+        if self._downloads:
+            self._downloads.acquire()
+        if host:
+            host.acquire()
+        return host
+
+    def release(self, slot):
+        """Give back a slot returned by acquire()."""
+        if slot:
+            slot.release()
+        if self._downloads:
+            self._downloads.release()
+
+    @contextlib.contextmanager
+    def slot(self, url):
+        slot = self.acquire(url)
+        try:
+            yield
+        finally:
+            self.release(slot)
+
+    def throttle(self, size):
+        """Account for size bytes read, sleeping to keep under the rate."""
+        if not self.rate or not size:
             return
-        for fdest, meta in self._files.items():
-            dest = fdest.encode()
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= size
+            # readers share the debt, each waiting until it is paid back
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class _ThrottledResponse(object):
+    """Wraps an HTTPResponse, throttling reads through a scheduler."""
+
+    def __init__(self, resp, scheduler):
+        self._resp = resp
+        self._scheduler = scheduler
+
+    def __getattr__(self, name):
+        return getattr(self._resp, name)
+
+    def read(self, amt=None):
+        data = self._resp.read(amt)
+        self._scheduler.throttle(len(data))
+        return data
+
+    def readinto(self, b):
+        size = self._resp.readinto(b)
+        self._scheduler.throttle(size)
+        return size
+
+
+class HttpClient(object):
+    """A small HTTP(S) client keeping the connections to each host alive.
+
+    Idle connections are pooled per scheme and host, so that fetching many
+    artifacts from the same server does not pay for a TCP (and TLS)
+    handshake each time. A client can be shared between threads.
+
+    If a MirrorMap is given, the mirrors of each URL are tried before it.
+    Requests wait for a slot of the DownloadScheduler, and reading their
+    responses is throttled by it.
+
+    Like curl, the client goes through the proxies of the http_proxy and
+    https_proxy environment variables, except for the hosts of no_proxy,
+    tunnelling HTTPS requests with CONNECT. The user and password of a URL
+    are sent with Basic authentication.
+    """
+
+    max_redirects = 5
+
+    def __init__(self, timeout=60, max_idle=4, mirrors=None,
+                 scheduler=None):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.mirrors = mirrors or MirrorMap()
+        self.scheduler = scheduler or DownloadScheduler()
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _basic_auth(parts):
+        """Return the Basic authorization of the userinfo of a URL."""
+        credentials = '%s:%s' % (urllib.parse.unquote(parts.username or ''),
+                                 urllib.parse.unquote(parts.password or ''))
+        return 'Basic %s' % base64.b64encode(
+            credentials.encode('UTF-8')).decode('ascii')
+
+    @staticmethod
+    def _proxy(parts):
+        """Return the split URL of the proxy for a split URL, or None."""
+        proxy = urllib.request.getproxies().get(parts.scheme)
+        if not proxy or urllib.request.proxy_bypass(parts.hostname or ''):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        return urllib.parse.urlsplit(proxy)
+
+    @staticmethod
+    def _host(parts, default_port):
+        """Return the host:port of a split URL, without its userinfo."""
+        hostname = parts.hostname or ''
+        if ':' in hostname:
+            hostname = '[%s]' % hostname
+        return '%s:%d' % (hostname, parts.port or default_port)
+
+    def _checkout(self, key):
+        """Return an (HTTPConnection, reused) tuple for a connection key.
+
+        The key is a (scheme, host:port, proxy URL or None) tuple.
+        """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, proxy = key
+        target = host
+        if proxy:
+            proxy = urllib.parse.urlsplit(proxy)
+            target = self._host(proxy, 80)
+        if scheme == 'https' and proxy:
+            conn = http.client.HTTPSConnection(
+                target, timeout=self.timeout,
+                context=ssl.create_default_context())
+            headers = {}
+            if proxy.username:
+                headers['Proxy-Authorization'] = self._basic_auth(proxy)
+            conn.set_tunnel(host, headers=headers)
+        elif scheme == 'https':
+            conn = http.client.HTTPSConnection(
+                target, timeout=self.timeout,
+                context=ssl.create_default_context())
+        else:
+            conn = http.client.HTTPConnection(target, timeout=self.timeout)
+        return conn, False
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _send(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise DownloadError('Unsupported URL %s' % url)
+        host = self._host(parts, 443 if parts.scheme == 'https' else 80)
+        proxy = self._proxy(parts)
+        key = (parts.scheme, host, proxy and proxy.geturl())
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+        headers = dict(headers)
+        if parts.username is not None:
+            headers['Authorization'] = self._basic_auth(parts)
+        if proxy and parts.scheme == 'http':
+            # a plain HTTP proxy is sent the absolute URL
+            path = urllib.parse.urlunsplit(('http', host, parts.path or '/',
+                                            parts.query, ''))
+            if proxy.username:
+                headers['Proxy-Authorization'] = self._basic_auth(proxy)
+        while True:
+            conn, reused = self._checkout(key)
             try:
-                os.makedirs(os.path.dirname(dest))
-            except OSError as e:
-                if e.errno == errno.EEXIST:
-                    LOG.debug(str(e))
-                else:
-                    LOG.exception(e)
+                conn.request('GET', path, headers=headers)
+                return key, conn, conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # the server may have dropped an idle connection
+                if not reused:
+                    raise
+
+    def _open(self, url, headers):
+        """Send a GET request, following redirects."""
+        for i in range(self.max_redirects + 1):
+            key, conn, resp = self._send(url, headers)
+            location = resp.getheader('Location')
+            if resp.status not in (301, 302, 303, 307, 308) or not location:
+                return key, conn, resp
+            resp.read()
+            self._checkin(key, conn)
+            url = urllib.parse.urljoin(url, location)
+        raise DownloadError('Too many redirects for %s' % url)
+
+    def _release(self, key, conn, resp):
+        if resp.isclosed():
+            self._checkin(key, conn)
+        else:
+            conn.close()
+
+    def _open_mirror(self, url, headers):
+        """Send a GET request to a mirror, returning None if it fails."""
+        try:
+            key, conn, resp = self._open(url, headers)
+        except (DownloadError, http.client.HTTPException, OSError) as e:
+            LOG.warning('Mirror %s failed: %s' % (url, e))
+            self.mirrors.failed(url)
+            return None
+        if resp.status == 404 or resp.status >= 500:
+            LOG.warning('Mirror %s returned HTTP status %d' %
+                        (url, resp.status))
+            resp.read()
+            self._release(key, conn, resp)
+            if resp.status >= 500:
+                self.mirrors.failed(url)
+            return None
+        self.mirrors.succeeded(url)
+        return key, conn, resp
 
-            if 'content' in meta:
-                if isinstance(meta['content'], str):
-                    f = open(dest, 'w+')
-                    f.write(meta['content'])
-                    f.close()
+    @contextlib.contextmanager
+    def get(self, url, headers=None):
+        """Send a GET request and yield the response.
+
+        Redirects are followed. The mirrors of url are tried first, in
+        order, and the next one (or the origin) is used when one cannot be
+        reached or answers with a server error or 404. The connection goes
+        back to the pool if the response body has been read in full.
+        """
+        headers = headers or {}
+        candidates = self.mirrors.candidates(url)
+        for candidate in candidates:
+            slot = self.scheduler.acquire(candidate)
+            try:
+                if candidate == url:
+                    opened = self._open(url, headers)
                 else:
-                    f = open(dest, 'w+')
-                    f.write(json.dumps(meta['content'],
-                                       indent=4).encode('UTF-8'))
-                    f.close()
-            elif 'source' in meta:
-                CommandRunner(['curl', '-o', dest, meta['source']]).run()
-            else:
-                LOG.error('%s %s' % (dest, str(meta)))
-                continue
+                    opened = self._open_mirror(candidate, headers)
+            except BaseException:
+                self.scheduler.release(slot)
+                raise
+            if opened:
+                break
+            self.scheduler.release(slot)
+        key, conn, resp = opened
+        try:
+            yield _ThrottledResponse(resp, self.scheduler)
+        finally:
+            self._release(key, conn, resp)
+            self.scheduler.release(slot)
 
-            uid = -1
-            gid = -1
-            if 'owner' in meta:
-                try:
-                    user_info = pwd.getpwnam(meta['owner'])
-                    uid = user_info[2]
-                except KeyError:
-                    pass
 
-            if 'group' in meta:
-                try:
-                    group_info = grp.getgrnam(meta['group'])
-                    gid = group_info[2]
-                except KeyError:
-                    pass
+class Download(object):
+    """A resumable download of an HTTP(S) URL to a file.
 
-            os.chown(dest, uid, gid)
-            if 'mode' in meta:
-                os.chmod(dest, int(meta['mode'], 8))
+    The content is hashed while it is written, so checking it against the
+    expected checksums takes no second pass over the file. When a transfer
+    is interrupted, only the rest of the content is requested on the next
+    attempt, with a Range request made conditional (If-Range) on the content
+    not having changed meanwhile. Servers not supporting ranges send the
+    whole content again.
 
+    If state_path is given, the validator (ETag or Last-Modified) of the
+    content at path is kept there, so that a later Download of the same URL
+    to the same path, e.g. after a reboot, resumes it too.
+    """
 
-class SourcesHandler(object):
-    '''tar, tar+gzip,tar+bz2 and zip.'''
-    _sources = {}
+    chunk_size = 65536
 
-    def __init__(self, sources):
-        self._sources = sources
+    def __init__(self, client, url, path, checksums=None, state_path=None,
+                 attempts=3):
+        self.client = client
+        self.url = url
+        self.path = path
+        self.checksums = checksums or {}
+        self.state_path = state_path
+        self.attempts = attempts
+        self.size = 0
+        self.digests = {}
+        self.etag = None
+        self.last_modified = None
+        self.validator = None
+        if state_path:
+            try:
+                with open(state_path) as f:
+                    self.validator = f.read().strip() or None
+            except IOError:
+                pass
 
-    def _url_to_tmp_filename(self, url):
-        tempdir = tempfile.mkdtemp()
-        atexit.register(lambda: shutil.rmtree(tempdir, True))
-        name = os.path.basename(url)
-        return os.path.join(tempdir, name)
+    def _save_state(self):
+        if not self.state_path:
+            return
+        if self.validator and os.path.exists(self.path):
+            with open(self.state_path, 'w') as f:
+                f.write(self.validator)
+        elif os.path.exists(self.state_path):
+            os.unlink(self.state_path)
+
+    def _discard(self):
+        """Forget the content at path, it cannot be resumed."""
+        self.validator = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._save_state()
 
-    def _splitext(self, path):
-        (r, ext) = os.path.splitext(path)
-        return (r, ext.lower())
+    @staticmethod
+    def _range_start(resp):
+        match = re.match(r'bytes (\d+)-', resp.getheader('Content-Range', ''))
+        return int(match.group(1)) if match else None
 
-    def _github_ball_type(self, url):
-        ext = ""
-        if url.endswith('/'):
+    def _hash_prefix(self, hashes):
+        with open(self.path, 'rb') as f:
+            for chunk in iter(functools.partial(f.read, self.chunk_size),
+                              b''):
+                for h in hashes.values():
+                    h.update(chunk)
+
+    def _attempt(self, headers):
+        """Request the content, or the rest of it, and write it to path.
+
+        Returns:
+            the number of bytes already at path the content was appended
+            to, or None if the server answered 304 Not Modified
+        """
+        offset = 0
+        headers = dict(headers)
+        if self.validator and os.path.isfile(self.path):
+            offset = os.path.getsize(self.path)
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = self.validator
+        with self.client.get(self.url, headers) as resp:
+            if resp.status == 304:
+                resp.read()
+                return None
+            if resp.status == 416 and offset:
+                # what is at path is no prefix of the content
+                resp.read()
+                self._discard()
+                raise http.client.HTTPException('range not satisfiable')
+            if resp.status == 206 and offset:
+                if self._range_start(resp) != offset:
+                    self._discard()
+                    raise http.client.HTTPException('unexpected range %s' %
+                                                    resp.getheader(
+                                                        'Content-Range'))
+                mode = 'ab'
+            elif resp.status == 200:
+                mode, offset = 'wb', 0
+            else:
+                raise DownloadError('%s returned HTTP status %d' %
+                                    (self.url, resp.status))
+            self.etag = resp.getheader('ETag')
+            self.last_modified = resp.getheader('Last-Modified')
+            # If-Range needs a strong validator
+            if self.etag and not self.etag.startswith('W/'):
+                self.validator = self.etag
+            else:
+                self.validator = self.last_modified
+
+            hashes = dict((name, hashlib.new(name))
+                          for name in set(self.checksums) | set(['sha256']))
+            if offset:
+                LOG.info('Resuming download of %s at byte %d' %
+                         (self.url, offset))
+                self._hash_prefix(hashes)
+            expected = resp.length
+            received = 0
+            with open(self.path, mode) as f:
+                self._save_state()
+                for chunk in iter(functools.partial(resp.read,
+                                                    self.chunk_size), b''):
+                    f.write(chunk)
+                    for h in hashes.values():
+                        h.update(chunk)
+                    received += len(chunk)
+            if expected is not None and received < expected:
+                raise http.client.IncompleteRead(b'', expected - received)
+        self.size = offset + received
+        self.digests = dict((name, h.hexdigest())
+                            for name, h in hashes.items())
+        return offset
+
+    def run(self, headers=None):
+        """Download the content, resuming interrupted transfers.
+
+        Arguments:
+            headers -- extra request headers, e.g. to make it conditional
+
+        Returns:
+            False if the server answered 304 Not Modified, True otherwise
+
+        Raises:
+            DownloadError -- the download failed, or the content does not
+                             match the expected checksums. What was
+                             received so far stays at path, unless it is
+                             known to be wrong.
+        """
+        error = None
+        for attempt in range(self.attempts):
+            try:
+                offset = self._attempt(headers or {})
+            except (http.client.HTTPException, OSError) as e:
+                LOG.warning('Download of %s interrupted: %s' % (self.url, e))
+                error = e
+                continue
+            if offset is None:
+                return False
+            try:
+                verify_checksums(self.url, self.digests, self.checksums)
+            except DownloadError as e:
+                self._discard()
+                if offset:
+                    # the beginning may be from an older version
+                    error = e
+                    continue
+                raise
+            self.validator = None
+            self._save_state()
+            return True
+        raise DownloadError('Failed to download %s: %s' % (self.url, error))
+
+
+def download(url, path, client, checksums=None):
+    """Download url to path.
+
+    HTTP(S) URLs are fetched with client, resuming interrupted transfers,
+    anything else with curl.
+
+    Returns:
+        a (size, sha256 hex digest) tuple for the content
+
+    Raises:
+        DownloadError -- the download failed, or the content does not match
+                         the expected checksums
+    """
+    checksums = checksums or {}
+    if urllib.parse.urlsplit(url).scheme in ('http', 'https'):
+        job = Download(client, url, path, checksums)
+        job.run()
+        return job.size, job.digests['sha256']
+    limit = []
+    if client.scheduler.rate:
+        limit = ['--limit-rate', str(client.scheduler.rate)]
+    for candidate in client.mirrors.candidates(url):
+        with client.scheduler.slot(candidate):
+            command = CommandRunner(['curl', '-s', '-f', '-L'] + limit +
+                                    ['-o', path, candidate]).run()
+        if command.status == 0:
+            client.mirrors.succeeded(candidate)
+            break
+        client.mirrors.failed(candidate)
+    else:
+        raise DownloadError('Failed to download %s: %s' %
+                            (url, command.stderr))
+    digests = file_digests(path, set(checksums) | set(['sha256']))
+    verify_checksums(url, digests, checksums)
+    return os.path.getsize(path), digests['sha256']
+
+
+class DownloadCache(object):
+    """Local store of the remote artifacts referenced by the metadata.
+
+    Artifacts are stored by the sha256 of their content under
+    cache_dir/objects, and an index entry per URL (under cache_dir/index)
+    records which object holds it along with the ETag and Last-Modified
+    validators the server sent. Fetching a URL again sends a conditional
+    GET, so an unchanged artifact costs a 304 response rather than a new
+    download. Interrupted downloads are kept under cache_dir/partial and
+    resumed by the next fetch. Objects are evicted, least recently used
+    first, once they take more than max_size bytes, except for those this
+    cache fetched or handed out, which the current run may still use.
+
+    Cached artifacts are only handed out when they match the checksums
+    expected by the caller, if any.
+
+    Artifacts can be downloaded ahead of time (and concurrently) and then
+    consumed by the FilesHandler and SourcesHandler.
+    """
+
+    def __init__(self, cache_dir='/var/cache/heat-cfntools/downloads',
+                 workers=4, client=None, max_size=1 << 30):
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.client = client or HttpClient()
+        self.max_size = max_size
+        self._objects_dir = os.path.join(cache_dir, 'objects')
+        self._index_dir = os.path.join(cache_dir, 'index')
+        self._partial_dir = os.path.join(cache_dir, 'partial')
+        self._evict_lock = threading.Lock()
+        # digests of the objects in use by this run, never evicted
+        self._pinned = set()
+
+    def _index_path(self, url):
+        name = hashlib.sha256(url.encode('UTF-8')).hexdigest()
+        return os.path.join(self._index_dir, name + '.json')
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects_dir, digest)
+
+    def _partial_path(self, url):
+        name = hashlib.sha256(url.encode('UTF-8')).hexdigest()
+        return os.path.join(self._partial_dir, name)
+
+    def entry(self, url, checksums=None):
+        """Return the index entry of a cached URL, or None.
+
+        The entry is a dict with the "url", the "digest" (sha256) and "size"
+        of its content, the "etag" and "last_modified" validators and the
+        "path" of the object holding the content. None is also returned if
+        the content does not match the given checksums.
+        """
+        try:
+            with open(self._index_path(url)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        entry['path'] = self._object_path(entry['digest'])
+        if not os.path.isfile(entry['path']):
+            return None
+        if 'md5' in (checksums or {}) and 'md5' not in entry:
+            entry['md5'] = file_digests(entry['path'], ['md5'])['md5']
+            self._save_entry(dict((k, v) for k, v in entry.items()
+                                  if k != 'path'))
+        digests = {'sha256': entry['digest'], 'md5': entry.get('md5')}
+        try:
+            verify_checksums(url, digests, checksums or {})
+        except DownloadError as e:
+            LOG.warning('Not using the cached copy: %s' % e)
+            return None
+        return entry
+
+    def get(self, url, checksums=None):
+        """Return the path of the cached artifact for url, or None."""
+        entry = self.lookup(url, checksums)
+        return entry and entry['path']
+
+    def lookup(self, url, checksums=None):
+        """Like entry(), also keeping the object for the rest of the run."""
+        entry = self.entry(url, checksums)
+        if entry is not None:
+            self._pin(entry)
+        return entry
+
+    def _pin(self, entry):
+        """Keep the object of an entry out of eviction, for this run."""
+        with self._evict_lock:
+            self._pinned.add(entry['digest'])
+            self._touch(entry['path'])
+
+    @staticmethod
+    def _touch(path):
+        # the mtime of an object records when it was last used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def _make_dirs(self):
+        for path in (self._objects_dir, self._index_dir, self._partial_dir):
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path, mode=0o700)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        LOG.warning('could not create download cache dir %s '
+                                    '[%s]' % (path, e))
+                        return False
+        return True
+
+    def _save_entry(self, entry):
+        fd, tmp = tempfile.mkstemp(dir=self._index_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp, self._index_path(entry['url']))
+
+    def _forget(self, url):
+        try:
+            os.unlink(self._index_path(url))
+        except OSError:
+            pass
+
+    def _download(self, url, cached, checksums=None):
+        """Download url unless the cached entry is still valid.
+
+        Returns the index entry of url.
+        """
+        partial = self._partial_path(url)
+        if urllib.parse.urlsplit(url).scheme not in ('http', 'https'):
+            size, digest = download(url, partial, self.client, checksums)
+            entry = {'url': url, 'digest': digest, 'size': size}
+        else:
+            job = Download(self.client, url, partial, checksums,
+                           state_path=partial + '.validator')
+            headers = {}
+            # a partial download is of a newer version than the cached one
+            if cached and not job.validator:
+                if cached.get('etag'):
+                    headers['If-None-Match'] = cached['etag']
+                if cached.get('last_modified'):
+                    headers['If-Modified-Since'] = cached['last_modified']
+            if not job.run(headers):
+                LOG.debug('%s is unchanged' % url)
+                self._touch(cached['path'])
+                return cached
+            entry = {'url': url, 'digest': job.digests['sha256'],
+                     'size': job.size, 'etag': job.etag,
+                     'last_modified': job.last_modified}
+            if 'md5' in job.digests:
+                entry['md5'] = job.digests['md5']
+        os.rename(partial, self._object_path(entry['digest']))
+        self._save_entry(entry)
+        entry['path'] = self._object_path(entry['digest'])
+        return entry
+
+    def fetch(self, url, checksums=None):
+        """Download url into the cache, or revalidate the cached copy.
+
+        Arguments:
+            checksums -- the checksums the content must match, as returned
+                         by expected_checksums()
+
+        Returns:
+            the path of the cached artifact, or None if the download failed
+        """
+        if not self._make_dirs():
+            return None
+        try:
+            entry = self._download(url, self.entry(url, checksums), checksums)
+        except (DownloadError, http.client.HTTPException, OSError) as e:
+            LOG.warning('Failed to download %s: %s' % (url, e))
+            # never let handlers consume a stale copy
+            self._forget(url)
+            return None
+        LOG.debug('Cached %s as %s' % (url, entry['path']))
+        self._pin(entry)
+        self.evict()
+        return entry['path']
+
+    def evict(self):
+        """Remove the least recently used objects above max_size.
+
+        The objects pinned by this run are kept, even above max_size, and
+        partial downloads are left to be resumed.
+        """
+        with self._evict_lock:
+            try:
+                objects = [(e.stat().st_mtime, e.stat().st_size, e.path)
+                           for e in os.scandir(self._objects_dir)
+                           if e.is_file() and not e.name.startswith('tmp')]
+            except OSError:
+                return
+            total = sum(size for mtime, size, path in objects)
+            evicted = set()
+            for mtime, size, path in sorted(objects):
+                if total <= self.max_size:
+                    break
+                if os.path.basename(path) in self._pinned:
+                    continue
+                LOG.debug('Evicting %s from the download cache' % path)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                evicted.add(os.path.basename(path))
+                total -= size
+            if not evicted:
+                return
+            for e in os.scandir(self._index_dir):
+                try:
+                    with open(e.path) as f:
+                        if json.load(f)['digest'] in evicted:
+                            os.unlink(e.path)
+                except (IOError, OSError, ValueError, KeyError):
+                    continue
+
+    def prefetch_async(self, urls, pool, checksums=None):
+        """Start downloading a list of URLs on an executor.
+
+        Arguments:
+            checksums -- an optional dict mapping URLs to the checksums their
+                         content must match
+
+        Returns:
+            a dict mapping each URL to the future of its cached path
+        """
+        urls = list(dict.fromkeys(urls))
+        checksums = checksums or {}
+        if urls:
+            LOG.info('Prefetching %d artifacts' % len(urls))
+        return dict((url, pool.submit(self.fetch, url, checksums.get(url)))
+                    for url in urls)
+
+    def prefetch(self, urls, checksums=None):
+        """Download a list of URLs concurrently.
+
+        Returns:
+            a dict mapping each URL to its cached path (None on failure)
+        """
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            fetches = self.prefetch_async(urls, pool, checksums)
+        return dict((url, f.result()) for url, f in fetches.items())
+
+
+class ContentError(Exception):
+    pass
+
+
+class FilesHandler(object):
+    # size of the pieces inline content is decoded and written in
+    _chunk_size = 65536
+    _encodings = ('plain', 'base64', 'gzip+base64')
+
+    def __init__(self, files, cache=None, workers=4, resolver=None):
+        self._files = files
+        self._cache = cache
+        self._workers = workers
+        self._client = cache.client if cache else HttpClient()
+        self._resolver = resolver or IdentityResolver()
+        # the files created, or whose content, owner or mode changed
+        self.changed = set()
+        # whether a file could not be updated
+        self.failed = False
+
+    @staticmethod
+    def _make_parent_dir(dest):
+        try:
+            os.makedirs(os.path.dirname(dest))
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                LOG.debug(str(e))
+            else:
+                LOG.exception(e)
+
+    def _not_updating(self, dest, error):
+        LOG.error('%s: not updating %s' % (error, dest))
+        self.failed = True
+
+    def _download_temp(self, dest, meta):
+        """Download the source of meta to a temporary file next to dest.
+
+        Returns:
+            a (path, size, sha256 digest) tuple for the temporary file, or
+            None if the download failed
+        """
+        self._make_parent_dir(dest)
+        tmp = self._temp_file(dest)
+        try:
+            size, digest = download(meta['source'], tmp, self._client,
+                                    expected_checksums(meta))
+        except DownloadError as e:
+            self._not_updating(dest, e)
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            return None
+        return tmp, size, digest
+
+    def _download_sources(self):
+        """Download the 'source' files missing from the cache concurrently.
+
+        Returns:
+            a dict mapping destinations to what _download_temp() returned
+        """
+        pending = [(dest, meta)
+                   for dest, meta in self._files.items()
+                   if 'content' not in meta and 'source' in meta and
+                   not (self._cache and
+                        self._cache.get(meta['source'],
+                                        expected_checksums(meta)))]
+        if not pending:
+            return {}
+        with futures.ThreadPoolExecutor(max_workers=self._workers) as pool:
+            tmps = pool.map(lambda entry: self._download_temp(*entry),
+                            pending)
+            return dict(zip([dest for dest, meta in pending], tmps))
+
+    def apply_files(self):
+        """Create or update the files listed.
+
+        Remote 'source' files not already in the download cache are
+        downloaded first, concurrently. A file whose content already matches
+        the metadata is not written again. Otherwise, the new content is
+        written to a temporary file in the same directory, which gets its
+        owner and mode and is then renamed over the destination, so readers
+        never see a partial file.
+
+        Entries with mode 120000 are symbolic links to their 'content'.
+        Entries with a 'hardlink' attribute are hard links to another file
+        of the list, and are created once all other files are in place.
+        Links are also created under a temporary name and renamed, and are
+        left alone when they already point at the right target.
+        """
+        if not self._files:
+            return
+        downloads = self._download_sources()
+        try:
+            hardlinks = []
+            for dest, meta in self._files.items():
+                kind = self._link_kind(meta)
+                if kind == 'hardlink':
+                    hardlinks.append((dest, meta))
+                elif kind == 'symlink':
+                    self._apply_symlink(dest, meta)
+                else:
+                    self._apply_file(dest, meta, downloads)
+            for dest, meta in hardlinks:
+                self._apply_hardlink(dest, meta)
+        finally:
+            for downloaded in downloads.values():
+                if downloaded and os.path.exists(downloaded[0]):
+                    os.unlink(downloaded[0])
+
+    @staticmethod
+    def _link_kind(meta):
+        """Return 'symlink' or 'hardlink' for link entries, else None."""
+        if 'hardlink' in meta:
+            return 'hardlink'
+        if 'mode' in meta and stat.S_ISLNK(int(meta['mode'], 8)):
+            return 'symlink'
+        return None
+
+    def _link_is_current(self, dest, meta):
+        """Return whether dest already is the link meta describes."""
+        try:
+            if self._link_kind(meta) == 'symlink':
+                return (os.path.islink(dest) and
+                        os.readlink(dest) == meta['content'])
+            return os.path.samefile(dest, meta['hardlink'])
+        except OSError:
+            return False
+
+    def _link_target_error(self, meta):
+        """Return why a link entry cannot be created, or None."""
+        if self._link_kind(meta) == 'symlink':
+            if not isinstance(meta.get('content'), str):
+                return 'symlink content must be the target path'
+            return None
+        target = meta['hardlink']
+        if target not in self._files or self._link_kind(self._files[target]):
+            return 'hardlink target %s is not a managed file' % target
+        return None
+
+    def _apply_symlink(self, dest, meta):
+        error = self._link_target_error(meta)
+        if error:
+            self._not_updating(dest, error)
+            return
+        if self._link_is_current(dest, meta):
+            LOG.debug("%s is unchanged" % dest)
+            return
+        self._make_parent_dir(dest)
+        tmp = self._link_temp(dest, lambda tmp: os.symlink(meta['content'],
+                                                           tmp))
+        if 'owner' in meta or 'group' in meta:
+            uid, gid, mode = self._owner_and_mode(None, meta)
+            os.lchown(tmp, uid, gid)
+        self._rename_link(tmp, dest)
+
+    def _apply_hardlink(self, dest, meta):
+        error = self._link_target_error(meta)
+        if error:
+            self._not_updating(dest, error)
+            return
+        if self._link_is_current(dest, meta):
+            LOG.debug("%s is unchanged" % dest)
+            return
+        self._make_parent_dir(dest)
+        try:
+            tmp = self._link_temp(dest, lambda tmp: os.link(meta['hardlink'],
+                                                            tmp))
+        except OSError as e:
+            self._not_updating(dest, e)
+            return
+        self._rename_link(tmp, dest)
+
+    @staticmethod
+    def _link_temp(dest, create):
+        """Create a link with create() under a free name next to dest."""
+        while True:
+            tmp = os.path.join(os.path.dirname(dest) or '.', '.%s.%s' % (
+                os.path.basename(dest), os.urandom(6).hex()))
+            try:
+                create(tmp)
+                return tmp
+            except FileExistsError:
+                continue
+
+    def _rename_link(self, tmp, dest):
+        try:
+            os.rename(tmp, dest)
+        except OSError as e:
+            self._not_updating(dest, e)
+            os.unlink(tmp)
+            return
+        self.changed.add(dest)
+
+    def _apply_file(self, dest, meta, downloads):
+        self._make_parent_dir(dest)
+
+        if 'content' in meta:
+            # the content is decoded twice rather than held in memory: once
+            # to compare it with dest, then again to write it if it differs
+            try:
+                size, digest = self._content_digest(meta)
+            except ContentError as e:
+                self._not_updating(dest, e)
+                return
+            if self._has_content(dest, size, digest):
+                LOG.debug("%s is unchanged" % dest)
+                self._update_owner_and_mode(dest, meta)
+                return
+            tmp = self._temp_file(dest)
+            try:
+                with open(tmp, 'wb') as f:
+                    for chunk in self._content_chunks(meta):
+                        f.write(chunk)
+            except Exception:
+                os.unlink(tmp)
+                raise
+        elif 'source' in meta:
+            downloaded = downloads.get(dest)
+            entry = None
+            if downloaded is None:
+                if dest in downloads:
+                    # the download failed
+                    return
+                entry = self._cache.lookup(meta['source'],
+                                           expected_checksums(meta))
+                if entry is None:
+                    # evicted from the cache since
+                    downloaded = self._download_temp(dest, meta)
+                    if downloaded is None:
+                        return
+            if entry:
+                source, tmp = entry['path'], None
+                size, digest = entry['size'], entry['digest']
+            else:
+                tmp, size, digest = downloaded
+            if self._has_content(dest, size, digest):
+                LOG.debug("%s is unchanged" % dest)
+                self._update_owner_and_mode(dest, meta)
+                return
+            if tmp is None:
+                tmp = self._temp_file(dest)
+                shutil.copyfile(source, tmp)
+        else:
+            self._not_updating(dest, 'no content or source in %s' % meta)
+            return
+        self._replace(tmp, dest, meta)
+
+    def _content_chunks(self, meta):
+        """Yield the decoded bytes of an inline 'content' entry in chunks.
+
+        The 'encoding' attribute may be 'plain' (the default), 'base64' or
+        'gzip+base64'. Encoded content is decoded a chunk at a time, so the
+        decoded file is never held in memory in full.
+        """
+        content = meta['content']
+        encoding = meta.get('encoding', 'plain')
+        if encoding not in self._encodings:
+            raise ContentError('unknown encoding "%s"' % encoding)
+        if not isinstance(content, str):
+            if encoding != 'plain':
+                raise ContentError('%s content must be a string' % encoding)
+            content = json.dumps(content, indent=4)
+        if encoding == 'plain':
+            yield content.encode('UTF-8')
+            return
+
+        chunks = self._base64_chunks(content)
+        if encoding == 'gzip+base64':
+            chunks = self._gunzip_chunks(chunks)
+        for chunk in chunks:
+            yield chunk
+
+    def _base64_chunks(self, content):
+        pending = ''
+        for start in range(0, len(content), self._chunk_size):
+            pending += ''.join(content[start:start + self._chunk_size].split())
+            # only whole 4 character groups can be decoded on their own
+            usable = len(pending) - len(pending) % 4
+            if usable:
+                yield self._b64decode(pending[:usable])
+                pending = pending[usable:]
+        if pending:
+            yield self._b64decode(pending)
+
+    @staticmethod
+    def _b64decode(data):
+        try:
+            return base64.b64decode(data, validate=True)
+        except (binascii.Error, ValueError) as e:
+            raise ContentError('invalid base64 content: %s' % e)
+
+    def _gunzip_chunks(self, chunks):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            for data in chunks:
+                # bound the output of each call, so a small compressed chunk
+                # cannot expand into a huge buffer
+                while data:
+                    out = decompressor.decompress(data, self._chunk_size)
+                    if out:
+                        yield out
+                    data = decompressor.unconsumed_tail
+            out = decompressor.flush()
+        except zlib.error as e:
+            raise ContentError('invalid gzip content: %s' % e)
+        if out:
+            yield out
+        if not decompressor.eof:
+            raise ContentError('truncated gzip content')
+
+    def _content_digest(self, meta):
+        """Return the size and sha256 of the decoded content of meta."""
+        sha = hashlib.sha256()
+        size = 0
+        for chunk in self._content_chunks(meta):
+            sha.update(chunk)
+            size += len(chunk)
+        return size, sha.hexdigest()
+
+    @staticmethod
+    def _has_content(dest, size, digest):
+        """Return whether dest holds size bytes with the given sha256."""
+        try:
+            if os.path.getsize(dest) != size:
+                return False
+        except OSError:
+            return False
+        return file_digest(dest) == digest
+
+    @staticmethod
+    def _temp_file(dest):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest) or '.',
+                                   prefix='.%s.' % os.path.basename(dest))
+        os.close(fd)
+        return tmp
+
+    def _owner_and_mode(self, st, meta):
+        """Return the (uid, gid, mode) a file should end up with.
+
+        Whatever the metadata does not specify is kept from st, the stat
+        result of the existing file (None if there is none), as rewriting
+        the file in place used to do.
+        """
+        if st is not None:
+            uid, gid, mode = st.st_uid, st.st_gid, stat.S_IMODE(st.st_mode)
+        else:
+            uid, gid, mode = -1, -1, 0o666 & ~UMASK
+
+        if 'owner' in meta:
+            try:
+                uid = self._resolver.getpwnam(meta['owner']).pw_uid
+            except KeyError:
+                pass
+
+        if 'group' in meta:
+            try:
+                gid = self._resolver.getgrnam(meta['group']).gr_gid
+            except KeyError:
+                pass
+
+        if 'mode' in meta:
+            mode = int(meta['mode'], 8)
+        return uid, gid, mode
+
+    def _replace(self, tmp, dest, meta):
+        """Atomically move a fully written temporary file to dest."""
+        try:
+            try:
+                st = os.stat(dest)
+            except OSError:
+                st = None
+            uid, gid, mode = self._owner_and_mode(st, meta)
+            fd = os.open(tmp, os.O_RDONLY)
+            try:
+                os.fchown(fd, uid, gid)
+                os.fchmod(fd, mode)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.rename(tmp, dest)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        self.changed.add(dest)
+
+    def _update_owner_and_mode(self, dest, meta):
+        """Fix the owner and mode of an unchanged file, if they differ."""
+        fd = os.open(dest, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+            uid, gid, mode = self._owner_and_mode(st, meta)
+            if (uid, gid) != (st.st_uid, st.st_gid):
+                os.fchown(fd, uid, gid)
+                self.changed.add(dest)
+            if mode != stat.S_IMODE(st.st_mode):
+                os.fchmod(fd, mode)
+                self.changed.add(dest)
+        finally:
+            os.close(fd)
+
+    def plan_files(self):
+        """Return the actions apply_files() would take."""
+        plan = []
+        if not self._files:
+            return plan
+        for dest, meta in self._files.items():
+            if self._link_kind(meta):
+                error = self._link_target_error(meta)
+                if error:
+                    plan.append(plan_entry('files', dest, 'skip',
+                                           reason=error))
+                elif self._link_is_current(dest, meta):
+                    plan.append(plan_entry('files', dest, 'unchanged'))
+                else:
+                    plan.append(plan_entry(
+                        'files', dest, 'link', kind=self._link_kind(meta),
+                        target=meta.get('hardlink', meta.get('content'))))
+            elif 'content' in meta:
+                try:
+                    size, digest = self._content_digest(meta)
+                except ContentError as e:
+                    plan.append(plan_entry('files', dest, 'skip',
+                                           reason=str(e)))
+                    continue
+                if self._has_content(dest, size, digest):
+                    plan.append(plan_entry('files', dest, 'unchanged'))
+                else:
+                    plan.append(plan_entry('files', dest, 'write'))
+            elif 'source' in meta:
+                plan.append(plan_entry('files', dest, 'write',
+                                       source=meta['source']))
+            else:
+                plan.append(plan_entry('files', dest, 'skip',
+                                       reason='no content or source'))
+        return plan
+
+
+class SourcesHandlerError(Exception):
+    pass
+
+
+class SourcesHandler(object):
+    '''tar, tar+gzip, tar+bz2, tar+xz, zip, gzip and bz2.
+
+    Each source is either a URL, or a dict with a "url" and optionally the
+    "sha256" or "md5" checksum the archive must match.
+
+    If manifest_dir is set, a manifest of what was unpacked into each
+    destination is kept there: the URL, the digest and validators of the
+    archive, and the size and mtime of each file. A source whose archive is
+    unchanged and whose files are all still in place is not unpacked again.
+    Otherwise only the archive members which differ in size or mtime from
+    the files in place are written.
+    '''
+    _sources = {}
+
+    # tarfile stream modes by source type
+    _tar_modes = {'.tgz': 'r|gz', '.tbz2': 'r|bz2', '.txz': 'r|xz',
+                  '.tar': 'r|'}
+    # openers of single compressed files by source type
+    _openers = {'.gz': gzip.open, '.bz2': bz2.open}
+
+    def __init__(self, sources, cache=None, client=None, workers=4,
+                 manifest_dir=None):
+        self._sources = sources
+        self._cache = cache
+        self._client = client or (cache.client if cache else HttpClient())
+        self._workers = workers
+        self._manifest_dir = manifest_dir
+        # the destinations sources were unpacked into
+        self.changed = set()
+        # failures raise SourcesHandlerError instead
+        self.failed = False
+
+    @staticmethod
+    def source_url(source):
+        """Return the URL of a source, given as a URL or a dict."""
+        if isinstance(source, dict):
+            return source.get('url')
+        return source
+
+    def _splitext(self, path):
+        (r, ext) = os.path.splitext(path)
+        return (r, ext.lower())
+
+    def _github_ball_type(self, url):
+        ext = ""
+        if url.endswith('/'):
             url = url[0:-1]
         sp = url.split('/')
         if len(sp) > 2:
@@ -804,97 +2381,674 @@ class SourcesHandler(object):
                     ext = '.tgz'
         return ext
 
-    def _source_type(self, url):
-        (r, ext) = self._splitext(url)
-        if ext == '.gz':
-            (r, ext2) = self._splitext(r)
-            if ext2 == '.tar':
-                ext = '.tgz'
-        elif ext == '.bz2':
-            (r, ext2) = self._splitext(r)
-            if ext2 == '.tar':
-                ext = '.tbz2'
-        elif ext == "":
-            ext = self._github_ball_type(url)
+    def _source_type(self, url):
+        if not url:
+            return ""
+        (r, ext) = self._splitext(url)
+        if ext == '.gz':
+            (r, ext2) = self._splitext(r)
+            if ext2 == '.tar':
+                ext = '.tgz'
+        elif ext == '.bz2':
+            (r, ext2) = self._splitext(r)
+            if ext2 == '.tar':
+                ext = '.tbz2'
+        elif ext == '.xz':
+            (r, ext2) = self._splitext(r)
+            if ext2 == '.tar':
+                ext = '.txz'
+            else:
+                ext = ''
+        elif ext == "":
+            ext = self._github_ball_type(url)
+
+        if ext not in ('.tgz', '.tbz2', '.txz', '.tar', '.zip', '.gz',
+                       '.bz2'):
+            return ""
+        return ext
+
+    def _manifest_path(self, dest):
+        name = hashlib.sha256(
+            os.path.abspath(dest).encode('UTF-8')).hexdigest()
+        return os.path.join(self._manifest_dir, name + '.json')
+
+    def _load_manifest(self, dest, url):
+        """Return the manifest of dest if it still describes its content.
+
+        That is, if url was last unpacked into dest and all the files it
+        recorded are still there, with the same size and mtime.
+        """
+        if not self._manifest_dir:
+            return None
+        try:
+            with open(self._manifest_path(dest)) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if manifest.get('url') != url:
+            return None
+        for name, (size, mtime) in manifest['members'].items():
+            if not self._member_unchanged(os.path.join(dest, name), size,
+                                          mtime):
+                return None
+        return manifest
+
+    def _save_manifest(self, dest, manifest):
+        if not self._manifest_dir:
+            return
+        try:
+            os.makedirs(self._manifest_dir, mode=0o700, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self._manifest_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f)
+            os.rename(tmp, self._manifest_path(dest))
+        except OSError as e:
+            LOG.warning('Could not save the manifest of %s: %s' % (dest, e))
+
+    @staticmethod
+    def _member_unchanged(path, size, mtime):
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+        return (stat.S_ISREG(st.st_mode) and st.st_size == size and
+                int(st.st_mtime) == int(mtime))
+
+    @contextlib.contextmanager
+    def _open_source(self, url, seekable=False, checksums=None,
+                     manifest=None):
+        """Yield a binary file object reading the content of url.
+
+        The cached copy is read if there is one. Otherwise HTTP(S) responses
+        are read as they arrive, unless a seekable file is needed or the
+        content must be checked against checksums before being used, in
+        which case (and for other URL schemes) url is downloaded to a
+        temporary file first.
+
+        The file object comes with a dict of the "digest" (when known),
+        "etag" and "last_modified" of the content. If manifest is given and
+        the content is the one it records, (None, None) is yielded instead.
+        """
+        entry = self._cache and self._cache.lookup(url, checksums)
+        if entry:
+            if manifest and manifest.get('digest') == entry['digest']:
+                yield None, None
+                return
+            try:
+                f = open(entry['path'], 'rb')
+            except (IOError, OSError):
+                # evicted from the cache since
+                LOG.debug('%s is no longer cached' % url)
+            else:
+                with f:
+                    yield f, {'digest': entry['digest'],
+                              'etag': entry.get('etag'),
+                              'last_modified': entry.get('last_modified')}
+                return
+        headers = {}
+        if manifest and manifest.get('etag'):
+            headers['If-None-Match'] = manifest['etag']
+        if manifest and manifest.get('last_modified'):
+            headers['If-Modified-Since'] = manifest['last_modified']
+        scheme = urllib.parse.urlsplit(url).scheme
+        if scheme in ('http', 'https') and not seekable and not checksums:
+            with self._client.get(url, headers) as resp:
+                if resp.status == 304:
+                    resp.read()
+                    yield None, None
+                    return
+                if resp.status != 200:
+                    raise DownloadError('%s returned HTTP status %d' %
+                                        (url, resp.status))
+                yield resp, {'digest': None,
+                             'etag': resp.getheader('ETag'),
+                             'last_modified': resp.getheader('Last-Modified')}
+            return
+        fd, tmp = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            if scheme in ('http', 'https'):
+                job = Download(self._client, url, tmp, checksums)
+                if not job.run(headers):
+                    yield None, None
+                    return
+                info = {'digest': job.digests['sha256'], 'etag': job.etag,
+                        'last_modified': job.last_modified}
+            else:
+                size, digest = download(url, tmp, self._client, checksums)
+                info = {'digest': digest, 'etag': None,
+                        'last_modified': None}
+            with open(tmp, 'rb') as f:
+                yield f, info
+        finally:
+            os.unlink(tmp)
+
+    @staticmethod
+    def _check_member(dest, member):
+        """Refuse tar members which would end up outside of dest.
+
+        As tar does, leading slashes are stripped from names, and symbolic
+        links may point anywhere, but hard links, which are made to existing
+        files, must be to files inside dest.
+        """
+        root = os.path.realpath(dest)
+
+        def inside(path):
+            # the last component is replaced, not followed
+            parent = os.path.realpath(
+                os.path.join(root, os.path.dirname(path)))
+            path = os.path.normpath(
+                os.path.join(parent, os.path.basename(path)))
+            return os.path.commonpath([root, path]) == root
+
+        member.name = member.name.lstrip('/')
+        if not inside(member.name):
+            raise SourcesHandlerError('%s is outside of %s' %
+                                      (member.name, dest))
+        if member.islnk() and (os.path.isabs(member.linkname) or
+                               not inside(member.linkname)):
+            raise SourcesHandlerError('%s links outside of %s' %
+                                      (member.name, dest))
+
+    def _extract_tar(self, dest, f, mode):
+        """Extract the members of a tarball which differ from dest.
+
+        Returns:
+            a dict mapping the names of the regular files of the tarball to
+            their (size, mtime)
+        """
+        members = {}
+        directories = []
+        with tarfile.open(fileobj=f, mode=mode) as tar:
+            for member in tar:
+                self._check_member(dest, member)
+                path = os.path.join(dest, member.name)
+                if not member.isdir() and (
+                        os.path.islink(path) or
+                        (member.islnk() or member.issym()) and
+                        os.path.lexists(path) and not os.path.isdir(path)):
+                    # as tar does, replace what is there rather than write
+                    # through a symbolic link, or have tarfile seek back in
+                    # the stream for the target of a hard link
+                    os.unlink(path)
+                if hasattr(tarfile, 'tar_filter'):
+                    # like tar itself, keeps ownership but refuses absolute
+                    # paths and anything ending up outside of dest
+                    member = tarfile.tar_filter(member, dest)
+                    options = {'filter': 'fully_trusted'}
+                else:
+                    options = {}
+                if member.isreg():
+                    members[member.name] = (member.size, member.mtime)
+                    if self._member_unchanged(os.path.join(dest, member.name),
+                                              member.size, member.mtime):
+                        continue
+                elif member.isdir():
+                    # as extractall() does, a directory gets its mode once
+                    # its content is written
+                    directories.append(member)
+                tar.extract(member, dest, set_attrs=not member.isdir(),
+                            **options)
+            for member in reversed(directories):
+                path = os.path.join(dest, member.name)
+                tar.chown(member, path, False)
+                tar.utime(member, path)
+                tar.chmod(member, path)
+        return members
+
+    def _extract_zip(self, dest, f):
+        """Extract the members of a zip file which differ from dest.
+
+        Returns:
+            a dict mapping the names of the files of the zip file to their
+            (size, mtime)
+        """
+        members = {}
+        with zipfile.ZipFile(f) as archive:
+            for info in archive.infolist():
+                mtime = int(time.mktime(info.date_time + (0, 0, -1)))
+                name = info.filename
+                # zipfile already drops absolute paths and ".." components,
+                # other names are only compared when they are used as is
+                plain = not (os.path.isabs(name) or
+                             '..' in name.split('/') or info.is_dir())
+                if plain:
+                    members[name] = (info.file_size, mtime)
+                    if self._member_unchanged(os.path.join(dest, name),
+                                              info.file_size, mtime):
+                        continue
+                path = archive.extract(info, dest)
+                if info.is_dir():
+                    continue
+                mode = (info.external_attr >> 16) & 0o777
+                if mode:
+                    os.chmod(path, mode)
+                os.utime(path, (mtime, mtime))
+        return members
+
+    @staticmethod
+    def _extract_file(dest, f, name, opener):
+        """Decompress a single file into dest.
+
+        Returns:
+            a dict mapping its name to its (size, mtime)
+        """
+        fd, tmp = tempfile.mkstemp(dir=dest, prefix='.%s.' % name)
+        try:
+            with os.fdopen(fd, 'wb') as out, opener(f) as src:
+                shutil.copyfileobj(src, out, 65536)
+            os.chmod(tmp, 0o666 & ~UMASK)
+            os.rename(tmp, os.path.join(dest, name))
+        except Exception:
+            os.unlink(tmp)
+            raise
+        st = os.stat(os.path.join(dest, name))
+        return {name: (st.st_size, int(st.st_mtime))}
+
+    def _apply_source(self, dest, source):
+        url = self.source_url(source)
+        stype = self._source_type(url)
+        if not stype:
+            LOG.warning('Not unpacking %s, unknown archive type' % source)
+            return
+        try:
+            os.makedirs(dest, exist_ok=True)
+            opened = self._open_source(url, stype == '.zip',
+                                       expected_checksums(source),
+                                       self._load_manifest(dest, url))
+            with opened as (f, info):
+                if f is None:
+                    LOG.debug('%s is unchanged in %s' % (url, dest))
+                    return
+                LOG.info('Unpacking %s into %s' % (url, dest))
+                if stype in self._tar_modes:
+                    members = self._extract_tar(dest, f,
+                                                self._tar_modes[stype])
+                elif stype == '.zip':
+                    members = self._extract_zip(dest, f)
+                else:
+                    name = self._splitext(os.path.basename(url))[0]
+                    members = self._extract_file(dest, f, name,
+                                                 self._openers[stype])
+        except SourcesHandlerError:
+            raise
+        except (DownloadError, tarfile.TarError, zipfile.BadZipFile,
+                http.client.HTTPException, EOFError, OSError,
+                zlib.error, lzma.LZMAError) as e:
+            raise SourcesHandlerError('Failed to unpack %s into %s: %s' %
+                                      (url, dest, e))
+        info['url'] = url
+        info['members'] = members
+        self._save_manifest(dest, info)
+        self.changed.add(dest)
+
+    def _source_groups(self):
+        """Group the sources whose destinations overlap.
+
+        Two destinations overlap when one is, or is inside, the other. The
+        groups, and the sources within each group, keep the order the
+        sources are declared in.
+        """
+        groups = []
+        for i, (dest, source) in enumerate(self._sources.items()):
+            path = os.path.abspath(dest)
+            overlapping = [group for group in groups
+                           if any(os.path.commonpath([path, other]) in
+                                  (path, other) for _, other, _, _ in group)]
+            # a source can join groups that did not overlap until now
+            merged = sorted(sum(overlapping, []) + [(i, path, dest, source)],
+                            key=lambda entry: entry[0])
+            groups = [group for group in groups
+                      if group not in overlapping] + [merged]
+        return [[(dest, source) for _, _, dest, source in group]
+                for group in groups]
+
+    def _apply_group(self, group):
+        for dest, source in group:
+            self._apply_source(dest, source)
+
+    def apply_sources(self):
+        """Unpack each source URL into its destination directory.
+
+        Archives are extracted in-process, streamed straight from the
+        download cache or the HTTP response where possible. Sources going
+        to unrelated directories are downloaded and unpacked concurrently,
+        by up to workers threads; sources whose destinations overlap are
+        unpacked one after the other, in the order they are declared in.
+        Any failure raises SourcesHandlerError once the other sources are
+        done.
+        """
+        if not self._sources:
+            return
+        groups = self._source_groups()
+        if self._workers <= 1 or len(groups) == 1:
+            for group in groups:
+                self._apply_group(group)
+            return
+        with futures.ThreadPoolExecutor(max_workers=self._workers) as pool:
+            results = [pool.submit(self._apply_group, group)
+                       for group in groups]
+        for result in results:
+            result.result()
+
+    def plan_sources(self):
+        """Return the actions apply_sources() would take.
+
+        A source still unpacked as its manifest records is unchanged if the
+        cached copy of its URL is the content that was unpacked. Without a
+        cached copy, apply_sources() asks the server whether it changed, so
+        it is planned as a conditional extract.
+        """
+        plan = []
+        if not self._sources:
+            return plan
+        for dest, source in self._sources.items():
+            url = self.source_url(source)
+            if self._source_type(url):
+                manifest = self._load_manifest(dest, url)
+                entry = manifest and self._cache and self._cache.entry(
+                    url, expected_checksums(source))
+                if entry and entry['digest'] == manifest.get('digest'):
+                    plan.append(plan_entry('sources', dest, 'unchanged',
+                                           url=url))
+                elif manifest and not entry:
+                    plan.append(plan_entry('sources', dest, 'extract',
+                                           url=url, conditional=True))
+                else:
+                    plan.append(plan_entry('sources', dest, 'extract',
+                                           url=url))
+            else:
+                plan.append(plan_entry('sources', dest, 'skip', url=url,
+                                       reason='unknown archive type'))
+        return plan
+
+
+class RestartPolicy(object):
+    """Limits how often monitored services are restarted.
+
+    A stopped service is restarted at most max_restarts times within window
+    seconds. The first restart is immediate, the next one waits backoff
+    seconds, and each one after that twice as long as the previous, up to
+    window seconds. A service still stopped once its restarts are used up is
+    given up until it is seen running again.
+
+    The state of each service is kept in state_path, so that it carries over
+    from one cfn-hup run to the next and can be read by monitoring tools.
+    """
+
+    RESTART = 'restart'
+    WAIT = 'wait'
+    GIVE_UP = 'give-up'
+    FAILED = 'failed'
+
+    def __init__(self, max_restarts=5, window=300, backoff=10,
+                 state_path='/var/lib/heat-cfntools/cfn-hup-restarts.json'):
+        self.max_restarts = max_restarts
+        self.window = window
+        self.backoff = backoff
+        self.state_path = state_path
+        self._state = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, section='main'):
+        """Build a policy from the restart options of a ConfigParser.
+
+        The options are restart-limit (default 5), restart-window (default
+        300 seconds) and restart-backoff (default 10 seconds).
+        """
+        limits = {'max_restarts': 5, 'window': 300, 'backoff': 10}
+        options = (('restart-limit', 'max_restarts'),
+                   ('restart-window', 'window'),
+                   ('restart-backoff', 'backoff'))
+        try:
+            for option, key in options:
+                if config.has_option(section, option):
+                    limits[key] = config.getint(section, option)
+        except ValueError as e:
+            LOG.warning('Invalid restart limits, using the defaults: %s' % e)
+            limits = {'max_restarts': 5, 'window': 300, 'backoff': 10}
+        return cls(**limits)
+
+    def _load(self):
+        if self._state is None:
+            try:
+                with open(self.state_path) as f:
+                    self._state = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._state = {}
+        return self._state
+
+    def _save(self):
+        try:
+            save_json(self.state_path, self._state)
+        except (IOError, OSError) as e:
+            LOG.warning('Could not save the restart state to %s: %s' %
+                        (self.state_path, e))
+
+    def stopped(self, key, now=None):
+        """Decide what to do about a stopped service.
+
+        A restart is recorded when RESTART is returned.
+
+        Returns:
+            RESTART to restart the service now, WAIT while backing off,
+            GIVE_UP the first time the service is given up and FAILED after
+            that
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._load()
+            entry = state.setdefault(key, {'state': 'ok', 'restarts': []})
+            if entry['state'] == self.FAILED:
+                return self.FAILED
+            restarts = [t for t in entry['restarts']
+                        if now - t < self.window]
+            if len(restarts) >= self.max_restarts:
+                entry.update(state=self.FAILED, restarts=restarts,
+                             next_restart=None)
+                self._save()
+                return self.GIVE_UP
+            if restarts and now < (entry.get('next_restart') or 0):
+                return self.WAIT
+            restarts.append(now)
+            delay = min(self.backoff * 2 ** (len(restarts) - 1),
+                        self.window)
+            entry.update(state='backoff', restarts=restarts,
+                         next_restart=now + delay)
+            self._save()
+            return self.RESTART
+
+    def running(self, key, now=None):
+        """Record that a service is running, forgetting old restarts."""
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._load()
+            entry = state.get(key)
+            if entry is None:
+                return
+            restarts = [t for t in entry['restarts']
+                        if now - t < self.window]
+            if entry['state'] == self.FAILED:
+                LOG.info('Service %s is running again' % key)
+                restarts = []
+            if not restarts:
+                del state[key]
+            elif restarts == entry['restarts']:
+                return
+            else:
+                entry['restarts'] = restarts
+            self._save()
+
+    def status(self):
+        """Return the restart state of the services restarted lately."""
+        with self._lock:
+            return json.loads(json.dumps(self._load()))
+
 
-        return ext
+class ServiceNotReadyError(Exception):
+    pass
 
-    def _apply_source_cmd(self, dest, url):
-        cmd = ""
-        basename = os.path.basename(url)
-        stype = self._source_type(url)
-        if stype == '.tgz':
-            cmd = "curl -s '%s' | gunzip | tar -xvf -" % url
-        elif stype == '.tbz2':
-            cmd = "curl -s '%s' | bunzip2 | tar -xvf -" % url
-        elif stype == '.zip':
-            tmp = self._url_to_tmp_filename(url)
-            cmd = "curl -s -o '%s' '%s' && unzip -o '%s'" % (tmp, url, tmp)
-        elif stype == '.tar':
-            cmd = "curl -s '%s' | tar -xvf -" % url
-        elif stype == '.gz':
-            (r, ext) = self._splitext(basename)
-            cmd = "curl -s '%s' | gunzip > '%s'" % (url, r)
-        elif stype == '.bz2':
-            (r, ext) = self._splitext(basename)
-            cmd = "curl -s '%s' | bunzip2 > '%s'" % (url, r)
-
-        if cmd != '':
-            cmd = "mkdir -p '%s'; cd '%s'; %s" % (dest, dest, cmd)
-
-        return cmd
-
-    def _apply_source(self, dest, url):
-        cmd = self._apply_source_cmd(dest, url)
-        # FIXME bug 1498298
-        if cmd != '':
-            runner = CommandRunner(cmd, shell=True)
-            runner.run()
 
-    def apply_sources(self):
-        if not self._sources:
-            return
-        for dest, url in self._sources.items():
-            self._apply_source(dest, url)
+class ReadinessProbe(object):
+    """Waits for a service to be ready, as its 'readiness' block describes.
+
+    The block may hold any of these probes, which must all pass:
+      * tcp  -- "host:port", or a port of localhost, accepting connections
+      * http -- a URL answering GET with one of the 'status' codes, any 2xx
+                or 3xx status by default
+      * file -- a path which exists
+    The probes are retried every 'interval' seconds (1 by default), for
+    'timeout' seconds at most (60 by default).
+    """
+
+    def __init__(self, service, readiness):
+        self.service = service
+        try:
+            self.address = self._address(readiness.get('tcp'))
+            self.url = readiness.get('http')
+            status = readiness.get('status')
+            if status is not None and not isinstance(status, list):
+                status = [status]
+            self.status = [int(code) for code in status or []]
+            self.path = readiness.get('file')
+            self.timeout = float(readiness.get('timeout', 60))
+            self.interval = float(readiness.get('interval', 1))
+        except (AttributeError, TypeError, ValueError) as e:
+            raise ServiceNotReadyError('Invalid readiness of %s: %s' %
+                                       (service, e))
+
+    @staticmethod
+    def _address(tcp):
+        if tcp is None:
+            return None
+        tcp = str(tcp)
+        if tcp.isdigit():
+            return '127.0.0.1', int(tcp)
+        host, sep, port = tcp.rpartition(':')
+        return host.strip('[]') or '127.0.0.1', int(port)
+
+    def _tcp_ready(self, timeout):
+        try:
+            socket.create_connection(self.address, timeout).close()
+        except OSError:
+            return False
+        return True
+
+    def _http_ready(self, timeout):
+        url = urllib.parse.urlsplit(self.url)
+        if url.scheme == 'https':
+            conn = http.client.HTTPSConnection(url.hostname, url.port,
+                                               timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(url.hostname, url.port,
+                                              timeout=timeout)
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        try:
+            conn.request('GET', path)
+            status = conn.getresponse().status
+        except (OSError, http.client.HTTPException):
+            return False
+        finally:
+            conn.close()
+        if self.status:
+            return status in self.status
+        return 200 <= status < 400
+
+    def ready(self, timeout=5):
+        """Return whether all the probes pass now."""
+        return ((self.path is None or os.path.exists(self.path)) and
+                (self.address is None or self._tcp_ready(timeout)) and
+                (self.url is None or self._http_ready(timeout)))
+
+    def wait(self):
+        """Return whether the service became ready before the timeout."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if self.ready(max(0.1, min(5, remaining))):
+                LOG.info("Service %s is ready" % self.service)
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                LOG.error("Service %s is not ready after %s seconds" %
+                          (self.service, self.timeout))
+                return False
+            time.sleep(min(self.interval, remaining))
 
 
 class ServicesHandler(object):
     _services = {}
-
-    def __init__(self, services, resource=None, hooks=None):
+    _systemctl = "/bin/systemctl"
+    # unit ActiveState values treated as running by ``systemctl show``
+    _running_states = ('active', 'activating', 'reloading')
+    # UnitFileState values which need no enable, or which need a disable
+    _enabled_states = ('enabled', 'enabled-runtime', 'static', 'alias',
+                       'generated')
+    _disable_states = ('enabled', 'enabled-runtime')
+    # order in which batched systemctl actions are run
+    _batch_actions = (('enable', 'Enabling'), ('disable', 'Disabling'),
+                      ('start', 'Starting'), ('stop', 'Stopping'),
+                      ('restart', 'Restarting'))
+    # where the pidfiles of sysvinit services are looked for
+    _pidfiles = ('/var/run/%s.pid', '/run/%s.pid')
+
+    def __init__(self, services, resource=None, hooks=None,
+                 restart_policy=None, changes=None):
         self._services = services
         self.resource = resource
         self.hooks = hooks
+        self.restart_policy = restart_policy
+        self.changes = changes or {}
+        self._tools = None
+        # main process ids of the running services, as queried by the last
+        # monitor_services() call, for service_pids() to reuse
+        self._main_pids = {}
+
+    def _init_system(self):
+        """Return the (service, enable) executables, probing only once."""
+        if self._tools is None:
+            if os.path.exists(self._systemctl):
+                self._tools = (self._systemctl, self._systemctl)
+            else:
+                if os.path.exists("/sbin/service"):
+                    service_exe = "/sbin/service"
+                else:
+                    service_exe = "/usr/sbin/service"
+                if os.path.exists("/sbin/chkconfig"):
+                    enable_exe = "/sbin/chkconfig"
+                else:
+                    enable_exe = "/usr/sbin/update-rc.d"
+                self._tools = (service_exe, enable_exe)
+        return self._tools
+
+    def _uses_systemctl(self):
+        return self._init_system()[0] == self._systemctl
 
     def _handle_sysv_command(self, service, command):
-        if os.path.exists("/bin/systemctl"):
-            service_exe = "/bin/systemctl"
+        service_exe, enable_exe = self._init_system()
+        if service_exe == self._systemctl:
             service = '%s.service' % service
             service_start = [service_exe, 'start', service]
             service_status = [service_exe, 'status', service]
             service_stop = [service_exe, 'stop', service]
-        elif os.path.exists("/sbin/service"):
-            service_exe = "/sbin/service"
-            service_start = [service_exe, service, 'start']
-            service_status = [service_exe, service, 'status']
-            service_stop = [service_exe, service, 'stop']
         else:
-            service_exe = "/usr/sbin/service"
             service_start = [service_exe, service, 'start']
             service_status = [service_exe, service, 'status']
             service_stop = [service_exe, service, 'stop']
 
-        if os.path.exists("/bin/systemctl"):
-            enable_exe = "/bin/systemctl"
+        service_restart = service_start[:]
+        service_restart[service_start.index('start')] = 'restart'
+
+        if enable_exe == self._systemctl:
             enable_on = [enable_exe, 'enable', service]
             enable_off = [enable_exe, 'disable', service]
-        elif os.path.exists("/sbin/chkconfig"):
-            enable_exe = "/sbin/chkconfig"
+        elif enable_exe == "/sbin/chkconfig":
             enable_on = [enable_exe, service, 'on']
             enable_off = [enable_exe, service, 'off']
-
         else:
-            enable_exe = "/usr/sbin/update-rc.d"
             enable_on = [enable_exe, service, 'enable']
             enable_off = [enable_exe, service, 'disable']
 
@@ -909,6 +3063,8 @@ class ServicesHandler(object):
             cmd = service_stop
         elif "status" == command:
             cmd = service_status
+        elif "restart" == command:
+            cmd = service_restart
 
         if cmd is not None:
             command = CommandRunner(cmd)
@@ -917,6 +3073,66 @@ class ServicesHandler(object):
         else:
             LOG.error("Unknown sysv command %s" % command)
 
+    def _unit_states(self, services,
+                     properties='Id,ActiveState,UnitFileState'):
+        """Query the state of several services with one systemctl call.
+
+        Returns:
+            a dict of service name to a dict of the requested unit
+            properties, or None when systemctl is not available or the
+            query fails.
+        """
+        services = list(services)
+        if not services or not self._uses_systemctl():
+            return None
+        units = ['%s.service' % service for service in services]
+        command = CommandRunner([self._systemctl, 'show', '-p',
+                                 properties] + units)
+        command.run()
+        output = command.stdout or ''
+        if isinstance(output, bytes):
+            output = output.decode('utf-8', 'replace')
+        # one block per unit, in the order they were asked for; Id may name
+        # the unit an alias resolves to, so match blocks by position
+        blocks = [block for block in output.strip().split('\n\n') if block]
+        if command.status != 0 or len(blocks) != len(services):
+            LOG.warning("Could not query the state of services %s" %
+                        ', '.join(services))
+            return None
+        states = {}
+        for service, block in zip(services, blocks):
+            props = {}
+            for line in block.splitlines():
+                key, sep, value = line.partition('=')
+                if sep:
+                    props[key.strip()] = value.strip()
+            states[service] = props
+        return states
+
+    def _service_running(self, handler, service, states=None):
+        if states is not None and service in states:
+            active = states[service].get('ActiveState')
+            return active in self._running_states
+        command = handler(self, service, "status")
+        return command.status == 0
+
+    def _changed_dependencies(self, properties):
+        """Return the dependencies of a service which this run changed."""
+        changed = []
+        for key in ('files', 'sources'):
+            done = set(os.path.normpath(path)
+                       for path in self.changes.get(key, ()))
+            changed.extend(path for path in properties.get(key) or []
+                           if os.path.normpath(path) in done)
+        done = self.changes.get('commands', ())
+        changed.extend(command for command in properties.get('commands') or []
+                       if command in done)
+        packages = self.changes.get('packages', {})
+        for manager, names in (properties.get('packages') or {}).items():
+            changed.extend(name for name in names
+                           if name in packages.get(manager, ()))
+        return changed
+
     def _initialize_service(self, handler, service, properties):
         if "enabled" in properties:
             enable = to_boolean(properties["enabled"])
@@ -937,13 +3153,31 @@ class ServicesHandler(object):
             elif not ensure_running and running:
                 LOG.info("Stopping service %s" % service)
                 handler(self, service, "stop")
+            elif ensure_running and self._changed_dependencies(properties):
+                LOG.info("Restarting service %s" % service)
+                handler(self, service, "restart")
 
-    def _monitor_service(self, handler, service, properties):
+    def _monitor_service(self, handler, service, properties, states=None):
         if "ensureRunning" in properties:
             ensure_running = to_boolean(properties["ensureRunning"])
-            command = handler(self, service, "status")
-            running = command.status == 0
+            running = self._service_running(handler, service, states)
+            policy = self.restart_policy
+            key = '%s/%s' % (self.resource, service)
             if ensure_running and not running:
+                decision = (policy.stopped(key) if policy
+                            else RestartPolicy.RESTART)
+                if decision == RestartPolicy.WAIT:
+                    LOG.info("Waiting to restart service %s" % service)
+                    return
+                if decision == RestartPolicy.GIVE_UP:
+                    LOG.error("Service %s keeps stopping, giving up "
+                              "restarting it" % service)
+                    for h in self.hooks:
+                        h.event('service.failed', service, self.resource)
+                    return
+                if decision == RestartPolicy.FAILED:
+                    LOG.debug("Not restarting failed service %s" % service)
+                    return
                 LOG.warning("Restarting service %s" % service)
                 start_cmd = handler(self, service, "start")
                 if start_cmd.status != 0:
@@ -951,14 +3185,64 @@ class ServicesHandler(object):
                                 (service, start_cmd.stderr))
                 for h in self.hooks:
                     h.event('service.restarted', service, self.resource)
+            elif running and policy:
+                policy.running(key)
 
     def _monitor_services(self, handler, services):
+        states = self._unit_states(
+            (service for service, properties in services.items()
+             if "ensureRunning" in properties),
+            'Id,ActiveState,UnitFileState,MainPID')
         for service, properties in services.items():
-            self._monitor_service(handler, service, properties)
+            self._monitor_service(handler, service, properties, states)
+        for service, props in (states or {}).items():
+            if props.get('ActiveState') in self._running_states:
+                try:
+                    self._main_pids[service] = int(props.get('MainPID', 0))
+                except ValueError:
+                    pass
 
     def _initialize_services(self, handler, services):
+        states = self._unit_states(services)
+        if states is None:
+            for service, properties in services.items():
+                self._initialize_service(handler, service, properties)
+            return
+
+        # only the units whose state differs are passed to systemctl, with
+        # one invocation per action
+        plan = []
         for service, properties in services.items():
-            self._initialize_service(handler, service, properties)
+            plan.extend(self._plan_service(handler, service, properties,
+                                           states))
+        for action, verb in self._batch_actions:
+            batch = [entry['item'] for entry in plan
+                     if entry['action'] == action]
+            if not batch:
+                continue
+            for service in batch:
+                LOG.info("%s service %s" % (verb, service))
+            command = CommandRunner(
+                [self._systemctl, action] +
+                ['%s.service' % service for service in batch])
+            command.run()
+            if command.status == 0:
+                continue
+            if len(batch) == 1:
+                LOG.warning('Could not %s service %s. STDERR: %s' %
+                            (action, batch[0], command.stderr))
+                continue
+            # systemctl fails the whole batch when one unit is missing, so
+            # the others are given their own chance
+            LOG.info('Could not %s services %s together, retrying one at a '
+                     'time' % (action, ', '.join(batch)))
+            for service in batch:
+                command = CommandRunner(
+                    [self._systemctl, action, '%s.service' % service])
+                command.run()
+                if command.status != 0:
+                    LOG.warning('Could not %s service %s. STDERR: %s' %
+                                (action, service, command.stderr))
 
     # map of function pointers to various service handlers
     _service_handlers = {
@@ -973,7 +3257,14 @@ class ServicesHandler(object):
         return handler
 
     def apply_services(self):
-        """Starts, stops, enables, disables services."""
+        """Starts, stops, enables, disables services.
+
+        Then waits for the running services with a readiness block to be
+        ready, see ReadinessProbe.
+
+        Raises:
+            ServiceNotReadyError: when a service is not ready in time
+        """
         if not self._services:
             return
         for manager, service_entries in self._services.items():
@@ -982,9 +3273,105 @@ class ServicesHandler(object):
                 LOG.warning("Skipping invalid service type: %s" % manager)
             else:
                 self._initialize_services(handler, service_entries)
+        self._await_readiness()
+
+    def _readiness_blocks(self):
+        """Yield the (service, readiness) of the services to wait for."""
+        for manager, service_entries in self._services.items():
+            if not self._service_handler(manager):
+                continue
+            for service, properties in service_entries.items():
+                if ("readiness" in properties and
+                        to_boolean(properties.get("ensureRunning", False))):
+                    yield service, properties["readiness"]
+
+    def _await_readiness(self):
+        """Wait for the running services with a readiness block, together.
+
+        Raises:
+            ServiceNotReadyError: when a service is not ready in time
+        """
+        probes = [ReadinessProbe(service, readiness)
+                  for service, readiness in self._readiness_blocks()]
+        if not probes:
+            return
+        with futures.ThreadPoolExecutor(max_workers=len(probes)) as pool:
+            ready = list(pool.map(lambda probe: probe.wait(), probes))
+        not_ready = [probe.service for probe, ok in zip(probes, ready)
+                     if not ok]
+        if not_ready:
+            raise ServiceNotReadyError('Services not ready: %s' %
+                                       ', '.join(not_ready))
+
+    def _plan_service(self, handler, service, properties, states=None):
+        plan = []
+        if "enabled" in properties:
+            enable = to_boolean(properties["enabled"])
+            unit_file = None
+            if states is not None and service in states:
+                unit_file = states[service].get('UnitFileState', '')
+            if enable and unit_file in self._enabled_states:
+                plan.append(plan_entry('services', service, 'skip',
+                                       reason='enabled'))
+            elif enable:
+                plan.append(plan_entry('services', service, 'enable'))
+            elif unit_file is not None and (
+                    unit_file not in self._disable_states):
+                plan.append(plan_entry('services', service, 'skip',
+                                       reason='disabled'))
+            else:
+                plan.append(plan_entry('services', service, 'disable'))
+
+        if "ensureRunning" in properties:
+            ensure_running = to_boolean(properties["ensureRunning"])
+            running = self._service_running(handler, service, states)
+            changed = self._changed_dependencies(properties)
+            if ensure_running and not running:
+                plan.append(plan_entry('services', service, 'start'))
+            elif not ensure_running and running:
+                plan.append(plan_entry('services', service, 'stop'))
+            elif ensure_running and changed:
+                plan.append(plan_entry('services', service, 'restart',
+                                       changed=changed))
+            else:
+                plan.append(plan_entry(
+                    'services', service, 'skip',
+                    reason='running' if running else 'stopped'))
+        return plan
+
+    def plan_services(self):
+        """Return the actions apply_services() would take.
+
+        Only service status queries are run.
+        """
+        plan = []
+        if not self._services:
+            return plan
+        for manager, service_entries in self._services.items():
+            handler = self._service_handler(manager)
+            if not handler:
+                plan.extend(plan_entry('services', service, 'skip',
+                                       reason='invalid service type')
+                            for service in service_entries)
+                continue
+            states = self._unit_states(service_entries)
+            for service, properties in service_entries.items():
+                plan.extend(self._plan_service(handler, service, properties,
+                                               states))
+        for service, readiness in self._readiness_blocks():
+            try:
+                probe = ReadinessProbe(service, readiness)
+            except ServiceNotReadyError as e:
+                plan.append(plan_entry('services', service, 'skip',
+                                       reason=str(e)))
+                continue
+            plan.append(plan_entry('services', service, 'wait',
+                                   timeout=probe.timeout))
+        return plan
 
     def monitor_services(self):
         """Restarts failed services, and runs hooks."""
+        self._main_pids = {}
         if not self._services:
             return
         for manager, service_entries in self._services.items():
@@ -994,6 +3381,170 @@ class ServicesHandler(object):
             else:
                 self._monitor_services(handler, service_entries)
 
+    def _pidfile_pid(self, service):
+        for path in self._pidfiles:
+            try:
+                with open(path % service) as f:
+                    return int(f.readline().strip())
+            except (IOError, OSError, ValueError):
+                continue
+        return None
+
+    def service_pids(self):
+        """Return the main process ids of the monitored services.
+
+        systemd units are queried with one systemctl call, other services
+        through their pidfile. The units monitor_services() just found
+        running are not queried again. Services without a known main process
+        are left out.
+        """
+        services = []
+        for manager, service_entries in (self._services or {}).items():
+            if not self._service_handler(manager):
+                continue
+            services.extend(
+                service for service, properties in service_entries.items()
+                if to_boolean(properties.get("ensureRunning", False)))
+        if not services:
+            return {}
+
+        main_pids, self._main_pids = self._main_pids, {}
+        pids = dict((service, main_pids[service]) for service in services
+                    if service in main_pids)
+        if self._uses_systemctl():
+            states = self._unit_states(
+                [service for service in services if service not in pids],
+                'MainPID') or {}
+            for service, props in states.items():
+                try:
+                    pids[service] = int(props.get('MainPID', 0))
+                except ValueError:
+                    pass
+        else:
+            for service in services:
+                pids[service] = self._pidfile_pid(service)
+        return dict((service, pid) for service, pid in pids.items() if pid)
+
+
+class PollingWatcher(object):
+    """Service watcher which does not watch, it only waits."""
+
+    name = 'poll'
+
+    def wait(self, pids, timeout):
+        time.sleep(timeout)
+        return []
+
+
+class PidfdWatcher(object):
+    """Service watcher waking up as soon as a watched process exits.
+
+    Waits on Linux process file descriptors, so watching costs neither
+    forks nor CPU time while the services keep running.
+    """
+
+    name = 'pidfd'
+
+    @staticmethod
+    def supported():
+        if not hasattr(os, 'pidfd_open'):
+            return False
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+        except OSError:
+            return False
+        return True
+
+    def wait(self, pids, timeout):
+        """Wait until one of the processes exits.
+
+        Arguments:
+            pids    -- a dict of keys to process ids
+            timeout -- how many seconds to wait at most
+        Returns:
+            the keys of the processes which exited, empty on timeout
+        """
+        fds = {}
+        poller = select.poll()
+        try:
+            for key, pid in pids.items():
+                try:
+                    fd = os.pidfd_open(pid)
+                except ProcessLookupError:
+                    # a stale pidfile, the next check at the latest finds
+                    # whether the service is really down
+                    LOG.debug("No process %d to watch for %s" % (pid, key))
+                    continue
+                fds[fd] = key
+                poller.register(fd, select.POLLIN)
+            return [fds[fd] for fd, event in poller.poll(timeout * 1000)]
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+
+_service_watchers = {
+    PollingWatcher.name: PollingWatcher,
+    PidfdWatcher.name: PidfdWatcher,
+}
+
+
+def service_watcher(backend='auto'):
+    """Return a service watcher.
+
+    Arguments:
+        backend -- "pidfd", "poll", or "auto" for the best one available
+    Raises:
+        ValueError: on an unknown backend
+    """
+    if backend == 'auto':
+        backend = 'pidfd' if PidfdWatcher.supported() else 'poll'
+    try:
+        return _service_watchers[backend]()
+    except KeyError:
+        raise ValueError('Unknown service watcher: %s' % backend)
+
+
+def watch_services(handlers, watcher=None, interval=10, until=None,
+                   poll=None, poll_interval=None):
+    """Keep the monitored services of several resources running.
+
+    monitor_services() runs on every handler each time the watcher wakes
+    up: as soon as the main process of a watched service exits, and at the
+    latest every interval seconds for services without a known process.
+
+    If poll is given, it is called every poll_interval seconds, on its own
+    schedule, to poll the remote metadata; the handlers it returns are
+    watched from then on.
+
+    Arguments:
+        handlers      -- ServicesHandler instances
+        watcher       -- a service watcher, the best available by default
+        interval      -- how many seconds to wait at most between checks
+        until         -- a callable returning True when watching must stop
+        poll          -- a callable returning new ServicesHandler instances
+        poll_interval -- how many seconds to wait between two polls
+    """
+    watcher = watcher or service_watcher()
+    LOG.info("Watching services with the %s watcher" % watcher.name)
+    next_poll = None
+    if poll is not None:
+        next_poll = time.monotonic() + poll_interval
+    while until is None or not until():
+        if next_poll is not None and time.monotonic() >= next_poll:
+            handlers = poll()
+            next_poll = time.monotonic() + poll_interval
+        pids = {}
+        for handler in handlers:
+            handler.monitor_services()
+            for service, pid in handler.service_pids().items():
+                pids[(handler.resource, service)] = pid
+        timeout = interval
+        if next_poll is not None:
+            timeout = max(0, min(interval, next_poll - time.monotonic()))
+        for resource, service in watcher.wait(pids, timeout):
+            LOG.info("Service %s of %s exited" % (service, resource))
+
 
 class ConfigsetsHandler(object):
 
@@ -1071,21 +3622,405 @@ class CommandsHandlerRunError(Exception):
     pass
 
 
+class PackageInventory(object):
+    """The names of the installed packages, read with a single query.
+
+    The rpm database is read if rpm is there, the dpkg one otherwise. The
+    inventory is read on first use and kept until forget() is called.
+    """
+
+    _queries = (
+        (['rpm', '-qa', '--queryformat', '%{NAME}\\n'], None),
+        (['dpkg-query', '-W', '-f=${Package} ${Status}\\n'], ' installed'),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = None
+
+    def _read(self):
+        for cmd, suffix in self._queries:
+            try:
+                command = CommandRunner(cmd).run()
+            except OSError:
+                continue
+            if command.status != 0:
+                continue
+            output = command.stdout or b''
+            if isinstance(output, bytes):
+                output = output.decode('utf-8', 'replace')
+            names = set()
+            for line in output.splitlines():
+                if suffix and not line.endswith(suffix):
+                    continue
+                if line.split():
+                    names.add(line.split()[0].split(':')[0])
+            return names
+        LOG.warning("Could not list the installed packages")
+        return set()
+
+    def installed(self, name):
+        """Return whether a package of this name is installed."""
+        with self._lock:
+            if self._names is None:
+                self._names = self._read()
+            return name in self._names
+
+    def forget(self):
+        with self._lock:
+            self._names = None
+
+
+class CommandTest(object):
+    """A 'test' clause of a command made of built-in predicates.
+
+    Instead of a shell command, 'test' may be a map of predicates which are
+    evaluated in-process, and which all have to hold:
+      * pathExists: a path, or list of paths, to exist
+      * fileContains: a map of 'path' to a file whose content matches the
+        regular expression 'pattern'
+      * packageInstalled: a package name, or list of names, to be installed
+      * userExists, groupExists: a user or group name, or list of names
+      * portListening: a TCP port, or list of ports, being listened on
+      * not: a map of predicates which must not all hold
+
+    Raises CommandsHandlerRunError for an invalid clause.
+    """
+
+    _proc_net = ('/proc/net/tcp', '/proc/net/tcp6')
+
+    def __init__(self, test, resolver=None, inventory=None):
+        if not isinstance(test, dict) or not test:
+            raise CommandsHandlerRunError(
+                "test must be a shell command or a map of predicates")
+        unknown = sorted(key for key in test if key not in self._predicates)
+        if unknown:
+            raise CommandsHandlerRunError(
+                "Unknown test predicates %s" % ', '.join(unknown))
+        self.resolver = resolver or IdentityResolver()
+        self.inventory = inventory or PackageInventory()
+        self.test = dict((key, getattr(self, self._predicates[key][1])(
+            key, value)) for key, value in test.items())
+
+    @staticmethod
+    def _values(value):
+        return value if isinstance(value, list) else [value]
+
+    def _check_names(self, key, value):
+        names = self._values(value)
+        if not names or not all(isinstance(name, str) and name
+                                for name in names):
+            raise CommandsHandlerRunError(
+                "%s needs a name or a list of names" % key)
+        return names
+
+    def _check_ports(self, key, value):
+        ports = []
+        for port in self._values(value):
+            try:
+                if isinstance(port, bool):
+                    raise ValueError(port)
+                port = int(port)
+            except (TypeError, ValueError):
+                port = 0
+            if not 0 < port < 65536:
+                raise CommandsHandlerRunError(
+                    "%s needs a port or a list of ports" % key)
+            ports.append(port)
+        if not ports:
+            raise CommandsHandlerRunError(
+                "%s needs a port or a list of ports" % key)
+        return ports
+
+    def _check_contains(self, key, value):
+        if (not isinstance(value, dict) or
+                not isinstance(value.get('path'), str) or
+                not isinstance(value.get('pattern'), str)):
+            raise CommandsHandlerRunError(
+                "%s needs a path and a pattern" % key)
+        try:
+            return value['path'], re.compile(value['pattern'], re.MULTILINE)
+        except re.error as e:
+            raise CommandsHandlerRunError(
+                "Invalid %s pattern: %s" % (key, e))
+
+    def _check_test(self, key, value):
+        return CommandTest(value, self.resolver, self.inventory)
+
+    def _path_exists(self, paths):
+        return all(os.path.exists(os.path.expanduser(path))
+                   for path in paths)
+
+    def _file_contains(self, contains):
+        path, pattern = contains
+        try:
+            with open(os.path.expanduser(path), 'rb') as f:
+                content = f.read().decode('utf-8', 'replace')
+        except (IOError, OSError):
+            return False
+        return pattern.search(content) is not None
+
+    def _package_installed(self, names):
+        return all(self.inventory.installed(name) for name in names)
+
+    @staticmethod
+    def _exists(lookup, names):
+        for name in names:
+            try:
+                lookup(name)
+            except KeyError:
+                return False
+        return True
+
+    def _user_exists(self, names):
+        return self._exists(self.resolver.getpwnam, names)
+
+    def _group_exists(self, names):
+        return self._exists(self.resolver.getgrnam, names)
+
+    def _listening_ports(self):
+        ports = set()
+        for path in self._proc_net:
+            try:
+                with open(path) as f:
+                    lines = f.readlines()[1:]
+            except (IOError, OSError):
+                continue
+            for line in lines:
+                fields = line.split()
+                # local address as ADDR:PORT in hex, then state, 0A listening
+                if len(fields) > 3 and fields[3] == '0A':
+                    ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+        return ports
+
+    def _port_listening(self, ports):
+        listening = self._listening_ports()
+        return all(port in listening for port in ports)
+
+    def _not(self, test):
+        return not test.holds()
+
+    # predicate name: (method evaluating it, method checking its value)
+    _predicates = {
+        'pathExists': ('_path_exists', '_check_names'),
+        'fileContains': ('_file_contains', '_check_contains'),
+        'packageInstalled': ('_package_installed', '_check_names'),
+        'userExists': ('_user_exists', '_check_names'),
+        'groupExists': ('_group_exists', '_check_names'),
+        'portListening': ('_port_listening', '_check_ports'),
+        'not': ('_not', '_check_test'),
+    }
+
+    def holds(self):
+        """Return whether all the predicates hold."""
+        return all(getattr(self, self._predicates[key][0])(value)
+                   for key, value in sorted(self.test.items()))
+
+
 class CommandsHandler(object):
+    """Runs commands, in alphabetical order by name by default.
+
+    Once any command has a 'dependsOn' or a 'parallelGroup' attribute, the
+    commands run up to workers at a time, each as soon as the commands it
+    waits for are done:
+      * a command with 'dependsOn', the name or list of names of other
+        commands, waits for those only
+      * any other command waits for all the commands before it in
+        alphabetical order, except those waiting for it through 'dependsOn'
+        and those of its own 'parallelGroup', so the commands of a group
+        which sort next to each other run together
+    A command failing without 'ignoreErrors' stops any further command from
+    starting, and is raised once the running ones are done.
+
+    If journal, a JournalScope, is given, each command which completes is
+    recorded there, and the commands it shows done are not run again.
+
+    A 'test' is run as a shell command unless it is a map of the built-in
+    predicates of CommandTest, which are evaluated without a fork.
+    """
 
-    def __init__(self, commands):
+    def __init__(self, commands, resolver=None, workers=4, journal=None):
         self.commands = commands
+        self.resolver = resolver
+        self.workers = workers
+        self.journal = journal
+        self.inventory = PackageInventory()
+        # the names of the commands which ran successfully
+        self.changed = set()
+
+    def _uses_graph(self):
+        return any('dependsOn' in properties or 'parallelGroup' in properties
+                   for properties in self.commands.values())
+
+    def _command_graph(self):
+        """Return the names of the commands each command waits for.
+
+        Raises:
+            CommandsHandlerRunError: on unknown or circular dependencies
+        """
+        labels = sorted(self.commands)
+        graph = {}
+        for label in labels:
+            deps = self.commands[label].get('dependsOn')
+            if deps is None:
+                continue
+            if isinstance(deps, str):
+                deps = [deps]
+            unknown = [dep for dep in deps if dep not in self.commands]
+            if unknown:
+                raise CommandsHandlerRunError(
+                    "%s depends on unknown commands %s" %
+                    (label, ', '.join(unknown)))
+            graph[label] = set(deps)
+
+        def waits_for(label, other):
+            seen = set()
+            stack = [label]
+            while stack:
+                current = stack.pop()
+                if current == other:
+                    return True
+                if current not in seen:
+                    seen.add(current)
+                    stack.extend(graph.get(current, ()))
+            return False
+
+        # the alphabetical order is not kept where it contradicts dependsOn
+        for i, label in enumerate(labels):
+            if label in graph:
+                continue
+            group = self.commands[label].get('parallelGroup')
+            graph[label] = set(
+                other for other in labels[:i]
+                if (group is None or
+                    self.commands[other].get('parallelGroup') != group) and
+                not waits_for(other, label))
+
+        # every command must be reachable from the ones without dependencies
+        done = set()
+        ready = [label for label in labels if not graph[label]]
+        while ready:
+            done.update(ready)
+            ready = [label for label in labels
+                     if label not in done and graph[label] <= done]
+        if len(done) != len(labels):
+            raise CommandsHandlerRunError(
+                "Circular dependencies between commands %s" %
+                ', '.join(label for label in labels if label not in done))
+        return graph
+
+    def _apply_graph(self):
+        pending = self._command_graph()
+        done = set()
+        running = {}
+        errors = []
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                if not errors:
+                    for label in sorted(pending):
+                        if pending[label] <= done:
+                            del pending[label]
+                            LOG.debug("%s is being processed" % label)
+                            running[pool.submit(
+                                self._run_command, label,
+                                self.commands[label])] = label
+                if not running:
+                    break
+                finished, _ = futures.wait(
+                    running, return_when=futures.FIRST_COMPLETED)
+                for future in finished:
+                    label = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors.append(e)
+                    else:
+                        done.add(label)
+        if errors:
+            raise errors[0]
 
     def apply_commands(self):
-        """Execute commands on the instance in alphabetical order by name."""
+        """Execute the commands on the instance.
+
+        Raises:
+            CommandsHandlerRunError: when a command fails
+        """
         if not self.commands:
             return
+        if self._uses_graph():
+            self._apply_graph()
+            return
         for command_label in sorted(self.commands):
             LOG.debug("%s is being processed" % command_label)
-            self._initialize_command(command_label,
-                                     self.commands[command_label])
+            self._run_command(command_label, self.commands[command_label])
+
+    def _run_command(self, command_label, properties):
+        if self.journal and self.journal.done(command_label, properties):
+            LOG.info("%s was run by an earlier run, skipping" %
+                     command_label)
+            return
+        ran = self._initialize_command(command_label, properties)
+        if ran and self.journal:
+            self.journal.record(command_label, properties)
+
+    def plan_commands(self):
+        """Return the actions apply_commands() would take.
+
+        Shell 'test' clauses are not evaluated, as they may have side
+        effects; those made of built-in predicates are.
+        """
+        plan = []
+        if not self.commands:
+            return plan
+        graph = None
+        if self._uses_graph():
+            try:
+                graph = self._command_graph()
+            except CommandsHandlerRunError as e:
+                return [plan_entry('commands', command_label, 'skip',
+                                   reason=str(e))
+                        for command_label in sorted(self.commands)]
+        for command_label in sorted(self.commands):
+            properties = self.commands[command_label]
+            if "command" not in properties:
+                plan.append(plan_entry('commands', command_label, 'skip',
+                                       reason="'command' property missing"))
+                continue
+            cwd = properties.get("cwd")
+            if cwd and not os.path.exists(os.path.expanduser(cwd)):
+                plan.append(plan_entry('commands', command_label, 'skip',
+                                       reason='%s does not exist' % cwd))
+                continue
+            detail = {}
+            if "test" in properties:
+                detail['test'] = properties["test"]
+                if isinstance(properties["test"], dict):
+                    try:
+                        holds = self._command_test(properties["test"])
+                    except CommandsHandlerRunError as e:
+                        plan.append(plan_entry('commands', command_label,
+                                               'skip', reason=str(e)))
+                        continue
+                    if not holds:
+                        plan.append(plan_entry('commands', command_label,
+                                               'skip',
+                                               reason='test returns false'))
+                        continue
+            if graph is not None:
+                detail['after'] = sorted(graph[command_label])
+            plan.append(plan_entry('commands', command_label, 'run',
+                                   **detail))
+        return plan
+
+    def _command_test(self, test):
+        return CommandTest(test, self.resolver, self.inventory).holds()
 
     def _initialize_command(self, command_label, properties):
+        """Run a command unless its test returns false.
+
+        Returns whether the command ran, successfully or with its errors
+        ignored.
+        """
         command_status = None
         cwd = None
         env = properties.get("env", None)
@@ -1098,8 +4033,16 @@ class CommandsHandler(object):
                 return
 
         if "test" in properties:
-            test = CommandRunner(properties["test"], shell=True)
-            test_status = test.run('root', cwd, env).status
+            if isinstance(properties["test"], dict):
+                try:
+                    test_status = 0 if self._command_test(
+                        properties["test"]) else 1
+                except CommandsHandlerRunError as e:
+                    raise CommandsHandlerRunError(
+                        "%s has failed. %s" % (command_label, e))
+            else:
+                test = CommandRunner(properties["test"], shell=True)
+                test_status = test.run('root', cwd, env, self.resolver).status
             if test_status != 0:
                 LOG.info("%s test returns false, skipping command"
                          % command_label)
@@ -1112,8 +4055,10 @@ class CommandsHandler(object):
                 command = properties["command"]
                 shell = isinstance(command, str)
                 command = CommandRunner(command, shell=shell)
-                command.run('root', cwd, env)
+                command.run('root', cwd, env, self.resolver)
                 command_status = command.status
+                # the command may have installed or removed packages
+                self.inventory.forget()
             except OSError as e:
                 if e.errno == errno.EEXIST:
                     LOG.debug(str(e))
@@ -1126,19 +4071,24 @@ class CommandsHandler(object):
 
         if command_status == 0:
             LOG.info("%s has been successfully executed" % command_label)
+            self.changed.add(command_label)
         else:
             if ("ignoreErrors" in properties and
                     to_boolean(properties["ignoreErrors"])):
-                LOG.info("%s has failed (status=%d). Explicit ignoring"
+                LOG.info("%s has failed (status=%s). Explicit ignoring"
                          % (command_label, command_status))
             else:
                 raise CommandsHandlerRunError("%s has failed." % command_label)
+        return command_status is not None
 
 
 class GroupsHandler(object):
 
-    def __init__(self, groups):
+    def __init__(self, groups, resolver=None):
         self.groups = groups
+        self.resolver = resolver or IdentityResolver()
+        # whether a group could not be created
+        self.failed = False
 
     def apply_groups(self):
         """Create Linux/UNIX groups and assign group IDs."""
@@ -1148,6 +4098,20 @@ class GroupsHandler(object):
             LOG.debug("%s group is being created" % group)
             self._initialize_group(group, properties)
 
+    def plan_groups(self):
+        """Return the actions apply_groups() would take."""
+        plan = []
+        if not self.groups:
+            return plan
+        for group in self.groups:
+            try:
+                self.resolver.getgrnam(group)
+            except KeyError:
+                plan.append(plan_entry('groups', group, 'create'))
+            else:
+                plan.append(plan_entry('groups', group, 'exists'))
+        return plan
+
     def _initialize_group(self, group, properties):
         gid = properties.get("gid", None)
         cmd = ['groupadd', group]
@@ -1157,6 +4121,11 @@ class GroupsHandler(object):
         command = CommandRunner(cmd)
         command.run()
         command_status = command.status
+        self.resolver.forget_group(group)
+        # one which already exists is not a failure, so that a resumed run
+        # can complete the step
+        if command_status not in (0, 9):
+            self.failed = True
 
         if command_status == 0:
             LOG.info("%s has been successfully created" % group)
@@ -1178,8 +4147,11 @@ class GroupsHandler(object):
 
 class UsersHandler(object):
 
-    def __init__(self, users):
+    def __init__(self, users, resolver=None):
         self.users = users
+        self.resolver = resolver or IdentityResolver()
+        # whether a user could not be created
+        self.failed = False
 
     def apply_users(self):
         """Create Linux/UNIX users and assign user IDs, groups and homedir."""
@@ -1189,6 +4161,20 @@ class UsersHandler(object):
             LOG.debug("%s user is being created" % user)
             self._initialize_user(user, properties)
 
+    def plan_users(self):
+        """Return the actions apply_users() would take."""
+        plan = []
+        if not self.users:
+            return plan
+        for user in self.users:
+            try:
+                self.resolver.getpwnam(user)
+            except KeyError:
+                plan.append(plan_entry('users', user, 'create'))
+            else:
+                plan.append(plan_entry('users', user, 'exists'))
+        return plan
+
     def _initialize_user(self, user, properties):
         uid = properties.get("uid", None)
         homeDir = properties.get("homeDir", None)
@@ -1212,6 +4198,9 @@ class UsersHandler(object):
         command = CommandRunner(cmd)
         command.run()
         command_status = command.status
+        self.resolver.forget_user(user)
+        if command_status not in (0, 9):
+            self.failed = True
 
         if command_status == 0:
             LOG.info("%s has been successfully created" % user)
@@ -1234,6 +4223,81 @@ class UsersHandler(object):
             LOG.error("An error occurred creating %s user" % user)
 
 
+class Journal(object):
+    """Records the steps of cfn-init runs which completed.
+
+    A step is a handler of a config, or a single command, and is recorded
+    with a digest of its inputs, the metadata it was applied from. When
+    resuming, a step recorded with the same digest is done already and is
+    skipped; otherwise the journal only records. It is saved after each
+    step, so that it survives a failure or a reboot halfway through a run.
+    """
+
+    def __init__(self, path='/var/lib/heat-cfntools/cfn-init-journal.json',
+                 resume=False):
+        self.path = path
+        self.resume = resume
+        self._lock = threading.Lock()
+        self._steps = self._load() if resume else {}
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self):
+        try:
+            save_json(self.path, self._steps)
+        except (IOError, OSError) as e:
+            LOG.warning('Could not save the journal to %s: %s' %
+                        (self.path, e))
+
+    @staticmethod
+    def _key(config, handler, item):
+        return json.dumps([config, handler, item])
+
+    @staticmethod
+    def digest(inputs):
+        data = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode('UTF-8')).hexdigest()
+
+    def done(self, config, handler, item, inputs):
+        """Return whether a step is done already, when resuming."""
+        if not self.resume:
+            return False
+        with self._lock:
+            step = self._steps.get(self._key(config, handler, item))
+        return step == self.digest(inputs)
+
+    def record(self, config, handler, item, inputs):
+        """Record that a step completed."""
+        with self._lock:
+            self._steps[self._key(config, handler, item)] = self.digest(
+                inputs)
+            self._save()
+
+    def scope(self, config, handler):
+        """Return the journal of the items of one handler of a config."""
+        return JournalScope(self, config, handler)
+
+
+class JournalScope(object):
+    """The steps of one handler of a config, see Journal."""
+
+    def __init__(self, journal, config, handler):
+        self.journal = journal
+        self.config = config
+        self.handler = handler
+
+    def done(self, item, inputs):
+        return self.journal.done(self.config, self.handler, item, inputs)
+
+    def record(self, item, inputs):
+        self.journal.record(self.config, self.handler, item, inputs)
+
+
 class MetadataServerConnectionError(Exception):
     pass
 
@@ -1245,7 +4309,11 @@ class Metadata(object):
 
     def __init__(self, stack, resource, access_key=None,
                  secret_key=None, credentials_file=None, region=None,
-                 configsets=None):
+                 configsets=None, download_cache=None,
+                 overlap_downloads=False, source_workers=4,
+                 sources_manifest_dir='/var/lib/heat-cfntools/sources',
+                 mirrors=None, scheduler=None, restart_policy=None,
+                 command_workers=4, journal=None, cache_size=1 << 30):
 
         self.stack = stack
         self.resource = resource
@@ -1256,6 +4324,17 @@ class Metadata(object):
         self.access_key = access_key
         self.secret_key = secret_key
         self.configsets = configsets
+        self.mirrors = mirrors or MirrorMap()
+        self.download_cache = download_cache or DownloadCache(
+            client=HttpClient(mirrors=self.mirrors, scheduler=scheduler),
+            max_size=cache_size)
+        self.overlap_downloads = overlap_downloads
+        self.source_workers = source_workers
+        self.command_workers = command_workers
+        self.journal = journal
+        self.sources_manifest_dir = sources_manifest_dir
+        self.restart_policy = restart_policy
+        self._resolver = IdentityResolver()
 
         # TODO(asalkeld) is this metadata for the local resource?
         self._is_local_metadata = True
@@ -1302,8 +4381,16 @@ class Metadata(object):
 
         url = 'http://169.254.169.254/openstack/2012-08-10/meta_data.json'
         if not os.path.exists(cache_path):
-            cmd = ['curl', '-o', cache_path, url]
-            CommandRunner(cmd).run()
+            candidates = self.mirrors.candidates(url)
+            for candidate in candidates[:-1]:
+                cmd = ['curl', '-f', '-o', cache_path, candidate]
+                if CommandRunner(cmd).run().status == 0:
+                    self.mirrors.succeeded(candidate)
+                    break
+                self.mirrors.failed(candidate)
+            else:
+                cmd = ['curl', '-o', cache_path, url]
+                CommandRunner(cmd).run()
         try:
             with open(cache_path) as fd:
                 try:
@@ -1335,9 +4422,14 @@ class Metadata(object):
             self,
             meta_str=None,
             default_path='/var/lib/heat-cfntools/cfn-init-data',
-            last_path='/var/cache/heat-cfntools/last_metadata'):
+            last_path='/var/cache/heat-cfntools/last_metadata',
+            save_cache=True):
         """Read the metadata from the given filename or from the remote server.
 
+           Arguments:
+               save_cache -- if False, do not record the metadata as the last
+                             seen one, so that cfn-hup still notices changes
+
            Returns:
                True -- success
               False -- error
@@ -1407,6 +4499,9 @@ class Metadata(object):
         if self._metadata != last_data:
             self._has_changed = True
 
+        if not save_cache:
+            return True
+
         # if cache dir does not exist try to create it
         cache_dir = os.path.dirname(last_path)
         if not os.path.isdir(cache_dir):
@@ -1486,7 +4581,14 @@ class Metadata(object):
             self._metadata = self._metadata[self._init_key]
         return is_valid
 
-    def _process_config(self, config="config"):
+    def _config_section(self, config):
+        try:
+            return self._metadata[config]
+        except KeyError:
+            raise Exception("Could not find '%s' set in template, may need to"
+                            " specify another set." % config)
+
+    def _process_config(self, config="config", fetches=None):
         """Parse and process a config section.
 
           * packages
@@ -1496,45 +4598,203 @@ class Metadata(object):
           * files
           * commands
           * services
+
+        Arguments:
+            fetches -- an optional dict mapping URLs to the futures of
+                       downloads running in the background. The ones this
+                       section needs are waited for once its packages are
+                       installed, before its sources are applied.
+        """
+
+        self._config = self._config_section(config)
+        resolver = self._resolver
+        packages = PackagesHandler(self._config.get("packages"))
+        self._apply_step(config, "packages", packages, packages.apply_packages)
+        if fetches:
+            futures.wait([fetches[url] for url in self._remote_urls(config)
+                          if url in fetches])
+        sources = SourcesHandler(self._config.get("sources"),
+                                 cache=self.download_cache,
+                                 workers=self.source_workers,
+                                 manifest_dir=self.sources_manifest_dir)
+        self._apply_step(config, "sources", sources, sources.apply_sources)
+        groups = GroupsHandler(self._config.get("groups"), resolver=resolver)
+        self._apply_step(config, "groups", groups, groups.apply_groups)
+        users = UsersHandler(self._config.get("users"), resolver=resolver)
+        self._apply_step(config, "users", users, users.apply_users)
+        files = FilesHandler(self._config.get("files"),
+                             cache=self.download_cache, resolver=resolver)
+        self._apply_step(config, "files", files, files.apply_files)
+        journal = None
+        if self.journal is not None:
+            journal = self.journal.scope(config, "commands")
+        commands = CommandsHandler(self._config.get("commands"),
+                                   resolver=resolver,
+                                   workers=self.command_workers,
+                                   journal=journal)
+        commands.apply_commands()
+        # running services are restarted when what they depend on changed
+        changes = {'packages': packages.changed, 'sources': sources.changed,
+                   'files': files.changed, 'commands': commands.changed}
+        ServicesHandler(self._config.get("services"),
+                        changes=changes).apply_services()
+
+    def _plan_config(self, config="config"):
+        """Return the actions _process_config() would take for a section.
+
+        Handlers are asked in the same order they are applied in.
         """
+        section = self._config_section(config)
+        actions = []
+        actions.extend(
+            PackagesHandler(section.get("packages")).plan_packages())
+        actions.extend(SourcesHandler(
+            section.get("sources"), cache=self.download_cache,
+            manifest_dir=self.sources_manifest_dir).plan_sources())
+        actions.extend(GroupsHandler(section.get("groups"),
+                                     resolver=self._resolver).plan_groups())
+        actions.extend(UsersHandler(section.get("users"),
+                                    resolver=self._resolver).plan_users())
+        actions.extend(FilesHandler(section.get("files"),
+                                    resolver=self._resolver).plan_files())
+        actions.extend(
+            CommandsHandler(section.get("commands")).plan_commands())
+        actions.extend(
+            ServicesHandler(section.get("services")).plan_services())
+        return {'config': config, 'actions': actions}
+
+    def _remote_urls(self, config="config"):
+        """Return the URLs of the sources and files of a config section.
 
+        Returns:
+            a dict mapping the URLs, in order, to their expected checksums
+        """
+        section = self._config_section(config)
+        urls = {}
+        if not self._step_done(config, "sources"):
+            for source in (section.get("sources") or {}).values():
+                url = SourcesHandler.source_url(source)
+                if url:
+                    urls[url] = expected_checksums(source)
+        if not self._step_done(config, "files"):
+            for meta in (section.get("files") or {}).values():
+                if 'content' not in meta and 'source' in meta:
+                    urls[meta['source']] = expected_checksums(meta)
+        return urls
+
+    def _step_done(self, config, handler):
+        """Return whether the journal shows a handler of a config done."""
+        if self.journal is None:
+            return False
+        section = self._config_section(config)
+        return self.journal.done(config, handler, None, section.get(handler))
+
+    def _apply_step(self, config, name, handler, apply):
+        """Call apply() for a handler of a config, unless already done.
+
+        The step is only journaled when nothing failed, so that the next
+        run applies it again.
+        """
+        if self._step_done(config, name):
+            LOG.info("%s of %s were applied by an earlier run, skipping" %
+                     (name, config))
+            return
+        apply()
+        if handler.failed:
+            LOG.warning("Some %s of %s could not be applied" % (name, config))
+            return
+        if self.journal is not None:
+            self.journal.record(config, name, None,
+                                self._config_section(config).get(name))
+
+    def prefetch(self, executionlist):
+        """Download the artifacts of every config in the execution list."""
+        urls = {}
+        for item in executionlist:
+            urls.update(self._remote_urls(item))
+        return self.download_cache.prefetch(list(urls), urls)
+
+    def _process_overlapped(self, executionlist):
+        """Process the execution list while downloading in the background.
+
+        Downloads only ever write to the download cache, so running them
+        alongside the package installs does not change the order of any
+        side effect on the host.
+        """
+        urls = {}
+        for item in executionlist:
+            urls.update(self._remote_urls(item))
+        pool = futures.ThreadPoolExecutor(
+            max_workers=self.download_cache.workers)
+        fetches = self.download_cache.prefetch_async(list(urls), pool, urls)
         try:
-            self._config = self._metadata[config]
-        except KeyError:
-            raise Exception("Could not find '%s' set in template, may need to"
-                            " specify another set." % config)
-        PackagesHandler(self._config.get("packages")).apply_packages()
-        SourcesHandler(self._config.get("sources")).apply_sources()
-        GroupsHandler(self._config.get("groups")).apply_groups()
-        UsersHandler(self._config.get("users")).apply_users()
-        FilesHandler(self._config.get("files")).apply_files()
-        CommandsHandler(self._config.get("commands")).apply_commands()
-        ServicesHandler(self._config.get("services")).apply_services()
-
-    def cfn_init(self):
-        """Process the resource metadata."""
+            for item in executionlist:
+                self._process_config(item, fetches)
+        finally:
+            for fetch in fetches.values():
+                fetch.cancel()
+            pool.shutdown(wait=True)
+
+    def cfn_init(self, plan=False, prefetch_only=False):
+        """Process the resource metadata.
+
+        The remote sources and files of the whole execution list are
+        downloaded into the download cache before any config is applied, or,
+        if overlap_downloads is set, while the packages are being installed.
+
+        Arguments:
+            plan          -- if True, change nothing and return a list with
+                             the actions each config section of the execution
+                             list would take, suitable for serializing as JSON
+            prefetch_only -- if True, only populate the download cache
+        """
         if not self._is_valid_metadata():
             raise Exception("invalid metadata")
         else:
             executionlist = ConfigsetsHandler(self._metadata.get("configSets"),
                                               self.configsets).get_configsets()
             if not executionlist:
-                self._process_config()
-            else:
-                for item in executionlist:
-                    self._process_config(item)
+                executionlist = ["config"]
+            # user and group names are looked up once per run
+            self._resolver = IdentityResolver()
+            if plan:
+                return [self._plan_config(item) for item in executionlist]
+            if self.overlap_downloads and not prefetch_only:
+                self._process_overlapped(executionlist)
+                return
+            self.prefetch(executionlist)
+            if prefetch_only:
+                return
+            for item in executionlist:
+                self._process_config(item)
+
+    def services_handler(self, hooks):
+        """Return a ServicesHandler for the services of local metadata.
+
+        Returns:
+            None when the metadata is not local, or could not be read
+        """
+        if not self._is_local_metadata or self._metadata is None:
+            return None
+        self._config = self._metadata.get("config", {})
+        return ServicesHandler(self._config.get("services"),
+                               resource=self.resource, hooks=hooks,
+                               restart_policy=self.restart_policy)
 
-    def cfn_hup(self, hooks):
-        """Process the resource metadata."""
+    def cfn_hup(self, hooks, monitor=True):
+        """Process the resource metadata.
+
+        The monitored services are checked once unless monitor is False,
+        which leaves them to a caller that keeps watching them itself.
+        """
         if not self._is_valid_metadata():
             LOG.debug(
                 'Metadata does not contain a %s section' % self._init_key)
 
-        if self._is_local_metadata:
-            self._config = self._metadata.get("config", {})
-            s = self._config.get("services")
-            sh = ServicesHandler(s, resource=self.resource, hooks=hooks)
-            sh.monitor_services()
+        if monitor:
+            sh = self.services_handler(hooks)
+            if sh is not None:
+                sh.monitor_services()
 
         if self._has_changed:
             for h in hooks:
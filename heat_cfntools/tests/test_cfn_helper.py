@@ -14,10 +14,27 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import base64
+import bz2
+import collections
+from concurrent import futures
+import configparser
+import functools
+import gzip
+import hashlib
+import http.server
+import io
 import json
 import os
+import re
+import socket
+import subprocess
+import tarfile
 import tempfile
+import threading
+import time
 from unittest import mock
+import zipfile
 
 import boto.cloudformation as cfn
 import fixtures
@@ -49,6 +66,92 @@ class FakePOpen(object):
         pass
 
 
+def make_tar(members, mode='w:gz'):
+    """Return a tar archive of a dict of names to bytes."""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o640
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+class HTTPServerFixture(fixtures.Fixture):
+    """Serve a dict of paths to bytes over HTTP on localhost.
+
+    Range requests are supported. The connection is dropped after the
+    number of bytes given in the truncate dict for a path, once.
+    """
+
+    def __init__(self, files=None):
+        super(HTTPServerFixture, self).__init__()
+        self.files = files or {}
+        self.truncate = {}
+
+    def _setUp(self):
+        files = self.files
+        truncate = self.truncate
+        self.requests = requests = []
+        self.headers = headers = []
+        self.clients = clients = set()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _send_empty(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                requests.append(self.path)
+                headers.append(dict(self.headers))
+                clients.add(self.client_address)
+                body = files.get(self.path)
+                if body is None:
+                    self._send_empty(404)
+                    return
+                etag = '"%s"' % hashlib.md5(body).hexdigest()
+                if self.headers.get('If-None-Match') == etag:
+                    self._send_empty(304)
+                    return
+                start = 0
+                match = re.match(r'bytes=(\d+)-$',
+                                 self.headers.get('Range', ''))
+                if match and self.headers.get('If-Range') in (None, etag):
+                    start = int(match.group(1))
+                if start:
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                        start, len(body) - 1, len(body)))
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(len(body) - start))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                if self.path in truncate:
+                    self.wfile.write(body[start:truncate.pop(self.path)])
+                    self.close_connection = True
+                    return
+                self.wfile.write(body[start:])
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      Handler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+
 @mock.patch.object(cfn_helper.pwd, 'getpwnam')
 @mock.patch.object(cfn_helper.os, 'seteuid')
 @mock.patch.object(cfn_helper.os, 'geteuid')
@@ -159,8 +262,19 @@ class TestPackages(testtools.TestCase):
 
         with mock.patch('subprocess.Popen') as mock_popen:
             mock_popen.side_effect = returns
-            cfn_helper.PackagesHandler(packages).apply_packages()
+            handler = cfn_helper.PackagesHandler(packages)
+            handler.apply_packages()
             mock_popen.assert_has_calls(calls, any_order=True)
+        self.assertEqual({'yum': {'httpd', 'wordpress', 'mysql-server'}},
+                         handler.changed)
+
+    def test_yum_installed_packages_are_unchanged(self, mock_cp):
+        packages = {"yum": {"httpd": [], "wordpress": []}}
+        with mock.patch('subprocess.Popen') as mock_popen:
+            mock_popen.return_value = FakePOpen()
+            handler = cfn_helper.PackagesHandler(packages)
+            handler.apply_packages()
+        self.assertEqual({}, handler.changed)
 
     def test_dnf_install_yum_unavailable(self, mock_cp):
 
@@ -260,6 +374,54 @@ class TestPackages(testtools.TestCase):
             cfn_helper.PackagesHandler(packages).apply_packages()
             self.assertTrue(mock_popen.called)
 
+    def test_apt_reports_newly_installed_packages(self, mock_cp):
+        packages = {"apt": {"httpd": [], "wordpress": []}}
+
+        def returns(cmd, **kwargs):
+            if cmd[0] == 'dpkg-query' and cmd[-1] == 'httpd':
+                return FakePOpen(b'install ok installed')
+            if cmd[0] == 'dpkg-query':
+                return FakePOpen(returncode=1)
+            return FakePOpen()
+
+        with mock.patch('subprocess.Popen') as mock_popen:
+            mock_popen.side_effect = returns
+            handler = cfn_helper.PackagesHandler(packages)
+            handler.apply_packages()
+        self.assertEqual({'apt': {'wordpress'}}, handler.changed)
+
+    def test_gem_reports_newly_installed_packages(self, mock_cp):
+        packages = {"rubygems": {"chef": ["0.10.2"], "rake": []}}
+
+        def returns(cmd, **kwargs):
+            if cmd[:3] == ['gem', 'list', '-i']:
+                return FakePOpen(returncode=1 if cmd[-1] == 'chef' else 0)
+            return FakePOpen()
+
+        with mock.patch('subprocess.Popen') as mock_popen:
+            mock_popen.side_effect = returns
+            handler = cfn_helper.PackagesHandler(packages)
+            handler.apply_packages()
+            mock_popen.assert_has_calls(popen_root_calls(
+                [['gem', 'list', '-i', '--version', '0.10.2', 'chef'],
+                 ['gem', 'install', '-b', '-y', '--version', '0.10.2',
+                  'chef']]), any_order=True)
+        self.assertEqual({'rubygems': {'chef'}}, handler.changed)
+
+    def test_failed_install_changes_nothing(self, mock_cp):
+        packages = {"yum": {"httpd": []}}
+
+        def returns(cmd, **kwargs):
+            if cmd[:2] == ['rpm', '-q'] or cmd[:3] == ['yum', '-y', 'install']:
+                return FakePOpen(returncode=1)
+            return FakePOpen()
+
+        with mock.patch('subprocess.Popen') as mock_popen:
+            mock_popen.side_effect = returns
+            handler = cfn_helper.PackagesHandler(packages)
+            handler.apply_packages()
+        self.assertEqual({}, handler.changed)
+
 
 @mock.patch.object(cfn_helper, 'controlled_privileges')
 class TestServicesHandler(testtools.TestCase):
@@ -269,23 +431,30 @@ class TestServicesHandler(testtools.TestCase):
         returns = []
 
         # apply_services
-        calls.append(['/bin/systemctl', 'enable', 'httpd.service'])
-        returns.append(FakePOpen())
-        calls.append(['/bin/systemctl', 'status', 'httpd.service'])
-        returns.append(FakePOpen(returncode=-1))
-        calls.append(['/bin/systemctl', 'start', 'httpd.service'])
+        show = ['/bin/systemctl', 'show', '-p', 'Id,ActiveState,UnitFileState',
+                'mysqld.service', 'httpd.service']
+        monitor = ['/bin/systemctl', 'show', '-p',
+                   'Id,ActiveState,UnitFileState,MainPID'] + show[4:]
+        calls.append(show)
+        returns.append(FakePOpen(stdout=(
+            'Id=mysqld.service\nActiveState=inactive\n'
+            'UnitFileState=disabled\n\n'
+            'Id=httpd.service\nActiveState=active\n'
+            'UnitFileState=disabled\n')))
+        calls.append(['/bin/systemctl', 'enable', 'mysqld.service',
+                      'httpd.service'])
         returns.append(FakePOpen())
-        calls.append(['/bin/systemctl', 'enable', 'mysqld.service'])
-        returns.append(FakePOpen())
-        calls.append(['/bin/systemctl', 'status', 'mysqld.service'])
-        returns.append(FakePOpen(returncode=-1))
         calls.append(['/bin/systemctl', 'start', 'mysqld.service'])
         returns.append(FakePOpen())
 
         # monitor_services not running
-        calls.append(['/bin/systemctl', 'status', 'httpd.service'])
-        returns.append(FakePOpen(returncode=-1))
-        calls.append(['/bin/systemctl', 'start', 'httpd.service'])
+        calls.append(monitor)
+        returns.append(FakePOpen(stdout=(
+            'Id=mysqld.service\nActiveState=failed\n'
+            'UnitFileState=enabled\n\n'
+            'Id=httpd.service\nActiveState=inactive\n'
+            'UnitFileState=enabled\n')))
+        calls.append(['/bin/systemctl', 'start', 'mysqld.service'])
         returns.append(FakePOpen())
 
         calls = popen_root_calls(calls)
@@ -293,23 +462,20 @@ class TestServicesHandler(testtools.TestCase):
         calls.extend(popen_root_calls(['/bin/services_restarted'], shell=True))
         returns.append(FakePOpen())
 
-        calls.extend(popen_root_calls([['/bin/systemctl', 'status',
-                                        'mysqld.service']]))
-        returns.append(FakePOpen(returncode=-1))
         calls.extend(popen_root_calls([['/bin/systemctl', 'start',
-                                        'mysqld.service']]))
+                                        'httpd.service']]))
         returns.append(FakePOpen())
 
         calls.extend(popen_root_calls(['/bin/services_restarted'], shell=True))
         returns.append(FakePOpen())
 
         # monitor_services running
-        calls.extend(popen_root_calls([['/bin/systemctl', 'status',
-                                        'httpd.service']]))
-        returns.append(FakePOpen())
-        calls.extend(popen_root_calls([['/bin/systemctl', 'status',
-                                        'mysqld.service']]))
-        returns.append(FakePOpen())
+        calls.extend(popen_root_calls([monitor]))
+        returns.append(FakePOpen(stdout=(
+            'Id=mysqld.service\nActiveState=active\n'
+            'UnitFileState=enabled\n\n'
+            'Id=httpd.service\nActiveState=active\n'
+            'UnitFileState=enabled\n')))
 
         services = {
             "systemd": {
@@ -344,13 +510,22 @@ class TestServicesHandler(testtools.TestCase):
     def test_services_handler_systemd_disabled(self, mock_cp):
         calls = []
 
+        returns = []
+
         # apply_services
-        calls.append(['/bin/systemctl', 'disable', 'httpd.service'])
-        calls.append(['/bin/systemctl', 'status', 'httpd.service'])
-        calls.append(['/bin/systemctl', 'stop', 'httpd.service'])
-        calls.append(['/bin/systemctl', 'disable', 'mysqld.service'])
-        calls.append(['/bin/systemctl', 'status', 'mysqld.service'])
+        calls.append(['/bin/systemctl', 'show', '-p',
+                      'Id,ActiveState,UnitFileState',
+                      'mysqld.service', 'httpd.service'])
+        returns.append(FakePOpen(stdout=(
+            'Id=mysqld.service\nActiveState=active\n'
+            'UnitFileState=enabled\n\n'
+            'Id=httpd.service\nActiveState=inactive\n'
+            'UnitFileState=enabled\n')))
+        calls.append(['/bin/systemctl', 'disable', 'mysqld.service',
+                      'httpd.service'])
+        returns.append(FakePOpen())
         calls.append(['/bin/systemctl', 'stop', 'mysqld.service'])
+        returns.append(FakePOpen())
         calls = popen_root_calls(calls)
 
         services = {
@@ -370,10 +545,11 @@ class TestServicesHandler(testtools.TestCase):
         with mock.patch('os.path.exists') as mock_exists:
             mock_exists.return_value = True
             with mock.patch('subprocess.Popen') as mock_popen:
-                mock_popen.return_value = FakePOpen()
+                mock_popen.side_effect = returns
                 sh = cfn_helper.ServicesHandler(services, 'resource1', hooks)
                 sh.apply_services()
-                mock_popen.assert_has_calls(calls, any_order=True)
+                mock_popen.assert_has_calls(calls)
+                self.assertEqual(3, mock_popen.call_count)
             mock_exists.assert_called_with('/bin/systemctl')
 
     def test_services_handler_sysv_service_chkconfig(self, mock_cp):
@@ -480,16 +656,24 @@ class TestServicesHandler(testtools.TestCase):
         returns = []
 
         # apply_services
+        show = ['/bin/systemctl', 'show', '-p', 'Id,ActiveState,UnitFileState',
+                'httpd.service']
+        monitor = ['/bin/systemctl', 'show', '-p',
+                   'Id,ActiveState,UnitFileState,MainPID'] + show[4:]
+        calls.append(show)
+        returns.append(FakePOpen(stdout=b'Id=httpd.service\n'
+                                        b'ActiveState=inactive\n'
+                                        b'UnitFileState=disabled\n'))
         calls.append(['/bin/systemctl', 'enable', 'httpd.service'])
         returns.append(FakePOpen())
-        calls.append(['/bin/systemctl', 'status', 'httpd.service'])
-        returns.append(FakePOpen(returncode=-1))
         calls.append(['/bin/systemctl', 'start', 'httpd.service'])
         returns.append(FakePOpen())
 
         # monitor_services not running
-        calls.append(['/bin/systemctl', 'status', 'httpd.service'])
-        returns.append(FakePOpen(returncode=-1))
+        calls.append(monitor)
+        returns.append(FakePOpen(stdout=b'Id=httpd.service\n'
+                                        b'ActiveState=inactive\n'
+                                        b'UnitFileState=enabled\n'))
         calls.append(['/bin/systemctl', 'start', 'httpd.service'])
         returns.append(FakePOpen())
 
@@ -501,9 +685,10 @@ class TestServicesHandler(testtools.TestCase):
         calls.extend(popen_root_calls(shell_calls, shell=True))
 
         # monitor_services running
-        calls.extend(popen_root_calls([['/bin/systemctl', 'status',
-                                        'httpd.service']]))
-        returns.append(FakePOpen())
+        calls.extend(popen_root_calls([monitor]))
+        returns.append(FakePOpen(stdout=b'Id=httpd.service\n'
+                                        b'ActiveState=active\n'
+                                        b'UnitFileState=enabled\n'))
 
         services = {
             "sysvinit": {
@@ -536,10 +721,18 @@ class TestServicesHandler(testtools.TestCase):
     def test_services_handler_sysv_disabled_systemctl(self, mock_cp):
         calls = []
 
+        returns = []
+
         # apply_services
+        calls.append(['/bin/systemctl', 'show', '-p',
+                      'Id,ActiveState,UnitFileState', 'httpd.service'])
+        returns.append(FakePOpen(stdout=b'Id=httpd.service\n'
+                                        b'ActiveState=active\n'
+                                        b'UnitFileState=enabled\n'))
         calls.append(['/bin/systemctl', 'disable', 'httpd.service'])
-        calls.append(['/bin/systemctl', 'status', 'httpd.service'])
+        returns.append(FakePOpen())
         calls.append(['/bin/systemctl', 'stop', 'httpd.service'])
+        returns.append(FakePOpen())
 
         calls = popen_root_calls(calls)
 
@@ -560,7 +753,7 @@ class TestServicesHandler(testtools.TestCase):
         with mock.patch('os.path.exists') as mock_exists:
             mock_exists.return_value = True
             with mock.patch('subprocess.Popen') as mock_popen:
-                mock_popen.return_value = FakePOpen()
+                mock_popen.side_effect = returns
                 sh = cfn_helper.ServicesHandler(services, 'resource1', hooks)
                 sh.apply_services()
                 mock_popen.assert_has_calls(calls)
@@ -665,6 +858,432 @@ class TestServicesHandler(testtools.TestCase):
             mock_exists.assert_any_call('/sbin/service')
             mock_exists.assert_any_call('/sbin/chkconfig')
 
+    def test_services_in_desired_state_are_left_alone(self, mock_cp):
+        services = {
+            "systemd": {
+                "httpd": {"enabled": "true", "ensureRunning": "true"},
+                "dbus": {"enabled": "true", "ensureRunning": "true"},
+                "cups": {"enabled": "false", "ensureRunning": "false"}
+            }
+        }
+        state = FakePOpen(stdout=(
+            'Id=httpd.service\nActiveState=active\n'
+            'UnitFileState=enabled\n\n'
+            'Id=dbus.service\nActiveState=active\n'
+            'UnitFileState=static\n\n'
+            'Id=cups.service\nActiveState=inactive\n'
+            'UnitFileState=disabled\n'))
+        with mock.patch('os.path.exists', return_value=True):
+            with mock.patch('subprocess.Popen') as mock_popen:
+                mock_popen.return_value = state
+                sh = cfn_helper.ServicesHandler(services)
+                sh.apply_services()
+                self.assertEqual(1, mock_popen.call_count)
+                plan = sh.plan_services()
+        self.assertEqual(
+            ['enabled', 'running', 'enabled', 'running', 'disabled',
+             'stopped'],
+            [entry['reason'] for entry in plan])
+
+    def test_services_restart_on_changed_dependencies(self, mock_cp):
+        services = {
+            "systemd": {
+                "httpd": {"ensureRunning": "true",
+                          "files": ["/etc/httpd/conf/httpd.conf"],
+                          "packages": {"yum": ["mod_ssl"]}},
+                "nginx": {"ensureRunning": "true",
+                          "sources": ["/var/www/"],
+                          "commands": ["01_migrate"]},
+                "sshd": {"ensureRunning": "true",
+                         "files": ["/etc/ssh/sshd_config"]},
+                "cron": {"ensureRunning": "true",
+                         "files": ["/etc/crontab"]}
+            }
+        }
+        changes = {'files': {'/etc/httpd/conf/httpd.conf', '/etc/crontab'},
+                   'sources': {'/var/www'}, 'commands': set(),
+                   'packages': {'yum': {'mod_ssl'}}}
+        returns = [FakePOpen(stdout=(
+            'ActiveState=active\n\nActiveState=active\n\n'
+            'ActiveState=active\n\nActiveState=inactive\n')),
+            FakePOpen(), FakePOpen()]
+        with mock.patch('os.path.exists', return_value=True):
+            with mock.patch('subprocess.Popen') as mock_popen:
+                mock_popen.side_effect = returns
+                sh = cfn_helper.ServicesHandler(services, changes=changes)
+                sh.apply_services()
+        # cron is started anyway, sshd did not change
+        mock_popen.assert_has_calls(popen_root_calls([
+            ['/bin/systemctl', 'start', 'cron.service'],
+            ['/bin/systemctl', 'restart', 'httpd.service', 'nginx.service']]))
+        self.assertEqual(3, mock_popen.call_count)
+
+    def test_failed_batch_is_retried_one_unit_at_a_time(self, mock_cp):
+        services = {
+            "systemd": {
+                "httpd": {"enabled": "true"},
+                "missing": {"enabled": "true"}
+            }
+        }
+        returns = [FakePOpen(stdout=(
+            'Id=httpd.service\nActiveState=inactive\n'
+            'UnitFileState=disabled\n\n'
+            'Id=missing.service\nActiveState=inactive\n'
+            'UnitFileState=\n')),
+            FakePOpen(returncode=1), FakePOpen(), FakePOpen(returncode=1)]
+        with mock.patch('os.path.exists', return_value=True):
+            with mock.patch('subprocess.Popen') as mock_popen:
+                mock_popen.side_effect = returns
+                cfn_helper.ServicesHandler(services).apply_services()
+        mock_popen.assert_has_calls(popen_root_calls([
+            ['/bin/systemctl', 'enable', 'httpd.service',
+             'missing.service'],
+            ['/bin/systemctl', 'enable', 'httpd.service'],
+            ['/bin/systemctl', 'enable', 'missing.service']]))
+        self.assertEqual(4, mock_popen.call_count)
+
+    def test_sysv_service_restart(self, mock_cp):
+        services = {"sysvinit": {"httpd": {"ensureRunning": "true",
+                                           "commands": ["reconfigure"]}}}
+        changes = {'commands': {'reconfigure'}}
+        with mock.patch('os.path.exists', return_value=False):
+            with mock.patch('subprocess.Popen') as mock_popen:
+                mock_popen.return_value = FakePOpen()
+                sh = cfn_helper.ServicesHandler(services, changes=changes)
+                sh.apply_services()
+        mock_popen.assert_has_calls(popen_root_calls([
+            ['/usr/sbin/service', 'httpd', 'status'],
+            ['/usr/sbin/service', 'httpd', 'restart']]))
+
+    def test_init_system_detected_once(self, mock_cp):
+        services = {
+            "sysvinit": {
+                "httpd": {"enabled": "true", "ensureRunning": "true"},
+                "sshd": {"enabled": "true", "ensureRunning": "true"}
+            }
+        }
+        with mock.patch('os.path.exists') as mock_exists:
+            mock_exists.side_effect = lambda path: path != '/bin/systemctl'
+            with mock.patch('subprocess.Popen') as mock_popen:
+                mock_popen.return_value = FakePOpen()
+                sh = cfn_helper.ServicesHandler(services)
+                sh.apply_services()
+                sh.monitor_services()
+            self.assertEqual(3, mock_exists.call_count)
+            # sysvinit has no batched query, so each service is checked
+            mock_popen.assert_has_calls(popen_root_calls([
+                ['/sbin/service', 'httpd', 'status'],
+                ['/sbin/service', 'sshd', 'status']]))
+
+    def test_monitor_falls_back_to_status(self, mock_cp):
+        services = {
+            "systemd": {
+                "httpd": {"ensureRunning": "true"},
+                "sshd": {"ensureRunning": "true"}
+            }
+        }
+        returns = [FakePOpen(returncode=1, stderr='no bus'),
+                   FakePOpen(), FakePOpen()]
+        with mock.patch('os.path.exists', return_value=True):
+            with mock.patch('subprocess.Popen') as mock_popen:
+                mock_popen.side_effect = returns
+                sh = cfn_helper.ServicesHandler(services, 'resource1', [])
+                sh.monitor_services()
+        mock_popen.assert_has_calls(popen_root_calls([
+            ['/bin/systemctl', 'show', '-p',
+             'Id,ActiveState,UnitFileState,MainPID',
+             'httpd.service', 'sshd.service'],
+            ['/bin/systemctl', 'status', 'httpd.service'],
+            ['/bin/systemctl', 'status', 'sshd.service']]))
+        self.assertEqual(3, mock_popen.call_count)
+
+
+class FakeWatcher(object):
+    name = 'fake'
+
+    def __init__(self, wakeups):
+        self.wakeups = list(wakeups)
+        self.waits = []
+
+    def wait(self, pids, timeout):
+        self.waits.append((pids, timeout))
+        return self.wakeups.pop(0)
+
+
+@mock.patch.object(cfn_helper, 'controlled_privileges')
+class TestServiceWatcher(testtools.TestCase):
+
+    def test_watch_restarts_exited_service(self, mock_cp):
+        services = {
+            "systemd": {
+                "httpd": {"ensureRunning": "true"},
+                "cron": {"ensureRunning": "true"}
+            }
+        }
+        hooks = [
+            cfn_helper.Hook(
+                'hook1',
+                'service.restarted',
+                'Resources.resource1.Metadata',
+                'root',
+                '/bin/services_restarted')
+        ]
+        state = ['show', '-p', 'Id,ActiveState,UnitFileState,MainPID',
+                 'httpd.service', 'cron.service']
+        pids = ['show', '-p', 'MainPID', 'httpd.service']
+        outputs = {
+            tuple(state): [
+                'ActiveState=active\nMainPID=101\n\n'
+                'ActiveState=active\nMainPID=0\n',
+                'ActiveState=failed\nMainPID=0\n\n'
+                'ActiveState=active\nMainPID=0\n'],
+            # only the restarted service is queried again
+            tuple(pids): ['MainPID=102\n'],
+        }
+
+        def popen(cmd, **kwargs):
+            if tuple(cmd[1:]) in outputs:
+                return FakePOpen(stdout=outputs[tuple(cmd[1:])].pop(0))
+            return FakePOpen()
+
+        watcher = FakeWatcher([[('resource1', 'httpd')], []])
+        with mock.patch('os.path.exists', return_value=True):
+            with mock.patch('subprocess.Popen') as mock_popen:
+                mock_popen.side_effect = popen
+                sh = cfn_helper.ServicesHandler(services, 'resource1', hooks)
+                cfn_helper.watch_services(
+                    [sh], watcher, interval=30,
+                    until=lambda: not watcher.wakeups)
+        # cron has no main process, so only httpd is watched
+        self.assertEqual([({('resource1', 'httpd'): 101}, 30),
+                          ({('resource1', 'httpd'): 102}, 30)],
+                         watcher.waits)
+        mock_popen.assert_has_calls(popen_root_calls(
+            [['/bin/systemctl', 'start', 'httpd.service']]) +
+            popen_root_calls(['/bin/services_restarted'], shell=True))
+        self.assertEqual(5, mock_popen.call_count)
+
+    def test_poll_on_its_own_schedule(self, mock_cp):
+        clock = [0]
+
+        class ClockWatcher(FakeWatcher):
+            def wait(self, pids, timeout):
+                self.waits.append(timeout)
+                clock[0] += timeout
+                return []
+
+        old = mock.Mock(resource='r1')
+        old.service_pids.return_value = {}
+        new = mock.Mock(resource='r1')
+        new.service_pids.return_value = {}
+        poll = mock.Mock(return_value=[new])
+        watcher = ClockWatcher([])
+        with mock.patch('time.monotonic', lambda: clock[0]):
+            cfn_helper.watch_services(
+                [old], watcher, interval=10, poll=poll, poll_interval=25,
+                until=lambda: len(watcher.waits) >= 7)
+        self.assertEqual([10, 10, 5, 10, 10, 5, 10], watcher.waits)
+        self.assertEqual(2, poll.call_count)
+        self.assertEqual(3, old.monitor_services.call_count)
+        self.assertEqual(4, new.monitor_services.call_count)
+
+    def test_unreadable_metadata_has_no_services(self, mock_cp):
+        md = cfn_helper.Metadata('teststack', 'resource1')
+        self.assertIsNone(md.services_handler([]))
+        md.retrieve(meta_str={'config': {'services': {}}}, save_cache=False)
+        self.assertEqual('resource1', md.services_handler([]).resource)
+
+    def test_sysv_pidfile(self, mock_cp):
+        pidfile = self.useFixture(fixtures.TempDir()).join('%s.pid')
+        with open(pidfile % 'httpd', 'w') as f:
+            f.write('4242\n')
+        services = {
+            "sysvinit": {
+                "httpd": {"ensureRunning": "true"},
+                "sshd": {"ensureRunning": "true"},
+                "cups": {"ensureRunning": "false"}
+            }
+        }
+        sh = cfn_helper.ServicesHandler(services)
+        sh._pidfiles = (pidfile,)
+        with mock.patch('os.path.exists', return_value=False):
+            self.assertEqual({'httpd': 4242}, sh.service_pids())
+
+    def test_pidfd_watcher(self, mock_cp):
+        if not cfn_helper.PidfdWatcher.supported():
+            self.skipTest('pidfd is not supported')
+        proc = subprocess.Popen(['sleep', '30'])
+        self.addCleanup(proc.wait)
+        watcher = cfn_helper.service_watcher()
+        self.assertEqual('pidfd', watcher.name)
+        self.assertEqual([], watcher.wait({'sleep': proc.pid}, 0.05))
+        threading.Timer(0.05, proc.kill).start()
+        start = time.monotonic()
+        self.assertEqual(['sleep'], watcher.wait({'sleep': proc.pid}, 10))
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_unknown_watcher(self, mock_cp):
+        self.assertRaises(ValueError, cfn_helper.service_watcher, 'inotify')
+        self.assertEqual('poll', cfn_helper.service_watcher('poll').name)
+
+
+class TestRestartPolicy(testtools.TestCase):
+
+    def setUp(self):
+        super(TestRestartPolicy, self).setUp()
+        self.state_path = self.useFixture(fixtures.TempDir()).join(
+            'restarts.json')
+
+    def test_backoff_and_give_up(self):
+        policy = cfn_helper.RestartPolicy(max_restarts=3, window=60,
+                                          backoff=10,
+                                          state_path=self.state_path)
+        decisions = [policy.stopped('r/httpd', now=t)
+                     for t in (0, 5, 10, 15, 30, 31, 100)]
+        self.assertEqual(['restart', 'wait', 'restart', 'wait', 'restart',
+                          'give-up', 'failed'], decisions)
+
+        # the state survives the policy, and a running service is forgiven
+        policy = cfn_helper.RestartPolicy(state_path=self.state_path)
+        self.assertEqual('failed', policy.status()['r/httpd']['state'])
+        policy.running('r/httpd', now=200)
+        self.assertEqual({}, cfn_helper.RestartPolicy(
+            state_path=self.state_path).status())
+        self.assertEqual('restart', policy.stopped('r/httpd', now=201))
+
+    def test_old_restarts_are_forgotten(self):
+        policy = cfn_helper.RestartPolicy(max_restarts=2, window=60,
+                                          backoff=10,
+                                          state_path=self.state_path)
+        self.assertEqual('restart', policy.stopped('r/httpd', now=0))
+        self.assertEqual('restart', policy.stopped('r/httpd', now=50))
+        policy.running('r/httpd', now=70)
+        self.assertEqual([50], policy.status()['r/httpd']['restarts'])
+        self.assertEqual('restart', policy.stopped('r/httpd', now=80))
+
+    def test_from_config(self):
+        config = configparser.ConfigParser()
+        config.read_string('[main]\nrestart-limit = 2\n')
+        policy = cfn_helper.RestartPolicy.from_config(config)
+        self.assertEqual((2, 300, 10),
+                         (policy.max_restarts, policy.window, policy.backoff))
+
+    @mock.patch.object(cfn_helper, 'controlled_privileges')
+    def test_monitor_gives_up(self, mock_cp):
+        services = {"sysvinit": {"httpd": {"ensureRunning": "true"}}}
+        hooks = [
+            cfn_helper.Hook('failed', 'service.failed',
+                            'Resources.resource1.Metadata', 'root',
+                            '/bin/service_failed'),
+            cfn_helper.Hook('restarted', 'service.restarted',
+                            'Resources.resource1.Metadata', 'root',
+                            '/bin/service_restarted'),
+        ]
+        policy = cfn_helper.RestartPolicy(max_restarts=1, backoff=0,
+                                          state_path=self.state_path)
+        with mock.patch('os.path.exists', return_value=False):
+            with mock.patch('subprocess.Popen') as mock_popen:
+                mock_popen.return_value = FakePOpen(returncode=3)
+                sh = cfn_helper.ServicesHandler(services, 'resource1', hooks,
+                                                restart_policy=policy)
+                for i in range(3):
+                    sh.monitor_services()
+        shell_calls = [c[0][0] for c in mock_popen.call_args_list
+                       if c[1]['shell']]
+        self.assertEqual(['/bin/service_restarted', '/bin/service_failed'],
+                         shell_calls)
+        mock_popen.assert_has_calls(popen_root_calls(
+            [['/usr/sbin/service', 'httpd', 'start']]))
+
+
+class TestReadinessProbe(testtools.TestCase):
+
+    def setUp(self):
+        super(TestReadinessProbe, self).setUp()
+        self.tdir = self.useFixture(fixtures.TempDir())
+
+    def test_tcp(self):
+        listener = socket.socket()
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        port = listener.getsockname()[1]
+        probe = cfn_helper.ReadinessProbe('a', {'tcp': port})
+        self.assertEqual(('127.0.0.1', port), probe.address)
+        self.assertTrue(probe.ready())
+        listener.close()
+        probe = cfn_helper.ReadinessProbe(
+            'a', {'tcp': '127.0.0.1:%d' % port, 'timeout': 0.2,
+                  'interval': 0.05})
+        self.assertFalse(probe.wait())
+
+    def test_http(self):
+        server = self.useFixture(HTTPServerFixture({'/health': b'ok'}))
+        probe = cfn_helper.ReadinessProbe(
+            'a', {'http': server.url + '/health'})
+        self.assertTrue(probe.ready())
+        probe = cfn_helper.ReadinessProbe(
+            'a', {'http': server.url + '/health', 'status': [204]})
+        self.assertFalse(probe.ready())
+        probe = cfn_helper.ReadinessProbe(
+            'a', {'http': server.url + '/missing', 'status': 404})
+        self.assertTrue(probe.ready())
+
+    def test_invalid(self):
+        self.assertRaises(cfn_helper.ServiceNotReadyError,
+                          cfn_helper.ReadinessProbe, 'a', {'tcp': 'host:x'})
+        self.assertRaises(cfn_helper.ServiceNotReadyError,
+                          cfn_helper.ReadinessProbe, 'a', 'tcp')
+
+    @mock.patch.object(cfn_helper, 'controlled_privileges')
+    def test_services_are_awaited_together(self, mock_cp):
+        ready = os.path.join(self.tdir.path, 'ready')
+        services = {
+            "sysvinit": {
+                "app": {"ensureRunning": "true",
+                        "readiness": {"file": ready, "interval": 0.01}},
+                "worker": {"ensureRunning": "true",
+                           "readiness": {"file": ready, "interval": 0.01}},
+                "cron": {"ensureRunning": "false",
+                         "readiness": {"file": ready, "timeout": 0}}
+            }
+        }
+        threading.Timer(0.1, lambda: open(ready, 'w').close()).start()
+        real_wait = cfn_helper.ReadinessProbe.wait
+        with mock.patch.object(cfn_helper.ServicesHandler, '_init_system',
+                               return_value=('/usr/sbin/service',
+                                             '/usr/sbin/update-rc.d')):
+            with mock.patch('subprocess.Popen') as mock_popen:
+                mock_popen.return_value = FakePOpen(returncode=3)
+                with mock.patch.object(cfn_helper.ReadinessProbe, 'wait',
+                                       autospec=True,
+                                       side_effect=real_wait) as mock_wait:
+                    cfn_helper.ServicesHandler(services).apply_services()
+        self.assertEqual(['app', 'worker'],
+                         sorted(c[0][0].service
+                                for c in mock_wait.call_args_list))
+
+    @mock.patch.object(cfn_helper, 'controlled_privileges')
+    def test_service_not_ready(self, mock_cp):
+        services = {
+            "sysvinit": {
+                "app": {"ensureRunning": "true",
+                        "readiness": {"file": '/nonexistent', "timeout": 0}}
+            }
+        }
+        with mock.patch.object(cfn_helper.ServicesHandler, '_init_system',
+                               return_value=('/usr/sbin/service',
+                                             '/usr/sbin/update-rc.d')):
+            with mock.patch('subprocess.Popen') as mock_popen:
+                mock_popen.return_value = FakePOpen()
+                sh = cfn_helper.ServicesHandler(services)
+                e = self.assertRaises(cfn_helper.ServiceNotReadyError,
+                                      sh.apply_services)
+                self.assertEqual('Services not ready: app', str(e))
+                self.assertEqual(
+                    {'handler': 'services', 'item': 'app', 'action': 'wait',
+                     'timeout': 0.0}, sh.plan_services()[-1])
+
 
 class TestHupConfig(testtools.TestCase):
 
@@ -683,6 +1302,8 @@ credential-file=%s''' % fcreds.name).encode('UTF-8'))
             '{stack: teststack, credential_file: %s, '
             'region: nova, interval:10}' % fcreds.name,
             str(mainconfig))
+        self.assertEqual('auto', mainconfig.service_watcher)
+        self.assertEqual(10, mainconfig.monitor_interval)
         main_conf.close()
 
         main_conf = tempfile.NamedTemporaryFile()
@@ -790,6 +1411,178 @@ interval=120''' % fcreds.name).encode('UTF-8'))
             main_conf.close()
             mock_popen.assert_has_calls(calls)
 
+    def test_mirrors_section(self):
+        fcreds = self.useFixture(fixtures.TempDir())
+        creds = os.path.join(fcreds.path, 'creds')
+        with open(creds, 'w') as f:
+            f.write('AWSAccessKeyId=foo\nAWSSecretKey=bar\n')
+        conf = io.StringIO('''[main]
+stack=teststack
+credential-file=%s
+
+[mirrors]
+artifacts = http://artifacts.example.com/
+            http://mirror1.example.com/a/, http://mirror2.example.com/a/
+
+[hook1]
+triggers=post.update
+path=Resources.resource1.Metadata
+action=/bin/hook1
+runas=root
+''' % creds)
+        mainconfig = cfn_helper.HupConfig([conf])
+        self.assertEqual(['hook1'], [hook.name for hook in mainconfig.hooks])
+        self.assertEqual(
+            ['http://mirror1.example.com/a/x.tgz',
+             'http://mirror2.example.com/a/x.tgz',
+             'http://artifacts.example.com/x.tgz'],
+            mainconfig.mirrors.candidates(
+                'http://artifacts.example.com/x.tgz'))
+
+
+class TestMirrorMap(testtools.TestCase):
+
+    def test_candidates(self):
+        mirrors = cfn_helper.MirrorMap({
+            'http://example.com/': ['http://m1/', 'http://m2/'],
+            'http://example.com/big/': ['http://big/']})
+        self.assertEqual(['http://m1/a', 'http://m2/a',
+                          'http://example.com/a'],
+                         mirrors.candidates('http://example.com/a'))
+        self.assertEqual(['http://big/b', 'http://example.com/big/b'],
+                         mirrors.candidates('http://example.com/big/b'))
+        self.assertEqual(['http://other/a'],
+                         mirrors.candidates('http://other/a'))
+
+    def test_failed_mirror_is_skipped_for_a_while(self):
+        mirrors = cfn_helper.MirrorMap(
+            {'http://example.com/': ['http://m1/', 'http://m2/']},
+            cooldown=60)
+        with mock.patch('time.monotonic', return_value=1000):
+            mirrors.failed('http://m1/a')
+            self.assertEqual(['http://m2/b', 'http://example.com/b'],
+                             mirrors.candidates('http://example.com/b'))
+        with mock.patch('time.monotonic', return_value=1061):
+            self.assertEqual(['http://m1/b', 'http://m2/b',
+                              'http://example.com/b'],
+                             mirrors.candidates('http://example.com/b'))
+
+    def test_client_falls_back_to_origin(self):
+        origin = self.useFixture(HTTPServerFixture({'/a': b'origin a',
+                                                    '/b': b'origin b'}))
+        mirror = self.useFixture(HTTPServerFixture({'/m/a': b'mirror a'}))
+        down = self.useFixture(HTTPServerFixture())
+        down_url = down.url
+        down.server.shutdown()
+        down.server.server_close()
+        mirrors = cfn_helper.MirrorMap({
+            origin.url + '/': [down_url + '/', mirror.url + '/m/']})
+        client = cfn_helper.HttpClient(mirrors=mirrors)
+
+        with client.get(origin.url + '/a') as resp:
+            self.assertEqual(b'mirror a', resp.read())
+        # the mirror does not have b
+        with client.get(origin.url + '/b') as resp:
+            self.assertEqual(b'origin b', resp.read())
+        self.assertEqual(['/b'], origin.requests)
+        # the mirror which is down is not tried again
+        self.assertEqual([mirror.url + '/m/c', origin.url + '/c'],
+                         mirrors.candidates(origin.url + '/c'))
+
+    @mock.patch.object(cfn_helper, 'controlled_privileges')
+    def test_nova_meta_from_mirror(self, mock_cp):
+        tdir = self.useFixture(fixtures.TempDir())
+        cache_path = os.path.join(tdir.path, 'meta_data.json')
+        mirrors = cfn_helper.MirrorMap({
+            'http://169.254.169.254/': ['http://m1/', 'http://m2/']})
+
+        def curl(cmd, *args, **kwargs):
+            if cmd[-1].startswith('http://m2/'):
+                with open(cache_path, 'w') as f:
+                    f.write('{"uuid": "foo"}')
+                return FakePOpen('Downloaded')
+            return FakePOpen('', 'Failed', 22)
+
+        with mock.patch('subprocess.Popen') as mock_popen:
+            mock_popen.side_effect = curl
+            md = cfn_helper.Metadata('teststack', None, mirrors=mirrors)
+            self.assertEqual({'uuid': 'foo'},
+                             md.get_nova_meta(cache_path=cache_path))
+        self.assertEqual(
+            [['curl', '-f', '-o', cache_path,
+              'http://m1/openstack/2012-08-10/meta_data.json'],
+             ['curl', '-f', '-o', cache_path,
+              'http://m2/openstack/2012-08-10/meta_data.json']],
+            [c[0][0] for c in mock_popen.call_args_list])
+
+
+class TestDownloadScheduler(testtools.TestCase):
+
+    def test_from_config(self):
+        config = configparser.ConfigParser()
+        config.read_string('''[main]
+download-concurrency = 2
+download-rate = 1.5M
+''')
+        scheduler = cfn_helper.DownloadScheduler.from_config(config)
+        self.assertEqual(4, scheduler.max_per_host)
+        self.assertEqual(1572864, scheduler.rate)
+        self.assertEqual(1572864, scheduler.burst)
+
+        config.set('main', 'download-rate', 'fast')
+        scheduler = cfn_helper.DownloadScheduler.from_config(config)
+        self.assertIsNone(scheduler.rate)
+
+    def test_concurrency_limits(self):
+        scheduler = cfn_helper.DownloadScheduler(max_downloads=3,
+                                                 max_per_host=2)
+        running = collections.Counter()
+        peaks = collections.Counter()
+        lock = threading.Lock()
+
+        def download(url):
+            with scheduler.slot(url):
+                host = url.split('/')[2]
+                with lock:
+                    running[host] += 1
+                    running['all'] += 1
+                    for key in (host, 'all'):
+                        peaks[key] = max(peaks[key], running[key])
+                time.sleep(0.01)
+                with lock:
+                    running[host] -= 1
+                    running['all'] -= 1
+
+        urls = ['http://%s/%d' % (host, i)
+                for host in ('a', 'b') for i in range(6)]
+        with futures.ThreadPoolExecutor(max_workers=12) as pool:
+            list(pool.map(download, urls))
+        self.assertEqual(3, peaks['all'])
+        self.assertEqual(2, peaks['a'])
+        self.assertEqual(2, peaks['b'])
+
+    def test_throttle(self):
+        scheduler = cfn_helper.DownloadScheduler(rate=1000)
+        with mock.patch('time.monotonic', return_value=scheduler._stamp), \
+                mock.patch('time.sleep') as mock_sleep:
+            # the first second worth of data goes through
+            scheduler.throttle(1000)
+            self.assertFalse(mock_sleep.called)
+            scheduler.throttle(500)
+            mock_sleep.assert_called_once_with(0.5)
+
+    def test_client_reads_are_throttled(self):
+        server = self.useFixture(HTTPServerFixture({'/a': b'x' * 3000}))
+        scheduler = mock.Mock(rate=None)
+        scheduler.acquire.return_value = mock.sentinel.slot
+        client = cfn_helper.HttpClient(scheduler=scheduler)
+        with client.get(server.url + '/a') as resp:
+            scheduler.acquire.assert_called_once_with(server.url + '/a')
+            self.assertFalse(scheduler.release.called)
+            self.assertEqual(3000, len(resp.read()))
+        scheduler.throttle.assert_called_once_with(3000)
+        scheduler.release.assert_called_once_with(mock.sentinel.slot)
+
 
 class TestCfnHelper(testtools.TestCase):
 
@@ -1312,106 +2105,1387 @@ class TestCfnInit(testtools.TestCase):
             md.cfn_init()
             mock_popen.assert_has_calls(calls)
 
+    @mock.patch.object(cfn_helper, 'controlled_privileges')
+    def test_cfn_init_resumes_from_journal(self, mock_cp):
+        path = os.path.join(self.tdir.path, 'journal.json')
+        foo = os.path.join(self.tdir.path, 'foo')
+        md_data = {"AWS::CloudFormation::Init": {"config": {
+            "files": {foo: {"content": "bar"}},
+            "commands": {"00_foo": {"command": "/bin/command1"},
+                         "01_bar": {"command": "/bin/command2"}}}}}
+
+        def run(journal, returns, error=None):
+            with mock.patch('subprocess.Popen') as mock_popen:
+                mock_popen.side_effect = returns
+                md = cfn_helper.Metadata('teststack', None, journal=journal)
+                self.assertTrue(
+                    md.retrieve(meta_str=md_data, last_path=self.last_file))
+                if error:
+                    self.assertRaises(error, md.cfn_init)
+                else:
+                    md.cfn_init()
+            return [c[1][0] for c in mock_popen.mock_calls if c[0] == '']
 
-class TestSourcesHandler(testtools.TestCase):
-    def test_apply_sources_empty(self):
-        sh = cfn_helper.SourcesHandler({})
-        sh.apply_sources()
+        self.assertEqual(
+            ['/bin/command1', '/bin/command2'],
+            run(cfn_helper.Journal(path),
+                [FakePOpen(), FakePOpen('', 'error', 1)],
+                cfn_helper.CommandsHandlerRunError))
+        with open(foo, 'w') as f:
+            f.write('changed')
+
+        self.assertEqual(
+            ['/bin/command2'],
+            run(cfn_helper.Journal(path, resume=True), [FakePOpen()]))
+        self.assertThat(foo, ttm.FileContains('changed'))
+
+        md_data["AWS::CloudFormation::Init"]["config"]["files"][foo] = {
+            "content": "baz"}
+        self.assertEqual(
+            [], run(cfn_helper.Journal(path, resume=True), []))
+        self.assertThat(foo, ttm.FileContains('baz'))
+
+    def test_cfn_init_does_not_journal_failed_steps(self):
+        server = self.useFixture(HTTPServerFixture())
+        path = os.path.join(self.tdir.path, 'journal.json')
+        foo = os.path.join(self.tdir.path, 'foo')
+        bar = os.path.join(self.tdir.path, 'bar')
+        files = {foo: {"source": server.url + '/foo'},
+                 bar: {"content": "bar"}}
+        md_data = {"AWS::CloudFormation::Init": {"config": {"files": files}}}
+        cache = cfn_helper.DownloadCache(
+            cache_dir=os.path.join(self.tdir.path, 'cache'))
+
+        def run():
+            md = cfn_helper.Metadata('teststack', None, download_cache=cache,
+                                     journal=cfn_helper.Journal(path,
+                                                                resume=True))
+            self.assertTrue(
+                md.retrieve(meta_str=md_data, last_path=self.last_file))
+            md.cfn_init()
+            journal = cfn_helper.Journal(path, resume=True)
+            return journal.done('config', 'files', None, files)
+
+        self.assertFalse(run())
+        self.assertFalse(os.path.exists(foo))
+        self.assertThat(bar, ttm.FileContains('bar'))
+
+        server.files['/foo'] = b'foo'
+        self.assertTrue(run())
+        self.assertThat(foo, ttm.FileContains('foo'))
+
+
+class TestJournal(testtools.TestCase):
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.tdir = self.useFixture(fixtures.TempDir())
+        self.path = os.path.join(self.tdir.path, 'journal.json')
+
+    def test_resume(self):
+        journal = cfn_helper.Journal(self.path)
+        journal.record('config', 'files', None, {'/a': {'content': 'a'}})
+        self.assertFalse(
+            journal.done('config', 'files', None, {'/a': {'content': 'a'}}))
+
+        journal = cfn_helper.Journal(self.path, resume=True)
+        self.assertTrue(
+            journal.done('config', 'files', None, {'/a': {'content': 'a'}}))
+        self.assertFalse(
+            journal.done('config', 'files', None, {'/a': {'content': 'b'}}))
+        self.assertFalse(
+            journal.done('other', 'files', None, {'/a': {'content': 'a'}}))
+
+    def test_without_resume_starts_over(self):
+        cfn_helper.Journal(self.path).record('config', 'users', None, {})
+        journal = cfn_helper.Journal(self.path)
+        journal.record('config', 'groups', None, {})
+        journal = cfn_helper.Journal(self.path, resume=True)
+        self.assertFalse(journal.done('config', 'users', None, {}))
+        self.assertTrue(journal.done('config', 'groups', None, {}))
+
+    def test_scope(self):
+        journal = cfn_helper.Journal(self.path, resume=True)
+        scope = journal.scope('config', 'commands')
+        self.assertFalse(scope.done('a', {'command': 'true'}))
+        scope.record('a', {'command': 'true'})
+        self.assertTrue(scope.done('a', {'command': 'true'}))
+        self.assertFalse(
+            journal.scope('other', 'commands').done('a', {'command': 'true'}))
+
+    def test_saved_durably(self):
+        journal = cfn_helper.Journal(self.path)
+        with mock.patch('os.fsync') as mock_fsync:
+            journal.record('config', 'users', None, {})
+        self.assertTrue(mock_fsync.called)
+        self.assertEqual(['journal.json'], os.listdir(self.tdir.path))
 
-    def _test_apply_sources(self, url, end_file):
-        dest = tempfile.mkdtemp()
-        self.addCleanup(os.rmdir, dest)
-        sources = {dest: url}
-        td = os.path.dirname(end_file)
-        er = "mkdir -p '%s'; cd '%s'; curl -s '%s' | gunzip | tar -xvf -"
-        calls = popen_root_calls([er % (dest, dest, url)], shell=True)
+    @mock.patch.object(cfn_helper, 'controlled_privileges')
+    def test_skipped_commands_are_not_recorded(self, mock_cp):
+        commands = {'a': {'command': 'true', 'test': 'false'}}
 
-        with mock.patch.object(tempfile, 'mkdtemp') as mock_mkdtemp:
-            mock_mkdtemp.return_value = td
+        def run(test_status):
+            journal = cfn_helper.Journal(self.path, resume=True)
             with mock.patch('subprocess.Popen') as mock_popen:
-                mock_popen.return_value = FakePOpen('Curl good')
-                sh = cfn_helper.SourcesHandler(sources)
-                sh.apply_sources()
-                mock_popen.assert_has_calls(calls)
-            mock_mkdtemp.assert_called_with()
+                mock_popen.return_value = FakePOpen(returncode=test_status)
+                cfn_helper.CommandsHandler(
+                    commands,
+                    journal=journal.scope('config', 'commands'),
+                ).apply_commands()
+            return mock_popen.call_count
+
+        # the test returns false, then true, then the command is done
+        self.assertEqual(1, run(1))
+        self.assertEqual(2, run(0))
+        self.assertEqual(0, run(0))
+
+    def test_unreadable_journal(self):
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        journal = cfn_helper.Journal(self.path, resume=True)
+        self.assertFalse(journal.done('config', 'users', None, {}))
+
+
+class TestCfnInitPlan(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCfnInitPlan, self).setUp()
+        self.tdir = self.useFixture(fixtures.TempDir())
+        self.last_file = os.path.join(self.tdir.path, 'last_metadata')
+
+    def test_plan_files(self):
+        same = os.path.join(self.tdir.path, 'same')
+        other = os.path.join(self.tdir.path, 'other')
+        with open(same, 'w') as f:
+            f.write('bar')
+        md_data = {"AWS::CloudFormation::Init": {"config": {"files": {
+            same: {"content": "bar"},
+            other: {"content": {"foo": "bar"}}}}}}
+
+        md = cfn_helper.Metadata('teststack', None)
+        self.assertTrue(md.retrieve(meta_str=md_data,
+                                    last_path=self.last_file))
+        plan = md.cfn_init(plan=True)
+
+        self.assertEqual(1, len(plan))
+        self.assertEqual('config', plan[0]['config'])
+        self.assertThat(plan[0]['actions'], ttm.MatchesSetwise(
+            ttm.Equals({'handler': 'files', 'item': same,
+                        'action': 'unchanged'}),
+            ttm.Equals({'handler': 'files', 'item': other,
+                        'action': 'write'})))
+        self.assertFalse(os.path.exists(other))
+        # the plan is serializable
+        json.dumps(plan)
 
     @mock.patch.object(cfn_helper, 'controlled_privileges')
-    def test_apply_sources_github(self, mock_cp):
-        url = "https://github.com/NoSuchProject/tarball/NoSuchTarball"
-        dest = tempfile.mkdtemp()
-        self.addCleanup(os.rmdir, dest)
-        sources = {dest: url}
-        er = "mkdir -p '%s'; cd '%s'; curl -s '%s' | gunzip | tar -xvf -"
-        calls = popen_root_calls([er % (dest, dest, url)], shell=True)
+    def test_plan_packages_yum(self, mock_cp):
+
+        def returns(*args, **kwargs):
+            if args[0][:3] == ['rpm', '-q', 'httpd']:
+                return FakePOpen(returncode=0)
+            elif args[0][0] == 'rpm':
+                return FakePOpen(returncode=1)
+            elif args[0][0] == 'yum' and args[0][-1] == 'nosuchpkg':
+                return FakePOpen(returncode=1)
+            return FakePOpen(returncode=0)
+
+        packages = {"yum": {"httpd": [], "wordpress": [], "nosuchpkg": []}}
         with mock.patch('subprocess.Popen') as mock_popen:
-            mock_popen.return_value = FakePOpen('Curl good')
-            sh = cfn_helper.SourcesHandler(sources)
-            sh.apply_sources()
-            mock_popen.assert_has_calls(calls)
+            mock_popen.side_effect = returns
+            plan = cfn_helper.PackagesHandler(packages).plan_packages()
+            for call in mock_popen.call_args_list:
+                self.assertNotIn('install', call[0][0])
+
+        self.assertThat(plan, ttm.MatchesSetwise(
+            ttm.Equals({'handler': 'packages', 'item': 'httpd',
+                        'action': 'skip', 'manager': 'yum',
+                        'reason': 'installed'}),
+            ttm.Equals({'handler': 'packages', 'item': 'wordpress',
+                        'action': 'install', 'manager': 'yum'}),
+            ttm.Equals({'handler': 'packages', 'item': 'nosuchpkg',
+                        'action': 'skip', 'manager': 'yum',
+                        'reason': 'unavailable'})))
+
+    @mock.patch.object(cfn_helper.grp, 'getgrnam')
+    @mock.patch.object(cfn_helper.pwd, 'getpwnam')
+    def test_plan_groups_and_users(self, mock_getpwnam, mock_getgrnam):
+        mock_getgrnam.side_effect = [mock.Mock(), KeyError('newgroup')]
+        mock_getpwnam.side_effect = [KeyError('newuser')]
+
+        self.assertEqual(
+            [{'handler': 'groups', 'item': 'wheel', 'action': 'exists'},
+             {'handler': 'groups', 'item': 'newgroup', 'action': 'create'}],
+            cfn_helper.GroupsHandler(
+                {'wheel': {}, 'newgroup': {}}).plan_groups())
+        self.assertEqual(
+            [{'handler': 'users', 'item': 'newuser', 'action': 'create'}],
+            cfn_helper.UsersHandler({'newuser': {}}).plan_users())
+
+    def test_plan_commands(self):
+        commands = {
+            "00_foo": {"command": "/bin/command1", "test": "/bin/test1"},
+            "01_bar": {"command": "/bin/command2", "cwd": "/no/such/dir"},
+            "02_baz": {"env": {}},
+        }
+        with mock.patch('subprocess.Popen') as mock_popen:
+            plan = cfn_helper.CommandsHandler(commands).plan_commands()
+            self.assertFalse(mock_popen.called)
+        self.assertEqual(
+            [{'handler': 'commands', 'item': '00_foo', 'action': 'run',
+              'test': '/bin/test1'},
+             {'handler': 'commands', 'item': '01_bar', 'action': 'skip',
+              'reason': '/no/such/dir does not exist'},
+             {'handler': 'commands', 'item': '02_baz', 'action': 'skip',
+              'reason': "'command' property missing"}],
+            plan)
+
+    def test_retrieve_without_saving_cache(self):
+        md_data = {"AWS::CloudFormation::Init": {"config": {}}}
+        md = cfn_helper.Metadata('teststack', None)
+        self.assertTrue(md.retrieve(meta_str=md_data,
+                                    last_path=self.last_file,
+                                    save_cache=False))
+        self.assertFalse(os.path.exists(self.last_file))
+
+
+class TestFilesHandler(testtools.TestCase):
+
+    def setUp(self):
+        super(TestFilesHandler, self).setUp()
+        self.tdir = self.useFixture(fixtures.TempDir())
+        self.dest = os.path.join(self.tdir.path, 'etc', 'foo.conf')
+
+    def test_write_new_files(self):
+        json_dest = os.path.join(self.tdir.path, 'foo.json')
+        cfn_helper.FilesHandler({
+            self.dest: {'content': 'bar', 'mode': '000640'},
+            json_dest: {'content': {'foo': 'bar'}},
+        }).apply_files()
+
+        self.assertThat(self.dest, ttm.FileContains('bar'))
+        self.assertEqual(0o640, os.stat(self.dest).st_mode & 0o777)
+        self.assertThat(json_dest,
+                        ttm.FileContains(json.dumps({'foo': 'bar'},
+                                                    indent=4)))
+        # no temporary file is left behind
+        self.assertEqual(['foo.conf'],
+                         os.listdir(os.path.dirname(self.dest)))
+
+    def test_unchanged_file_is_not_rewritten(self):
+        os.makedirs(os.path.dirname(self.dest))
+        with open(self.dest, 'w') as f:
+            f.write('bar')
+        os.chmod(self.dest, 0o644)
+        os.utime(self.dest, (1000000000, 1000000000))
+        before = os.stat(self.dest)
+
+        files = {self.dest: {'content': 'bar', 'mode': '000600'}}
+        with mock.patch.object(cfn_helper.os, 'rename') as mock_rename:
+            handler = cfn_helper.FilesHandler(files)
+            handler.apply_files()
+            self.assertFalse(mock_rename.called)
+        # the mode changed
+        self.assertEqual({self.dest}, handler.changed)
+        handler = cfn_helper.FilesHandler(files)
+        handler.apply_files()
+        self.assertEqual(set(), handler.changed)
+
+        after = os.stat(self.dest)
+        self.assertEqual(before.st_ino, after.st_ino)
+        self.assertEqual(1000000000, after.st_mtime)
+        self.assertEqual(0o600, after.st_mode & 0o777)
+
+    def test_changed_file_is_replaced(self):
+        os.makedirs(os.path.dirname(self.dest))
+        with open(self.dest, 'w') as f:
+            f.write('old content')
+        os.chmod(self.dest, 0o640)
+        before = os.stat(self.dest)
+
+        cfn_helper.FilesHandler(
+            {self.dest: {'content': 'new content'}}).apply_files()
+
+        after = os.stat(self.dest)
+        self.assertThat(self.dest, ttm.FileContains('new content'))
+        self.assertNotEqual(before.st_ino, after.st_ino)
+        # the existing mode is kept when the metadata has none
+        self.assertEqual(0o640, after.st_mode & 0o777)
+
+    def test_failed_download_keeps_file(self):
+        server = self.useFixture(HTTPServerFixture())
+        os.makedirs(os.path.dirname(self.dest))
+        with open(self.dest, 'w') as f:
+            f.write('old content')
+
+        cfn_helper.FilesHandler(
+            {self.dest: {'source': server.url + '/missing'}}).apply_files()
+
+        self.assertThat(self.dest, ttm.FileContains('old content'))
+        self.assertEqual(['foo.conf'],
+                         os.listdir(os.path.dirname(self.dest)))
+
+    def test_source_checksum_mismatch_keeps_file(self):
+        server = self.useFixture(HTTPServerFixture({'/foo': b'new content'}))
+        os.makedirs(os.path.dirname(self.dest))
+        with open(self.dest, 'w') as f:
+            f.write('old content')
+
+        cfn_helper.FilesHandler({self.dest: {
+            'source': server.url + '/foo',
+            'md5': hashlib.md5(b'other content').hexdigest()}}).apply_files()
+
+        self.assertThat(self.dest, ttm.FileContains('old content'))
+        self.assertEqual(['foo.conf'],
+                         os.listdir(os.path.dirname(self.dest)))
+
+    def test_download_sources_with_pooled_connections(self):
+        files = dict(('/f%d' % i, b'content %d' % i) for i in range(20))
+        server = self.useFixture(HTTPServerFixture(files))
+        entries = dict((os.path.join(self.tdir.path, name.lstrip('/')),
+                        {'source': server.url + name}) for name in files)
+
+        cfn_helper.FilesHandler(entries, workers=4).apply_files()
+
+        for name, content in files.items():
+            self.assertThat(os.path.join(self.tdir.path, name.lstrip('/')),
+                            ttm.FileContains(content.decode()))
+        self.assertEqual(20, len(server.requests))
+        # connections are kept alive and reused across files
+        self.assertThat(len(server.clients), ttm.LessThan(5))
+
+    def test_owner_resolved_once_and_set_through_descriptor(self):
+        resolver = cfn_helper.IdentityResolver()
+        other = os.path.join(self.tdir.path, 'other.conf')
+        files = dict((path, {'content': 'bar', 'owner': 'nobody',
+                             'group': 'nogroup'})
+                     for path in (self.dest, other))
+        pw = mock.Mock(pw_uid=os.getuid())
+        gr = mock.Mock(gr_gid=os.getgid())
+        with mock.patch('pwd.getpwnam', return_value=pw) as mock_pw, \
+                mock.patch('grp.getgrnam', return_value=gr) as mock_gr, \
+                mock.patch.object(cfn_helper.os, 'chown') as mock_chown, \
+                mock.patch.object(cfn_helper.os, 'fchown') as mock_fchown:
+            cfn_helper.FilesHandler(files, resolver=resolver).apply_files()
+
+        mock_pw.assert_called_once_with('nobody')
+        mock_gr.assert_called_once_with('nogroup')
+        self.assertFalse(mock_chown.called)
+        self.assertEqual(2, mock_fchown.call_count)
+        mock_fchown.assert_called_with(mock.ANY, os.getuid(), os.getgid())
+
+    def test_base64_and_gzip_content(self):
+        data = os.urandom(3000) + b'x' * 100000
+        gz_dest = os.path.join(self.tdir.path, 'foo.bin')
+        encoded = base64.encodebytes(data).decode()
+        compressed = base64.b64encode(gzip.compress(data)).decode()
+        self.patch(cfn_helper.FilesHandler, '_chunk_size', 1000)
+        cfn_helper.FilesHandler({
+            self.dest: {'content': encoded, 'encoding': 'base64'},
+            gz_dest: {'content': compressed, 'encoding': 'gzip+base64'},
+        }).apply_files()
+
+        for path in (self.dest, gz_dest):
+            with open(path, 'rb') as f:
+                self.assertEqual(data, f.read())
+
+    def test_unchanged_encoded_content_is_not_rewritten(self):
+        os.makedirs(os.path.dirname(self.dest))
+        with open(self.dest, 'wb') as f:
+            f.write(b'bar')
+        files = {self.dest: {
+            'content': base64.b64encode(gzip.compress(b'bar')).decode(),
+            'encoding': 'gzip+base64'}}
+        with mock.patch.object(cfn_helper.os, 'rename') as mock_rename:
+            cfn_helper.FilesHandler(files).apply_files()
+            self.assertFalse(mock_rename.called)
+
+    def test_invalid_encoded_content_keeps_file(self):
+        os.makedirs(os.path.dirname(self.dest))
+        with open(self.dest, 'w') as f:
+            f.write('old content')
+        truncated = base64.b64encode(gzip.compress(b'bar' * 100)[:-10])
+        for meta in ({'content': 'not base64!', 'encoding': 'base64'},
+                     {'content': truncated.decode(),
+                      'encoding': 'gzip+base64'},
+                     {'content': 'bar', 'encoding': 'rot13'},
+                     {'content': {'foo': 'bar'}, 'encoding': 'base64'}):
+            cfn_helper.FilesHandler({self.dest: meta}).apply_files()
+            self.assertThat(self.dest, ttm.FileContains('old content'))
+        self.assertEqual(['foo.conf'],
+                         os.listdir(os.path.dirname(self.dest)))
+
+    def test_symlinks_and_hardlinks(self):
+        release = os.path.join(self.tdir.path, 'releases', '2', 'app.conf')
+        current = os.path.join(self.tdir.path, 'current')
+        linked = os.path.join(self.tdir.path, 'etc', 'app.conf')
+        files = {
+            linked: {'hardlink': release},
+            current: {'content': 'releases/2', 'mode': '120000'},
+            release: {'content': 'bar'},
+        }
+        cfn_helper.FilesHandler(files).apply_files()
+
+        self.assertEqual('releases/2', os.readlink(current))
+        self.assertTrue(os.path.samefile(release, linked))
+        self.assertThat(os.path.join(current, 'app.conf'),
+                        ttm.FileContains('bar'))
+
+        # links already in place are left alone
+        with mock.patch.object(cfn_helper.os, 'rename') as mock_rename:
+            cfn_helper.FilesHandler(files).apply_files()
+            self.assertFalse(mock_rename.called)
+
+        # a changed target replaces the link atomically
+        files[current]['content'] = 'releases/3'
+        cfn_helper.FilesHandler(files).apply_files()
+        self.assertEqual('releases/3', os.readlink(current))
+        # no temporary link is left behind
+        self.assertEqual(['current', 'etc', 'releases'],
+                         sorted(os.listdir(self.tdir.path)))
+
+    def test_hardlink_to_unmanaged_file_is_skipped(self):
+        files = {self.dest: {'hardlink': '/etc/passwd'}}
+        self.assertEqual(
+            [{'handler': 'files', 'item': self.dest, 'action': 'skip',
+              'reason': 'hardlink target /etc/passwd is not a managed file'}],
+            cfn_helper.FilesHandler(files).plan_files())
+        cfn_helper.FilesHandler(files).apply_files()
+        self.assertFalse(os.path.lexists(self.dest))
+
+
+class TestIdentityResolver(testtools.TestCase):
+
+    def test_lookups_are_cached(self):
+        resolver = cfn_helper.IdentityResolver()
+        with mock.patch('pwd.getpwnam') as mock_pw:
+            mock_pw.side_effect = [mock.sentinel.ec2_user, KeyError('x'),
+                                   mock.sentinel.created]
+            self.assertEqual(mock.sentinel.ec2_user,
+                             resolver.getpwnam('ec2-user'))
+            self.assertEqual(mock.sentinel.ec2_user,
+                             resolver.getpwnam('ec2-user'))
+            # unknown names are not remembered, they may be created later
+            self.assertRaises(KeyError, resolver.getpwnam, 'created')
+            self.assertEqual(mock.sentinel.created,
+                             resolver.getpwnam('created'))
+            self.assertEqual(mock.sentinel.created,
+                             resolver.getpwnam('created'))
+        self.assertEqual([mock.call('ec2-user'), mock.call('created'),
+                          mock.call('created')],
+                         mock_pw.call_args_list)
+
+    def test_created_user_and_group_are_looked_up_again(self):
+        resolver = cfn_helper.IdentityResolver()
+        with mock.patch('pwd.getpwnam') as mock_pw, \
+                mock.patch('grp.getgrnam') as mock_gr, \
+                mock.patch('subprocess.Popen') as mock_popen, \
+                mock.patch.object(cfn_helper, 'controlled_privileges'):
+            mock_pw.side_effect = [KeyError('x'), mock.sentinel.user]
+            mock_gr.side_effect = [KeyError('x'), mock.sentinel.group]
+            mock_popen.return_value = FakePOpen()
+            self.assertRaises(KeyError, resolver.getpwnam, 'u')
+            self.assertRaises(KeyError, resolver.getgrnam, 'g')
+            cfn_helper.GroupsHandler({'g': {}},
+                                     resolver=resolver).apply_groups()
+            cfn_helper.UsersHandler({'u': {}},
+                                    resolver=resolver).apply_users()
+            self.assertEqual(mock.sentinel.user, resolver.getpwnam('u'))
+            self.assertEqual(mock.sentinel.group, resolver.getgrnam('g'))
+
+    def test_commands_switch_user_through_resolver(self):
+        resolver = mock.Mock()
+        resolver.getpwnam.return_value = mock.Mock(pw_uid=0, pw_gid=0)
+        with mock.patch('subprocess.Popen') as mock_popen, \
+                mock.patch('os.geteuid', return_value=0), \
+                mock.patch('os.getegid', return_value=0), \
+                mock.patch('os.seteuid'), mock.patch('os.setegid'):
+            mock_popen.return_value = FakePOpen()
+            cfn_helper.CommandsHandler(
+                {'a': {'command': 'true'}},
+                resolver=resolver).apply_commands()
+        resolver.getpwnam.assert_called_with('root')
+
+    def _run_commands(self, commands, workers=4):
+        """Apply commands, returning the commands started and finished."""
+        events = []
+        lock = threading.Lock()
+
+        def popen(cmd, **kwargs):
+            with lock:
+                events.append(('start', cmd))
+            time.sleep(0.05)
+            with lock:
+                events.append(('end', cmd))
+            return FakePOpen(returncode=1 if cmd.startswith('fail') else 0)
+
+        with mock.patch('subprocess.Popen') as mock_popen:
+            mock_popen.side_effect = popen
+            handler = cfn_helper.CommandsHandler(
+                commands, resolver=cfn_helper.IdentityResolver(),
+                workers=workers)
+            try:
+                handler.apply_commands()
+            finally:
+                self.events = events
+        return events
+
+    def test_commands_parallel_group(self):
+        commands = {
+            '01_setup': {'command': 'setup'},
+            '02_warm_a': {'command': 'warm_a', 'parallelGroup': 'warm'},
+            '02_warm_b': {'command': 'warm_b', 'parallelGroup': 'warm'},
+            '02_warm_c': {'command': 'warm_c', 'parallelGroup': 'warm'},
+            '03_finish': {'command': 'finish'},
+        }
+        events = self._run_commands(commands)
+        order = [cmd for event, cmd in events]
+        self.assertEqual(['setup', 'setup'], order[:2])
+        self.assertEqual({'warm_a', 'warm_b', 'warm_c'}, set(order[2:5]))
+        self.assertTrue(all(event == 'start' for event, cmd in events[2:5]))
+        self.assertEqual(['finish', 'finish'], order[-2:])
+
+    def test_commands_depends_on(self):
+        commands = {
+            'a': {'command': 'a', 'dependsOn': 'c'},
+            'b': {'command': 'b', 'dependsOn': []},
+            'c': {'command': 'c', 'dependsOn': ['b']},
+        }
+        events = self._run_commands(commands, workers=1)
+        self.assertEqual(['b', 'c', 'a'],
+                         [cmd for event, cmd in events if event == 'start'])
+
+    def test_commands_depends_on_later_command(self):
+        commands = {
+            'a': {'command': 'a'},
+            'b': {'command': 'b', 'dependsOn': ['d']},
+            'c': {'command': 'c'},
+            'd': {'command': 'd'},
+        }
+        handler = cfn_helper.CommandsHandler(commands)
+        self.assertEqual({'a': set(), 'b': {'d'}, 'c': {'a', 'b'},
+                          'd': {'a'}}, handler._command_graph())
+        events = self._run_commands(commands, workers=1)
+        self.assertEqual(['a', 'd', 'b', 'c'],
+                         [cmd for event, cmd in events if event == 'start'])
+
+    def test_commands_failure_stops_graph(self):
+        commands = {
+            'a': {'command': 'fail_a', 'parallelGroup': 'g'},
+            'b': {'command': 'b', 'parallelGroup': 'g'},
+            'c': {'command': 'c'},
+            'd': {'command': 'fail_d', 'dependsOn': [],
+                  'ignoreErrors': 'true'},
+        }
+        e = self.assertRaises(cfn_helper.CommandsHandlerRunError,
+                              self._run_commands, commands)
+        self.assertEqual('a has failed.', str(e))
+        self.assertEqual({'fail_a', 'b', 'fail_d'},
+                         set(cmd for event, cmd in self.events))
+
+    def test_commands_invalid_graph(self):
+        handler = cfn_helper.CommandsHandler({
+            'a': {'command': 'a', 'dependsOn': 'b'},
+            'b': {'command': 'b', 'dependsOn': 'a'},
+            'c': {'command': 'c', 'dependsOn': 'x'},
+        })
+        e = self.assertRaises(cfn_helper.CommandsHandlerRunError,
+                              handler.apply_commands)
+        self.assertEqual('c depends on unknown commands x', str(e))
+        del handler.commands['c']
+        e = self.assertRaises(cfn_helper.CommandsHandlerRunError,
+                              handler.apply_commands)
+        self.assertEqual('Circular dependencies between commands a, b',
+                         str(e))
+        plan = handler.plan_commands()
+        self.assertEqual(['skip', 'skip'], [entry['action'] for entry in plan])
+
+    def test_commands_report_what_ran(self):
+        commands = {'a': {'command': 'true'},
+                    'b': {'command': 'true', 'test': 'false'}}
+        with mock.patch('subprocess.Popen') as mock_popen:
+            mock_popen.side_effect = lambda cmd, **kwargs: FakePOpen(
+                returncode=1 if cmd == 'false' else 0)
+            handler = cfn_helper.CommandsHandler(
+                commands, resolver=cfn_helper.IdentityResolver())
+            handler.apply_commands()
+        self.assertEqual({'a'}, handler.changed)
+
+    def test_commands_report_only_successful_runs(self):
+        commands = {'a': {'command': 'true'},
+                    'b': {'command': 'false', 'ignoreErrors': 'true'}}
+        with mock.patch('subprocess.Popen') as mock_popen:
+            mock_popen.side_effect = lambda cmd, **kwargs: FakePOpen(
+                returncode=1 if cmd == 'false' else 0)
+            handler = cfn_helper.CommandsHandler(
+                commands, resolver=cfn_helper.IdentityResolver())
+            handler.apply_commands()
+        self.assertEqual({'a'}, handler.changed)
 
     @mock.patch.object(cfn_helper, 'controlled_privileges')
-    def test_apply_sources_general(self, mock_cp):
-        url = "https://website.no.existe/a/b/c/file.tar.gz"
-        dest = tempfile.mkdtemp()
-        self.addCleanup(os.rmdir, dest)
-        sources = {dest: url}
-        er = "mkdir -p '%s'; cd '%s'; curl -s '%s' | gunzip | tar -xvf -"
-        calls = popen_root_calls([er % (dest, dest, url)], shell=True)
+    def test_commands_builtin_test(self, mock_cp):
+        tdir = self.useFixture(fixtures.TempDir())
+        commands = {'a': {'command': 'true',
+                          'test': {'pathExists': tdir.path}},
+                    'b': {'command': 'true',
+                          'test': {'not': {'pathExists': tdir.path}}}}
         with mock.patch('subprocess.Popen') as mock_popen:
-            mock_popen.return_value = FakePOpen('Curl good')
-            sh = cfn_helper.SourcesHandler(sources)
-            sh.apply_sources()
-            mock_popen.assert_has_calls(calls)
+            mock_popen.return_value = FakePOpen()
+            handler = cfn_helper.CommandsHandler(
+                commands, resolver=cfn_helper.IdentityResolver())
+            handler.apply_commands()
+            mock_popen.assert_has_calls(popen_root_calls(['true'],
+                                                         shell=True))
+            self.assertEqual(1, mock_popen.call_count)
+        self.assertEqual({'a'}, handler.changed)
+        self.assertEqual(
+            ['run', 'skip'],
+            [entry['action'] for entry in handler.plan_commands()])
+
+    def test_commands_invalid_builtin_test(self):
+        commands = {'a': {'command': 'true', 'test': {'isFile': '/x'}},
+                    'b': {'command': 'true', 'test': {'exists': '/x'}}}
+        with mock.patch('subprocess.Popen') as mock_popen:
+            handler = cfn_helper.CommandsHandler(commands)
+            self.assertRaises(cfn_helper.CommandsHandlerRunError,
+                              handler.apply_commands)
+            self.assertEqual(
+                ['skip', 'skip'],
+                [entry['action'] for entry in handler.plan_commands()])
+            self.assertFalse(mock_popen.called)
+
+
+class TestCommandTest(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCommandTest, self).setUp()
+        self.tdir = self.useFixture(fixtures.TempDir())
+
+    def holds(self, test, **kwargs):
+        return cfn_helper.CommandTest(test, **kwargs).holds()
+
+    def test_path_exists(self):
+        path = os.path.join(self.tdir.path, 'a')
+        self.assertFalse(self.holds({'pathExists': path}))
+        self.assertTrue(self.holds({'not': {'pathExists': path}}))
+        open(path, 'w').close()
+        self.assertTrue(self.holds({'pathExists': [path, self.tdir.path]}))
+
+    def test_file_contains(self):
+        path = os.path.join(self.tdir.path, 'a')
+        with open(path, 'w') as f:
+            f.write('Listen 80\nUser apache\n')
+        self.assertTrue(self.holds(
+            {'fileContains': {'path': path, 'pattern': '^User apache$'}}))
+        self.assertFalse(self.holds(
+            {'fileContains': {'path': path, 'pattern': '^Listen 8080'}}))
+        self.assertFalse(self.holds(
+            {'fileContains': {'path': path + '.missing', 'pattern': 'a'}}))
+
+    def test_user_and_group_exist(self):
+        resolver = cfn_helper.IdentityResolver()
+        self.assertTrue(self.holds(
+            {'userExists': 'root', 'groupExists': ['root']},
+            resolver=resolver))
+        self.assertFalse(self.holds(
+            {'userExists': ['root', 'no-such-user-here']},
+            resolver=resolver))
+
+    def test_package_installed(self):
+        with mock.patch('subprocess.Popen') as mock_popen:
+            mock_popen.return_value = FakePOpen(b'bash\nhttpd\n')
+            inventory = cfn_helper.PackageInventory()
+            self.assertTrue(self.holds({'packageInstalled': ['httpd']},
+                                       inventory=inventory))
+            self.assertFalse(self.holds({'packageInstalled': 'nginx'},
+                                        inventory=inventory))
+            self.assertEqual(1, mock_popen.call_count)
+            inventory.forget()
+            self.assertTrue(inventory.installed('bash'))
+            self.assertEqual(2, mock_popen.call_count)
+
+    def test_package_installed_dpkg(self):
+        with mock.patch('subprocess.Popen') as mock_popen:
+            mock_popen.side_effect = [
+                OSError('No such file or directory: rpm'),
+                FakePOpen(b'bash install ok installed\n'
+                          b'nginx deinstall ok config-files\n')]
+            inventory = cfn_helper.PackageInventory()
+            self.assertTrue(inventory.installed('bash'))
+            self.assertFalse(inventory.installed('nginx'))
+
+    def test_port_listening(self):
+        listener = socket.socket()
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        self.assertFalse(self.holds({'portListening': port}))
+        listener.listen(1)
+        self.assertTrue(self.holds({'portListening': [port]}))
+
+    def test_invalid(self):
+        for test in ({}, 'true', {'isFile': '/x'},
+                     {'values': 1}, {'exists': '/x'}, {'proc_net': 1},
+                     {'holds': 1}, {'pathExists': 1},
+                     {'pathExists': []}, {'userExists': ['root', None]},
+                     {'portListening': 'http'}, {'portListening': True},
+                     {'portListening': 70000},
+                     {'fileContains': {'path': '/x'}},
+                     {'fileContains': {'path': '/x', 'pattern': 1}},
+                     {'fileContains': {'path': '/x', 'pattern': '('}},
+                     {'not': {'isFile': '/x'}}, {'not': '/x'}):
+            self.assertRaises(cfn_helper.CommandsHandlerRunError,
+                              cfn_helper.CommandTest, test)
+
+
+class TestDownload(testtools.TestCase):
+
+    def setUp(self):
+        super(TestDownload, self).setUp()
+        self.tdir = self.useFixture(fixtures.TempDir())
+        self.content = os.urandom(300000)
+        self.server = self.useFixture(HTTPServerFixture(
+            {'/big': self.content}))
+        self.url = self.server.url + '/big'
+        self.path = os.path.join(self.tdir.path, 'big')
+        self.client = cfn_helper.HttpClient()
+        self.sha256 = hashlib.sha256(self.content).hexdigest()
+
+    def test_interrupted_download_is_resumed(self):
+        self.server.truncate['/big'] = 100000
+        self.assertEqual(
+            (len(self.content), self.sha256),
+            cfn_helper.download(self.url, self.path, self.client,
+                                {'sha256': self.sha256}))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(self.content, f.read())
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual('bytes=100000-', self.server.headers[1]['Range'])
+        self.assertEqual('"%s"' % hashlib.md5(self.content).hexdigest(),
+                         self.server.headers[1]['If-Range'])
+
+    def test_changed_content_is_downloaded_again(self):
+        self.server.truncate['/big'] = 100000
+        job = cfn_helper.Download(self.client, self.url, self.path,
+                                  attempts=1)
+        self.assertRaises(cfn_helper.DownloadError, job.run)
+        self.server.files['/big'] = b'new content'
+
+        job = cfn_helper.Download(self.client, self.url, self.path,
+                                  attempts=1)
+        job.validator = '"old etag"'
+        self.assertTrue(job.run())
+        self.assertThat(self.path, ttm.FileContains('new content'))
+
+    def test_checksum_mismatch(self):
+        md5 = hashlib.md5(b'something else').hexdigest()
+        e = self.assertRaises(cfn_helper.DownloadError, cfn_helper.download,
+                              self.url, self.path, self.client,
+                              {'sha256': self.sha256, 'md5': md5})
+        self.assertIn('md5 checksum', str(e))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_url_credentials_are_sent_as_basic_auth(self):
+        url = self.server.url.replace('://', '://user:p%40ss@') + '/big'
+        with self.client.get(url) as resp:
+            self.assertEqual(self.content, resp.read())
+        self.assertEqual('/big', self.server.requests[0])
+        self.assertEqual(
+            'Basic ' + base64.b64encode(b'user:p@ss').decode(),
+            self.server.headers[0]['Authorization'])
+
+    def test_proxy_from_environment(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'http_proxy', self.server.url.replace('://', '://u:p@')))
+        self.useFixture(fixtures.EnvironmentVariable('no_proxy', ''))
+        url = 'http://artifacts.example.com/big'
+        self.server.files['http://artifacts.example.com:80/big'] = b'proxied'
+        with self.client.get(url) as resp:
+            self.assertEqual(b'proxied', resp.read())
+        self.assertEqual(
+            'Basic ' + base64.b64encode(b'u:p').decode(),
+            self.server.headers[0]['Proxy-Authorization'])
+
+        # HTTPS goes through a CONNECT tunnel
+        with mock.patch('http.client.HTTPSConnection') as mock_conn:
+            self.client._checkout(('https', 'artifacts.example.com:443',
+                                   'http://u:p@proxy.example.com:3128'))
+        mock_conn.assert_called_once_with(
+            'proxy.example.com:3128', timeout=60, context=mock.ANY)
+        mock_conn.return_value.set_tunnel.assert_called_once_with(
+            'artifacts.example.com:443', headers={
+                'Proxy-Authorization':
+                    'Basic ' + base64.b64encode(b'u:p').decode()})
+
+        # hosts of no_proxy are reached directly
+        self.useFixture(fixtures.EnvironmentVariable(
+            'http_proxy', 'http://proxy.invalid:3128'))
+        self.useFixture(fixtures.EnvironmentVariable(
+            'no_proxy', '127.0.0.1'))
+        with self.client.get(self.url) as resp:
+            self.assertEqual(self.content, resp.read())
+
+
+class TestDownloadCache(testtools.TestCase):
 
-    def test_apply_source_cmd(self):
+    def setUp(self):
+        super(TestDownloadCache, self).setUp()
+        self.tdir = self.useFixture(fixtures.TempDir())
+        self.cache = cfn_helper.DownloadCache(
+            os.path.join(self.tdir.path, 'downloads'))
+        self.server = self.useFixture(HTTPServerFixture({
+            '/a.tgz': b'content of a.tgz',
+            '/b.txt': b'content of b.txt',
+        }))
+
+    def test_prefetch(self):
+        urls = [self.server.url + '/a.tgz', self.server.url + '/b.txt',
+                self.server.url + '/a.tgz']
+        paths = self.cache.prefetch(urls)
+        self.assertEqual(2, len(self.server.requests))
+
+        self.assertEqual(sorted(set(urls)), sorted(paths))
+        for url in urls:
+            self.assertEqual(paths[url], self.cache.get(url))
+            self.assertThat(paths[url], ttm.FileContains(
+                'content of %s' % os.path.basename(url)))
+
+    def test_fetch_failure_drops_stale_copy(self):
+        url = self.server.url + '/a.tgz'
+        self.assertIsNotNone(self.cache.fetch(url))
+        del self.server.files['/a.tgz']
+        self.assertIsNone(self.cache.fetch(url))
+        self.assertIsNone(self.cache.get(url))
+        self.assertIsNone(self.cache.entry(url))
+
+    def test_fetch_revalidates(self):
+        url = self.server.url + '/a.tgz'
+        path = self.cache.fetch(url)
+        self.assertNotIn('If-None-Match', self.server.headers[0])
+        entry = self.cache.entry(url)
+        self.assertEqual(url, entry['url'])
+        self.assertEqual(path, entry['path'])
+        self.assertEqual(len(b'content of a.tgz'), entry['size'])
+        self.assertEqual(cfn_helper.file_digest(path), entry['digest'])
+        self.assertEqual(os.path.basename(path), entry['digest'])
+
+        # unchanged: a conditional GET answered with 304
+        self.assertEqual(path, self.cache.fetch(url))
+        self.assertEqual(entry['etag'],
+                         self.server.headers[1]['If-None-Match'])
+        self.assertThat(path, ttm.FileContains('content of a.tgz'))
+
+        # changed: the new content is stored as a new object
+        self.server.files['/a.tgz'] = b'new content'
+        new_path = self.cache.fetch(url)
+        self.assertNotEqual(path, new_path)
+        self.assertThat(new_path, ttm.FileContains('new content'))
+        self.assertEqual(new_path, self.cache.get(url))
+
+    def test_identical_content_is_stored_once(self):
+        self.server.files['/copy.tgz'] = self.server.files['/a.tgz']
+        paths = self.cache.prefetch([self.server.url + '/a.tgz',
+                                     self.server.url + '/copy.tgz'])
+        self.assertEqual(1, len(set(paths.values())))
+        self.assertEqual(1, len(os.listdir(
+            os.path.join(self.cache.cache_dir, 'objects'))))
+
+    def test_evict_least_recently_used(self):
+        self.cache.max_size = 100
+        for i, name in enumerate(('/1', '/2', '/3')):
+            self.server.files[name] = name.encode() * 16
+            path = self.cache.fetch(self.server.url + name)
+            os.utime(path, (1000000000 + i, 1000000000 + i))
+        # in a later run, using /1 makes /2 the least recently used
+        cache = cfn_helper.DownloadCache(self.cache.cache_dir, max_size=100)
+        self.assertIsNotNone(cache.get(self.server.url + '/1'))
+        self.server.files['/4'] = b'4' * 40
+        cache.fetch(self.server.url + '/4')
+
+        self.assertIsNone(cache.entry(self.server.url + '/2'))
+        self.assertIsNone(cache.entry(self.server.url + '/3'))
+        self.assertIsNotNone(cache.entry(self.server.url + '/1'))
+        self.assertIsNotNone(cache.entry(self.server.url + '/4'))
+        self.assertEqual(2, len(os.listdir(
+            os.path.join(cache.cache_dir, 'index'))))
+
+    def test_evict_keeps_objects_of_this_run(self):
+        self.cache.max_size = 50
+        self.server.files['/big'] = b'x' * 100
+        self.server.files['/partial'] = b'y' * 100
+        partial = self.cache._partial_path(self.server.url + '/partial')
+        os.makedirs(os.path.dirname(partial))
+        with open(partial, 'wb') as f:
+            f.write(b'y' * 60)
+        path = self.cache.fetch(self.server.url + '/big')
+        self.assertEqual(path, self.cache.get(self.server.url + '/big'))
+        self.assertTrue(os.path.exists(partial))
+
+        paths = self.cache.prefetch([self.server.url + '/a.tgz',
+                                     self.server.url + '/b.txt'])
+        for url, path in paths.items():
+            self.assertEqual(path, self.cache.get(url))
+        self.assertEqual(3, len(os.listdir(
+            os.path.join(self.cache.cache_dir, 'objects'))))
+
+    def test_files_handler_uses_cache(self):
+        url = self.server.url + '/b.txt'
+        dest = os.path.join(self.tdir.path, 'b.txt')
+        self.cache.prefetch([url])
+        cfn_helper.FilesHandler({dest: {'source': url}},
+                                cache=self.cache).apply_files()
+        self.assertEqual(1, len(self.server.requests))
+        self.assertThat(dest, ttm.FileContains('content of b.txt'))
+
+    def test_fetch_resumes_partial_download(self):
+        content = os.urandom(200000)
+        self.server.files['/big'] = content
+        self.server.truncate['/big'] = 50000
+        url = self.server.url + '/big'
+        self.patch(cfn_helper.Download, '__init__', functools.partialmethod(
+            cfn_helper.Download.__init__, attempts=1))
+        self.assertIsNone(self.cache.fetch(url))
+
+        # the next run picks up where the interrupted one stopped
+        path = self.cache.fetch(url, {'sha256':
+                                      hashlib.sha256(content).hexdigest()})
+        with open(path, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertEqual('bytes=50000-', self.server.headers[-1]['Range'])
+        self.assertEqual([], os.listdir(os.path.join(self.tdir.path,
+                                                     'downloads', 'partial')))
+
+    def test_cached_copy_must_match_checksums(self):
+        url = self.server.url + '/b.txt'
+        sha256 = hashlib.sha256(b'content of b.txt').hexdigest()
+        md5 = hashlib.md5(b'content of b.txt').hexdigest()
+        path = self.cache.fetch(url)
+        self.assertEqual(path, self.cache.get(url, {'sha256': sha256,
+                                                    'md5': md5}))
+        self.assertIsNone(self.cache.get(url, {'md5': sha256[:32]}))
+        self.assertIsNone(self.cache.fetch(url, {'sha256': md5 * 2}))
+        self.assertIsNone(self.cache.get(url))
+
+    def test_sources_handler_uses_cache(self):
+        self.server.files['/c.tgz'] = make_tar({'c.txt': b'content of c'})
+        url = self.server.url + '/c.tgz'
+        dest = os.path.join(self.tdir.path, 'c')
+        self.cache.fetch(url)
+        cfn_helper.SourcesHandler({dest: url},
+                                  cache=self.cache).apply_sources()
+        self.assertEqual(1, len(self.server.requests))
+        self.assertThat(os.path.join(dest, 'c.txt'),
+                        ttm.FileContains('content of c'))
+
+    def test_sources_handler_downloads_evicted_copy(self):
+        self.server.files['/c.tgz'] = make_tar({'c.txt': b'content of c'})
+        url = self.server.url + '/c.tgz'
+        dest = os.path.join(self.tdir.path, 'c')
+        self.cache.fetch(url)
+        entry = self.cache.entry(url)
+        os.unlink(entry['path'])
+        with mock.patch.object(self.cache, 'lookup', return_value=entry):
+            cfn_helper.SourcesHandler({dest: url},
+                                      cache=self.cache).apply_sources()
+        self.assertEqual(2, len(self.server.requests))
+        self.assertThat(os.path.join(dest, 'c.txt'),
+                        ttm.FileContains('content of c'))
+
+    @mock.patch.object(cfn_helper, 'controlled_privileges')
+    def test_cfn_init_prefetch_only(self, mock_cp):
+        dest = os.path.join(self.tdir.path, 'file')
+        md_data = {"AWS::CloudFormation::Init": {
+            "configSets": {"default": ["one", "two"]},
+            "one": {"sources": {"/opt/a": "http://example.com/a.tgz"}},
+            "two": {"files": {dest: {"source": "http://example.com/b"},
+                              "/tmp/x": {"content": "x"}}}}}
+        cache = mock.Mock()
+        md = cfn_helper.Metadata('teststack', None, download_cache=cache)
+        self.assertTrue(md.retrieve(
+            meta_str=md_data,
+            last_path=os.path.join(self.tdir.path, 'last_metadata')))
+        with mock.patch('subprocess.Popen') as mock_popen:
+            md.cfn_init(prefetch_only=True)
+            self.assertFalse(mock_popen.called)
+        cache.prefetch.assert_called_once_with(
+            ['http://example.com/a.tgz', 'http://example.com/b'],
+            {'http://example.com/a.tgz': {}, 'http://example.com/b': {}})
+        self.assertFalse(os.path.exists(dest))
+
+
+class TestCfnInitOverlap(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCfnInitOverlap, self).setUp()
+        self.tdir = self.useFixture(fixtures.TempDir())
+        self.last_file = os.path.join(self.tdir.path, 'last_metadata')
+        self.events = []
+        self.packages_started = threading.Event()
+
+        def apply_packages(handler):
+            self.events.append('packages')
+            self.packages_started.set()
+
+        def fetch(url, checksums=None):
+            self.assertTrue(self.packages_started.wait(5))
+            self.events.append('fetched %s' % url)
+            return '/cache/a'
+
+        def apply_sources(handler):
+            self.events.append('sources')
+
+        self.useFixture(fixtures.MockPatchObject(
+            cfn_helper.PackagesHandler, 'apply_packages', apply_packages,
+            autospec=False))
+        self.useFixture(fixtures.MockPatchObject(
+            cfn_helper.SourcesHandler, 'apply_sources', apply_sources,
+            autospec=False))
+        self.cache = cfn_helper.DownloadCache(self.tdir.path)
+        self.useFixture(fixtures.MockPatchObject(
+            self.cache, 'fetch', side_effect=fetch))
+
+    def _cfn_init(self, overlap_downloads):
+        md_data = {"AWS::CloudFormation::Init": {"config": {
+            "packages": {"yum": {"httpd": []}},
+            "sources": {"/opt/a": "http://example.com/a.tgz"}}}}
+        md = cfn_helper.Metadata('teststack', None,
+                                 download_cache=self.cache,
+                                 overlap_downloads=overlap_downloads)
+        self.assertTrue(md.retrieve(meta_str=md_data,
+                                    last_path=self.last_file))
+        md.cfn_init()
+
+    def test_downloads_overlap_packages(self):
+        self._cfn_init(overlap_downloads=True)
+        self.assertEqual(['packages', 'fetched http://example.com/a.tgz',
+                          'sources'], self.events)
+
+    def test_downloads_before_packages_by_default(self):
+        self.packages_started.set()
+        self._cfn_init(overlap_downloads=False)
+        self.assertEqual(['fetched http://example.com/a.tgz', 'packages',
+                          'sources'], self.events)
+
+
+class TestSourcesHandler(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSourcesHandler, self).setUp()
+        self.tdir = self.useFixture(fixtures.TempDir())
+        self.server = self.useFixture(HTTPServerFixture())
+
+    def _serve(self, name, data):
+        self.server.files['/' + name] = data
+        return self.server.url + '/' + name
+
+    def test_apply_sources_empty(self):
+        sh = cfn_helper.SourcesHandler({})
+        sh.apply_sources()
+
+    def test_source_type(self):
         sh = cfn_helper.SourcesHandler({})
-        er = "mkdir -p '%s'; cd '%s'; curl -s '%s' | %s | tar -xvf -"
-        dest = '/tmp'
-        # test tgz
-        url = 'http://www.example.com/a.tgz'
-        cmd = sh._apply_source_cmd(dest, url)
-        self.assertEqual(er % (dest, dest, url, "gunzip"), cmd)
-        # test tar.gz
-        url = 'http://www.example.com/a.tar.gz'
-        cmd = sh._apply_source_cmd(dest, url)
-        self.assertEqual(er % (dest, dest, url, "gunzip"), cmd)
-        # test github - tarball 1
-        url = 'https://github.com/openstack/heat-cfntools/tarball/master'
-        cmd = sh._apply_source_cmd(dest, url)
-        self.assertEqual(er % (dest, dest, url, "gunzip"), cmd)
-        # test github - tarball 2
-        url = 'https://github.com/openstack/heat-cfntools/tarball/master/'
-        cmd = sh._apply_source_cmd(dest, url)
-        self.assertEqual(er % (dest, dest, url, "gunzip"), cmd)
-        # test tbz2
-        url = 'http://www.example.com/a.tbz2'
-        cmd = sh._apply_source_cmd(dest, url)
-        self.assertEqual(er % (dest, dest, url, "bunzip2"), cmd)
-        # test tar.bz2
-        url = 'http://www.example.com/a.tar.bz2'
-        cmd = sh._apply_source_cmd(dest, url)
-        self.assertEqual(er % (dest, dest, url, "bunzip2"), cmd)
-        # test zip
-        er = "mkdir -p '%s'; cd '%s'; curl -s -o '%s' '%s' && unzip -o '%s'"
-        url = 'http://www.example.com/a.zip'
-        d = "/tmp/tmp2I0yNK"
-        tmp = "%s/a.zip" % d
-        with mock.patch.object(tempfile, 'mkdtemp') as mock_mkdtemp:
-            mock_mkdtemp.return_value = d
-
-            cmd = sh._apply_source_cmd(dest, url)
-            self.assertEqual(er % (dest, dest, tmp, url, tmp), cmd)
-            # test gz
-            er = "mkdir -p '%s'; cd '%s'; curl -s '%s' | %s > '%s'"
-            url = 'http://www.example.com/a.sh.gz'
-            cmd = sh._apply_source_cmd(dest, url)
-            self.assertEqual(er % (dest, dest, url, "gunzip", "a.sh"), cmd)
-            # test bz2
-            url = 'http://www.example.com/a.sh.bz2'
-            cmd = sh._apply_source_cmd(dest, url)
-            self.assertEqual(er % (dest, dest, url, "bunzip2", "a.sh"), cmd)
-            # test other
-            url = 'http://www.example.com/a.sh'
-            cmd = sh._apply_source_cmd(dest, url)
-            self.assertEqual("", cmd)
-            mock_mkdtemp.assert_called_with()
+        for url, stype in (
+                ('http://www.example.com/a.tgz', '.tgz'),
+                ('http://www.example.com/a.tar.gz', '.tgz'),
+                ('https://github.com/openstack/heat-cfntools/tarball/master',
+                 '.tgz'),
+                ('https://github.com/openstack/heat-cfntools/tarball/master/',
+                 '.tgz'),
+                ('https://github.com/openstack/heat-cfntools/zipball/master',
+                 '.zip'),
+                ('http://www.example.com/a.tbz2', '.tbz2'),
+                ('http://www.example.com/a.tar.bz2', '.tbz2'),
+                ('http://www.example.com/a.tar.xz', '.txz'),
+                ('http://www.example.com/a.tar', '.tar'),
+                ('http://www.example.com/a.zip', '.zip'),
+                ('http://www.example.com/a.sh.gz', '.gz'),
+                ('http://www.example.com/a.sh.bz2', '.bz2'),
+                ('http://www.example.com/a.sh.xz', ''),
+                ('http://www.example.com/a.sh', '')):
+            self.assertEqual(stype, sh._source_type(url), url)
+
+    def test_apply_sources(self):
+        members = {'top.txt': b'top', 'sub/dir/nested.txt': b'nested'}
+        zip_buf = io.BytesIO()
+        with zipfile.ZipFile(zip_buf, 'w') as archive:
+            for name, data in members.items():
+                info = zipfile.ZipInfo(name)
+                info.external_attr = 0o750 << 16
+                archive.writestr(info, data)
+        sources = {}
+        for name, data in (('a.tgz', make_tar(members)),
+                           ('a.tar.bz2', make_tar(members, 'w:bz2')),
+                           ('a.tar.xz', make_tar(members, 'w:xz')),
+                           ('a.tar', make_tar(members, 'w')),
+                           ('a.zip', zip_buf.getvalue())):
+            sources[os.path.join(self.tdir.path, name)] = self._serve(name,
+                                                                      data)
+
+        with mock.patch('subprocess.Popen') as mock_popen:
+            cfn_helper.SourcesHandler(sources).apply_sources()
+            self.assertFalse(mock_popen.called)
+
+        for dest in sources:
+            self.assertThat(os.path.join(dest, 'top.txt'),
+                            ttm.FileContains('top'))
+            self.assertThat(os.path.join(dest, 'sub', 'dir', 'nested.txt'),
+                            ttm.FileContains('nested'))
+        self.assertEqual(0o750, os.stat(os.path.join(
+            self.tdir.path, 'a.zip', 'top.txt')).st_mode & 0o777)
+        self.assertEqual(0o640, os.stat(os.path.join(
+            self.tdir.path, 'a.tgz', 'top.txt')).st_mode & 0o777)
+
+    def test_apply_sources_single_file(self):
+        gz_url = self._serve('a.sh.gz', gzip.compress(b'echo gz'))
+        bz2_url = self._serve('b.sh.bz2', bz2.compress(b'echo bz2'))
+        cfn_helper.SourcesHandler({self.tdir.path: gz_url,
+                                   os.path.join(self.tdir.path, 'b'): bz2_url}
+                                  ).apply_sources()
+        self.assertThat(os.path.join(self.tdir.path, 'a.sh'),
+                        ttm.FileContains('echo gz'))
+        self.assertThat(os.path.join(self.tdir.path, 'b', 'b.sh'),
+                        ttm.FileContains('echo bz2'))
+
+    def test_apply_sources_refuses_path_traversal(self):
+        dest = os.path.join(self.tdir.path, 'dest')
+        url = self._serve('evil.tgz', make_tar({'../evil.txt': b'evil'}))
+        self.assertRaises(cfn_helper.SourcesHandlerError,
+                          cfn_helper.SourcesHandler({dest: url})
+                          .apply_sources)
+        # absolute names are either refused or kept under dest
+        evil = os.path.join(self.tdir.path, 'evil.txt')
+        url = self._serve('abs.tgz', make_tar({evil: b'evil'}))
+        try:
+            cfn_helper.SourcesHandler({dest: url}).apply_sources()
+        except cfn_helper.SourcesHandlerError:
+            pass
+        self.assertFalse(os.path.exists(os.path.join(self.tdir.path,
+                                                     'evil.txt')))
+
+    def test_check_member(self):
+        sh = cfn_helper.SourcesHandler({})
+        dest = self.tdir.path
+        for name, kind, target in (('../a', tarfile.REGTYPE, ''),
+                                   ('a', tarfile.LNKTYPE, '../c'),
+                                   ('a', tarfile.LNKTYPE, '/etc/passwd')):
+            member = tarfile.TarInfo(name)
+            member.type = kind
+            member.linkname = target
+            self.assertRaises(cfn_helper.SourcesHandlerError,
+                              sh._check_member, dest, member)
+        # as with tar, symbolic links may point anywhere
+        for name, kind, target in (('/a', tarfile.REGTYPE, ''),
+                                   ('a/b', tarfile.SYMTYPE, '../c'),
+                                   ('a/b', tarfile.SYMTYPE, '../../c'),
+                                   ('a', tarfile.SYMTYPE, '/etc/passwd'),
+                                   ('a/b', tarfile.LNKTYPE, 'c')):
+            member = tarfile.TarInfo(name)
+            member.type = kind
+            member.linkname = target
+            self.assertIsNone(sh._check_member(dest, member))
+            self.assertFalse(member.name.startswith('/'))
+
+    def _link_tar(self):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            info = tarfile.TarInfo('a.txt')
+            info.size = 1
+            tar.addfile(info, io.BytesIO(b'a'))
+            for name, kind, target in (('b.txt', tarfile.LNKTYPE, 'a.txt'),
+                                       ('c', tarfile.SYMTYPE, '/etc/hosts'),
+                                       ('d', tarfile.SYMTYPE, '../x')):
+                info = tarfile.TarInfo(name)
+                info.type = kind
+                info.linkname = target
+                tar.addfile(info)
+        return buf.getvalue()
+
+    def _apply_links_twice(self, dest):
+        url = self._serve('links.tgz', self._link_tar())
+        for i in range(2):
+            cfn_helper.SourcesHandler({dest: url}).apply_sources()
+        self.assertThat(os.path.join(dest, 'b.txt'), ttm.FileContains('a'))
+        self.assertEqual(os.stat(os.path.join(dest, 'a.txt')).st_ino,
+                         os.stat(os.path.join(dest, 'b.txt')).st_ino)
+        self.assertEqual('/etc/hosts', os.readlink(os.path.join(dest, 'c')))
+        self.assertEqual('../x', os.readlink(os.path.join(dest, 'd')))
+
+    def test_apply_sources_with_links_twice(self):
+        self._apply_links_twice(os.path.join(self.tdir.path, 'dest'))
+
+    def test_apply_sources_with_links_without_tar_filter(self):
+        with mock.patch.dict(tarfile.__dict__):
+            tarfile.__dict__.pop('tar_filter', None)
+            self._apply_links_twice(os.path.join(self.tdir.path, 'dest'))
+
+    def test_apply_sources_errors_are_raised(self):
+        dest = os.path.join(self.tdir.path, 'dest')
+        for url in (self.server.url + '/missing.tgz',
+                    self._serve('corrupt.tgz', b'not a tarball'),
+                    self._serve('corrupt.zip', b'not a zip file')):
+            self.assertRaises(cfn_helper.SourcesHandlerError,
+                              cfn_helper.SourcesHandler({dest: url})
+                              .apply_sources)
+
+    def test_source_groups(self):
+        sources = collections.OrderedDict([
+            ('/opt/app/plugins', 'http://example.com/plugins.tgz'),
+            ('/opt/lib', 'http://example.com/lib.tgz'),
+            ('/opt/app', 'http://example.com/app.tgz'),
+            ('/opt/application', 'http://example.com/application.tgz'),
+            ('/opt/lib/../app/conf', 'http://example.com/conf.tgz'),
+        ])
+        groups = cfn_helper.SourcesHandler(sources)._source_groups()
+        self.assertEqual(
+            [[('/opt/app/plugins', 'http://example.com/plugins.tgz'),
+              ('/opt/app', 'http://example.com/app.tgz'),
+              ('/opt/lib/../app/conf', 'http://example.com/conf.tgz')],
+             [('/opt/application', 'http://example.com/application.tgz')],
+             [('/opt/lib', 'http://example.com/lib.tgz')]],
+            sorted(groups))
+
+    def test_apply_sources_concurrently(self):
+        sources = collections.OrderedDict(
+            (os.path.join(self.tdir.path, name),
+             self._serve(name + '.tgz', make_tar({name: name.encode()})))
+            for name in ('a', 'b', 'c'))
+        # b goes inside a, so it is unpacked after it
+        sources[os.path.join(self.tdir.path, 'a', 'b')] = sources.pop(
+            os.path.join(self.tdir.path, 'b'))
+        running = []
+        barrier = threading.Barrier(2, timeout=5)
+        apply_source = cfn_helper.SourcesHandler._apply_source
+
+        def fake_apply_source(handler, dest, url):
+            running.append(dest)
+            if len(running) <= 2:
+                # the first sources of both groups run at the same time
+                barrier.wait()
+            apply_source(handler, dest, url)
+
+        self.patch(cfn_helper.SourcesHandler, '_apply_source',
+                   fake_apply_source)
+        cfn_helper.SourcesHandler(sources, workers=2).apply_sources()
+
+        self.assertEqual(
+            [os.path.join(self.tdir.path, 'a'),
+             os.path.join(self.tdir.path, 'a', 'b')],
+            [dest for dest in running
+             if dest.startswith(os.path.join(self.tdir.path, 'a'))])
+        self.assertThat(os.path.join(self.tdir.path, 'a', 'b', 'b'),
+                        ttm.FileContains('b'))
+        self.assertThat(os.path.join(self.tdir.path, 'c', 'c'),
+                        ttm.FileContains('c'))
+
+    def test_apply_sources_failure_raised_after_others(self):
+        sources = collections.OrderedDict([
+            (os.path.join(self.tdir.path, 'a'),
+             self.server.url + '/missing.tgz'),
+            (os.path.join(self.tdir.path, 'b'),
+             self._serve('b.tgz', make_tar({'b': b'b'})))])
+        self.assertRaises(cfn_helper.SourcesHandlerError,
+                          cfn_helper.SourcesHandler(sources).apply_sources)
+        self.assertThat(os.path.join(self.tdir.path, 'b', 'b'),
+                        ttm.FileContains('b'))
+
+    def test_apply_sources_checksums(self):
+        data = make_tar({'a.txt': b'a'})
+        url = self._serve('a.tgz', data)
+        dest = os.path.join(self.tdir.path, 'a')
+        self.assertRaises(cfn_helper.SourcesHandlerError,
+                          cfn_helper.SourcesHandler(
+                              {dest: {'url': url, 'md5': 'f' * 32}})
+                          .apply_sources)
+        self.assertFalse(os.path.exists(os.path.join(dest, 'a.txt')))
+
+        cfn_helper.SourcesHandler({dest: {
+            'url': url, 'sha256': hashlib.sha256(data).hexdigest()}}
+        ).apply_sources()
+        self.assertThat(os.path.join(dest, 'a.txt'), ttm.FileContains('a'))
+
+    def _extracted(self, sources, **kwargs):
+        """Apply sources and return the names of the members written."""
+        extracted = []
+        extract = tarfile.TarFile.extract
+
+        def fake_extract(tar, member, *args, **kwargs):
+            extracted.append(member.name)
+            return extract(tar, member, *args, **kwargs)
+
+        with mock.patch.object(tarfile.TarFile, 'extract', fake_extract):
+            cfn_helper.SourcesHandler(
+                sources, manifest_dir=os.path.join(self.tdir.path, 'state'),
+                **kwargs).apply_sources()
+        return sorted(extracted)
+
+    def test_unchanged_sources_are_skipped(self):
+        url = self._serve('a.tgz', make_tar({'a': b'a', 'b': b'b'}))
+        dest = os.path.join(self.tdir.path, 'dest')
+        self.assertEqual(['a', 'b'], self._extracted({dest: url}))
+
+        # the archive is requested again, conditionally
+        handler = cfn_helper.SourcesHandler(
+            {dest: url}, manifest_dir=os.path.join(self.tdir.path, 'state'))
+        handler.apply_sources()
+        self.assertEqual(set(), handler.changed)
+        self.assertEqual([], self._extracted({dest: url}))
+        self.assertEqual(3, len(self.server.requests))
+        self.assertIn('If-None-Match', self.server.headers[1])
+
+        # a file changed on disk gets the archive unpacked again, but only
+        # the changed file is rewritten
+        with open(os.path.join(dest, 'b'), 'w') as f:
+            f.write('local change')
+        self.assertEqual(['b'], self._extracted({dest: url}))
+        self.assertThat(os.path.join(dest, 'b'), ttm.FileContains('b'))
+
+    def test_changed_sources_rewrite_changed_members(self):
+        tdir = self.useFixture(fixtures.TempDir())
+        cache = cfn_helper.DownloadCache(tdir.path)
+        url = self._serve('a.tgz', make_tar({'a': b'a', 'b': b'b'}))
+        dest = os.path.join(self.tdir.path, 'dest')
+        cache.fetch(url)
+        self.assertEqual(['a', 'b'], self._extracted({dest: url},
+                                                     cache=cache))
+        cache.fetch(url)
+        self.assertEqual([], self._extracted({dest: url}, cache=cache))
+
+        self._serve('a.tgz', make_tar({'a': b'a', 'b': b'bb', 'c': b'c'}))
+        cache.fetch(url)
+        self.assertEqual(['b', 'c'], self._extracted({dest: url},
+                                                     cache=cache))
+        self.assertThat(os.path.join(dest, 'b'), ttm.FileContains('bb'))
+
+    def test_plan_unchanged_sources(self):
+        tdir = self.useFixture(fixtures.TempDir())
+        cache = cfn_helper.DownloadCache(tdir.path)
+        url = self._serve('a.tgz', make_tar({'a': b'a'}))
+        dest = os.path.join(self.tdir.path, 'dest')
+
+        def plan(cache=None):
+            entry, = cfn_helper.SourcesHandler(
+                {dest: url}, cache=cache,
+                manifest_dir=os.path.join(self.tdir.path, 'state'),
+            ).plan_sources()
+            return entry['action'], entry.get('conditional')
+
+        self.assertEqual(('extract', None), plan(cache))
+        cache.fetch(url)
+        self._extracted({dest: url}, cache=cache)
+        self.assertEqual(('unchanged', None), plan(cache))
+        self.assertEqual(('extract', True), plan())
+
+        self._serve('a.tgz', make_tar({'a': b'aa'}))
+        cache.fetch(url)
+        self.assertEqual(('extract', None), plan(cache))
+        requests = len(self.server.requests)
+        plan(cache)
+        self.assertEqual(requests, len(self.server.requests))
+
+    def test_apply_sources_unknown_type_is_skipped(self):
+        dest = os.path.join(self.tdir.path, 'dest')
+        cfn_helper.SourcesHandler(
+            {dest: self._serve('a.sh', b'echo')}).apply_sources()
+        self.assertEqual([], self.server.requests)
+        self.assertFalse(os.path.exists(dest))
@@ -64,7 +64,7 @@ class TestCfnHup(testtools.TestCase):
             with tempfile.NamedTemporaryFile() as last_md:
                 self.metadata.retrieve(last_path=last_md.name)
 
-    def _test_cfn_hup_metadata(self, metadata):
+    def _test_cfn_hup_metadata(self, metadata, monitor=True):
 
         self._mock_retrieve_metadata(metadata)
         FakeServicesHandler = mock.Mock()
@@ -83,10 +83,22 @@ class TestCfnHup(testtools.TestCase):
 
         with mock.patch.object(cfn_helper.Hook, 'event') as mock_method:
             mock_method.return_value = None
-            self.metadata.cfn_hup([hook])
+            self.metadata.cfn_hup([hook], monitor=monitor)
+        return FakeServicesHandler, mock_method
 
     def test_cfn_hup_empty_metadata(self):
         self._test_cfn_hup_metadata({})
 
     def test_cfn_hup_cfn_init_metadata(self):
         self._test_cfn_hup_metadata(self.init_section)
+
+    def test_cfn_hup_without_monitor(self):
+        handler, event = self._test_cfn_hup_metadata(self.init_section,
+                                                     monitor=False)
+        handler.assert_not_called()
+        event.assert_called_once_with('post.update', self.resource,
+                                      self.resource)
+
+    def test_cfn_hup_monitors_services(self):
+        handler, event = self._test_cfn_hup_metadata(self.init_section)
+        handler.return_value.monitor_services.assert_called_once_with()